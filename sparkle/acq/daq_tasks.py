@@ -10,6 +10,8 @@ except:
 
 import numpy as np
 
+from sparkle.tools.precision import as_daq, signal_dtype
+
 
 class AITask(Task):
     """Class for managing continuous input with NI devices
@@ -37,12 +39,13 @@ class AITask(Task):
                               DAQmx_Val_ContSamps, bufsize)
         #self.AutoRegisterEveryNSamplesEvent(DAQmx_Val_Acquired_Into_Buffer,100,0)
         self.AutoRegisterDoneEvent(0)
+        self.ring = None
 
     def start(self):
         """Begins acquistition"""
         self.StartTask()
 
-    def register_callback(self, fun, npts):
+    def register_callback(self, fun, npts, ring=None):
         """ Provide a function to be executed periodically on 
         data collection, every time after the specified number 
         of points are collected.
@@ -51,9 +54,14 @@ class AITask(Task):
         :type fun: function
         :param npts: The number of data points collected before the function is called.
         :type npts: int
+        :param ring: buffer to read the data into, instead of allocating a new array for each read. Its blocks must be (channels, *npts*) of float64. *fun* is then passed a view of the block just read
+        :type ring: :class:`RingBuffer<sparkle.acq.ring_buffer.RingBuffer>`
         """
+        if ring is not None and (ring.block_shape != (self.nchans, npts) or ring.dtype != np.float64):
+            raise ValueError("Ring buffer blocks must be {} float64".format((self.nchans, npts)))
         self.callback_fun = fun
         self.n = npts
+        self.ring = ring
         self.AutoRegisterEveryNSamplesEvent(DAQmx_Val_Acquired_Into_Buffer,
                                             npts, 0, name=u"_run_callback")
     def _run_callback(self):
@@ -62,11 +70,18 @@ class AITask(Task):
 
     def _read(self):
         r = c_int32()
+        if self.ring is not None:
+            # the driver writes straight into the ring
+            data = self.ring.write_slot()
+            self.ReadAnalogF64(self.n,10.0,DAQmx_Val_GroupByChannel,
+                                data.reshape(-1), self.n*self.nchans, byref(r), None)
+            self.ring.commit()
+            return data
         inbuffer = np.zeros(self.n*self.nchans)
         self.ReadAnalogF64(self.n,10.0,DAQmx_Val_GroupByChannel,
                             inbuffer, self.n*self.nchans, byref(r), None)
         data = inbuffer.reshape(self.nchans, self.n)
-        return data
+        return data.astype(signal_dtype(), copy=False)
 
     def stop(self):
         """Halts the acquisition"""
@@ -115,7 +130,7 @@ class AOTask(Task):
         w = c_int32()
         # print "output max", max(abs(output))
         self.WriteAnalogF64(self.bufsize, 0, 10.0, DAQmx_Val_GroupByChannel,
-                            output, w, None);
+                            as_daq(output), w, None);
     def stop(self):
         """Halts the Generation"""
         self.StopTask()
@@ -134,8 +149,10 @@ class AITaskFinite(Task):
     :type clksrc: str
     :param trigsrc: source of a digital trigger to start the generation, default : no trigger, begin immediately on call of start method
     :type trigsrc: str
+    :param retriggerable: whether the acquisition re-arms itself when finished, and acquires again on the next trigger. Only used with *trigsrc*
+    :type retriggerable: bool
     """
-    def __init__(self, chan, samplerate, npts, clksrc="", trigsrc=None):
+    def __init__(self, chan, samplerate, npts, clksrc="", trigsrc=None, retriggerable=False):
         Task.__init__(self)
         if isinstance(chan, list):
             self.nchans = len(chan)
@@ -151,25 +168,37 @@ class AITaskFinite(Task):
 
         if trigsrc:
             self.CfgDigEdgeStartTrig(trigsrc, DAQmx_Val_Rising)
+            if retriggerable:
+                self.SetStartTrigRetriggerable(True)
 
     def start(self):
         """Begins acquistition -- immediately if not using a trigger"""
         self.StartTask()
 
-    def read(self):
-        """Reads the data off of the device input buffer. Blocks for acquisition to finish with a timeout of 10 seconds
+    def read(self, wait_done=True, timeout=10.0):
+        """Reads the data off of the device input buffer. Blocks for acquisition to finish
         
-        :returns: numpy.ndarray -- the acquired data
+        :param wait_done: whether to also wait for the task to finish. A retriggerable task never finishes, so it must not wait
+        :type wait_done: bool
+        :param timeout: longest to wait for the data, and again for the task to finish (seconds)
+        :type timeout: float
+        :returns: numpy.ndarray -- the acquired data, of the signal dtype (see :mod:`sparkle.tools.precision`)
         """
         r = c_int32()
         bufsize = self.npts*self.nchans
         inbuffer = np.zeros(bufsize)
-        self.ReadAnalogF64(self.npts, 10.0, DAQmx_Val_GroupByChannel, inbuffer,
+        self.ReadAnalogF64(self.npts, timeout, DAQmx_Val_GroupByChannel, inbuffer,
                            bufsize, byref(r), None)
-        self.WaitUntilTaskDone(10.0)
+        if wait_done:
+            self.WaitUntilTaskDone(timeout)
 
 
-        return inbuffer.reshape(self.nchans, self.npts)
+        return inbuffer.reshape(self.nchans, self.npts).astype(signal_dtype(), copy=False)
+
+    def rearm(self):
+        """Returns a finished acquisition to its configured state, so that it
+        can be started again without being re-created"""
+        self.StopTask()
 
     def stop(self):
         """Halts the acquisition"""
@@ -193,8 +222,10 @@ class AOTaskFinite(Task):
     :type clksrc: str
     :param trigsrc: source of a digital trigger to start the generation
     :type trigsrc: str
+    :param retriggerable: whether the generation re-arms itself when finished, and outputs the buffer again on the next trigger. Only used with *trigsrc*
+    :type retriggerable: bool
     """
-    def __init__(self, chan, samplerate, npoints, clksrc=u"", trigsrc=None):
+    def __init__(self, chan, samplerate, npoints, clksrc=u"", trigsrc=None, retriggerable=False):
         Task.__init__(self)
         self.npoints = npoints
 
@@ -203,6 +234,8 @@ class AOTaskFinite(Task):
                               DAQmx_Val_FiniteSamps, npoints)
         if trigsrc:
             self.CfgDigEdgeStartTrig(trigsrc, DAQmx_Val_Rising)
+            if retriggerable:
+                self.SetStartTrigRetriggerable(True)
 
     def start(self):
         """Begins generation -- immediately, if not using a trigger"""
@@ -216,7 +249,7 @@ class AOTaskFinite(Task):
         """
         w = c_int32()
         self.WriteAnalogF64(self.npoints, 0, 10.0, DAQmx_Val_GroupByChannel,
-                            output, w, None);
+                            as_daq(output), w, None);
 
     def wait(self):
         """returns after the generation finishes"""
@@ -310,6 +343,16 @@ class CounterOutTask(Task):
         self.StopTask()
         self.ClearTask()
 
+def get_counter_terminal(chan):
+    """The internal terminal the output of a counter channel can be routed from
+
+    :param chan: counter channel, e.g. 'PCI-6259/ctr0'
+    :type chan: str
+    :returns: str -- terminal name, e.g. '/PCI-6259/Ctr0InternalOutput'
+    """
+    devname, counter = chan.strip('/').split('/')
+    return '/{}/Ctr{}InternalOutput'.format(devname, counter[len('ctr'):])
+
 def get_ao_chans(dev):
     """Discover and return a list of the names of all analog output channels for the given device
 
@@ -1,6 +1,13 @@
-"""Stand-in module for development when NI drivers are not available"""
+"""Stand-in module for development when NI drivers are not available.
+
+Tasks are timed as they would be on the device, and what is read on the
+analog inputs comes from :data:`simulation`, which can loop the analog
+output back to the inputs, with a delay, noise and synthetic spikes. See
+:meth:`DeviceSimulation.configure`.
+"""
 import threading
 import time
+from collections import defaultdict
 from ctypes import c_bool
 
 import numpy as np
@@ -18,27 +25,158 @@ DAQmx_Val_WaitInfinitely = None
 DAQmx_Val_Hz = None
 DAQmx_Val_Low = None
 
+# number of calls made to each driver function, so that the task
+# handling overhead can be measured in development mode
+call_counts = defaultdict(int)
+
+# running counter pulse trains, terminal: (start time, period), so that
+# tasks triggered from them wait as they would on the device
+_pulse_trains = {}
+
+class DAQError(Exception):
+	"""Raised where the driver would return an error"""
+
+def _counter_terminal(chan):
+	devname, counter = chan.strip('/').split('/')
+	return '/{}/Ctr{}InternalOutput'.format(devname, counter[len('ctr'):])
+
+class DeviceSimulation(object):
+	"""Settings and state of the simulated device, shared by all stub tasks.
+	The defaults read a fixed sine wave, as fast as the timing allows."""
+	defaults = {'time_scale': 1., 'loopback': False, 'delay': 0., 'noise': 0.,
+				'spike_rate': 0., 'spike_amplitude': 1., 'spike_duration': 0.001,
+				'seed': None}
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		"""Restores the default settings, and forgets any output"""
+		self.configure(**self.defaults)
+		# device name: (first channel of the running output, samplerate)
+		self.outputs = {}
+		# number of spikes added to the input so far
+		self.spikes_injected = 0
+		# sample positions of the spikes in the last read, per channel
+		self.last_spikes = []
+
+	def configure(self, **kwargs):
+		"""Changes the simulation settings. Available settings:
+
+		:param time_scale: factor on the duration tasks take, e.g. 0.1 acquires 10 times faster than the device would, and 0 does not wait at all
+		:type time_scale: float
+		:param loopback: whether the analog inputs read the output of the same device, instead of a fixed sine wave
+		:type loopback: bool
+		:param delay: time (seconds) from output to input, when looped back
+		:type delay: float
+		:param noise: standard deviation (V) of gaussian noise added to the input
+		:type noise: float
+		:param spike_rate: mean number of spikes per second added to each input channel, at random times
+		:type spike_rate: float
+		:param spike_amplitude: peak (V) of the spikes. Spikes are detected if this is above the spike threshold
+		:type spike_amplitude: float
+		:param spike_duration: duration (seconds) of each spike
+		:type spike_duration: float
+		:param seed: random seed for the noise and spikes, for repeatable input
+		:type seed: int
+		"""
+		for key in kwargs:
+			if key not in self.defaults:
+				raise ValueError("Unknown simulation setting: {}".format(key))
+		for key, value in kwargs.items():
+			setattr(self, key, value)
+		if 'seed' in kwargs:
+			self.random = np.random.RandomState(kwargs['seed'])
+
+	def acquire(self, device, nchans, npts, fs, offset):
+		"""Simulated input
+
+		:param device: name of the device the input is on
+		:type device: str
+		:param nchans: number of channels
+		:type nchans: int
+		:param npts: samples per channel
+		:type npts: int
+		:param fs: input samplerate
+		:type fs: float
+		:param offset: samples since the acquisition started
+		:type offset: int
+		:returns: numpy.ndarray -- (nchans, npts) samples
+		"""
+		if self.loopback:
+			data = np.tile(self._loopback(device, npts, fs, offset), (nchans, 1))
+		else:
+			t = np.arange(npts*nchans)
+			data = 2*np.sin(2*np.pi*5*t/len(t)).reshape(nchans, npts)
+		if self.noise > 0:
+			data += self.random.normal(0, self.noise, data.shape)
+		self.last_spikes = []
+		if self.spike_rate > 0:
+			for chan in data:
+				self.last_spikes.append(self._add_spikes(chan, fs))
+		return data
+
+	def _loopback(self, device, npts, fs, offset):
+		output = self.outputs.get(device)
+		if output is None:
+			return np.zeros((npts,))
+		buf, ao_fs = output
+		t = np.arange(offset, offset+npts)/float(fs) - self.delay
+		return np.interp(t, np.arange(len(buf))/float(ao_fs), buf, left=0., right=0.)
+
+	def _add_spikes(self, chan, fs):
+		spike_npts = max(int(self.spike_duration*fs), 2)
+		nspikes = self.random.poisson(self.spike_rate*len(chan)/float(fs))
+		starts = np.sort(self.random.randint(0, max(len(chan) - spike_npts, 1), nspikes))
+		# biphasic waveform, rising to the amplitude first
+		waveform = self.spike_amplitude*np.sin(2*np.pi*np.arange(spike_npts)/spike_npts)
+		indexes = (starts[:, np.newaxis] + np.arange(spike_npts)).reshape(-1)
+		np.add.at(chan, indexes, np.tile(waveform, nspikes))
+		self.spikes_injected += nspikes
+		return starts
+
+simulation = DeviceSimulation()
+
+def _device(chan):
+	return chan.split(',')[0].strip().strip('/').split('/')[0]
+
 class Task(object):
 	def CreateAIVoltageChan(self, chan, name, p0, minv, maxv, units, p1):
+		call_counts['CreateAIVoltageChan'] += 1
 		self._nchans = len(chan.split(','))
+		self._device = _device(chan)
 
 	def CreateAOVoltageChan(self, chan, name, minv, maxv, units, p1):
+		call_counts['CreateAOVoltageChan'] += 1
 		self._nchans = len(chan.split(','))
+		self._device = _device(chan)
+		self._output = None
 
 	def CreateDOChan(self, chan, name, groupby):
 		pass
 
 	def CfgSampClkTiming(self, clk, fs, edge, acq_mode, bufsize):
 		self.fs = fs
+		self._npts = bufsize
 
 	def AutoRegisterDoneEvent(self, p0):
 		pass
 
 	def StartTask(self):
-		pass
+		call_counts['StartTask'] += 1
+		self._t_start = time.time()
+		if getattr(self, '_terminal', None) is not None:
+			_pulse_trains[self._terminal] = (self._t_start, 1./self._rate)
+		if getattr(self, '_output', None) is not None:
+			simulation.outputs[self._device] = (self._output, self.fs)
+		# number of triggered acquisitions completed since start
+		self._ntriggered = 0
+		# samples per channel read since start
+		self._nread = 0
+		self._waited_until = None
 
 	def AutoRegisterEveryNSamplesEvent(self, p0, npts, p1, name):
 		self._halt = False
+		self._continuous = True
 		interval = float(npts)/self.fs
 		t = threading.Thread(target=self._autoread, args=(interval,name))
 		t.start()
@@ -46,29 +184,78 @@ class Task(object):
 	def _autoread(self, interval, callback_name):
 		while not self._halt:
 			exec "self."+callback_name+"()"
-			time.sleep(interval)
+			time.sleep(interval*simulation.time_scale)
 
 	def ReadAnalogF64(self, npts, maxv, groupby, inbuffer, total_samples, datatype, p0):
-		# populate contents of inbuffer with some fake data
-		t = np.arange(npts*self._nchans)
-		f = 5
-		data = 2*np.sin(2*np.pi*f*t/len(t))
-		inbuffer[:] = data
+		if getattr(self, '_continuous', False):
+			offset = getattr(self, '_nread', 0)
+		else:
+			# a finite read is of one whole acquisition
+			offset = 0
+			self._wait_acquired(npts, maxv)
+		data = simulation.acquire(self._device, self._nchans, npts, self.fs, offset)
+		inbuffer[:] = data.reshape(-1)
+		self._nread = offset + npts
+
+	def _wait_acquired(self, npts, timeout):
+		"""Blocks until a finite acquisition of *npts* would be done"""
+		train = _pulse_trains.get(getattr(self, '_trigsrc', None))
+		if getattr(self, '_retriggerable', False) and train is not None:
+			# the data is ready once the next pulse's acquisition is done
+			t0, period = train
+			self._ntriggered += 1
+			done = t0 + ((self._ntriggered - 1)*period + float(npts)/self.fs)*simulation.time_scale
+		else:
+			done = getattr(self, '_t_start', time.time()) + float(npts)/self.fs*simulation.time_scale
+		self._wait_until(done, float(npts)/self.fs, timeout)
+
+	def _wait_until(self, done, duration, timeout):
+		"""Sleeps until *done*, or fails as the device would if the
+		*duration* (device seconds) left to wait is longer than *timeout*"""
+		if done <= getattr(self, '_waited_until', None):
+			return
+		remaining = done - time.time()
+		if simulation.time_scale > 0:
+			device_remaining = remaining/simulation.time_scale
+		else:
+			# no time passes in the simulation, all of it is left
+			device_remaining = duration
+		if timeout is not None and timeout >= 0 and device_remaining > timeout:
+			raise DAQError("Timed out waiting for the task, {:.1f}s left of a {:.1f}s timeout".format(device_remaining, timeout))
+		if remaining > 0:
+			time.sleep(remaining)
+		self._waited_until = done
 
 	def StopTask(self):
+		call_counts['StopTask'] += 1
 		self._halt = True
+		if getattr(self, '_terminal', None) is not None:
+			_pulse_trains.pop(self._terminal, None)
+		if getattr(self, '_output', None) is not None:
+			current = simulation.outputs.get(self._device)
+			if current is not None and current[0] is self._output:
+				del simulation.outputs[self._device]
 
 	def ClearTask(self):
-		pass
+		call_counts['ClearTask'] += 1
 
 	def CfgDigEdgeStartTrig(self, trigsrc, edge):
-		pass
+		self._trigsrc = trigsrc
+
+	def SetStartTrigRetriggerable(self, retriggerable):
+		self._retriggerable = retriggerable
 
 	def WriteAnalogF64(self, npts, p0, maxv, grouby, output, datatype, p1):
-		pass
+		call_counts['WriteAnalogF64'] += 1
+		# only the first channel is looped back
+		self._output = np.array(output[:npts], dtype=np.float64)
 
 	def WaitUntilTaskDone(self, timeout):
-		time.sleep(0.1)
+		npts = getattr(self, '_npts', None)
+		if npts is None or not hasattr(self, '_t_start'):
+			return
+		duration = float(npts)/self.fs
+		self._wait_until(self._t_start + duration*simulation.time_scale, duration, timeout)
 
 	def WriteDigitalLines(self, npts, autostart, timeout, groupby, data, wrote, p1):
 		pass
@@ -77,7 +264,8 @@ class Task(object):
 		response_buffer.value = 0
 
 	def CreateCOPulseChanFreq(self, chan, name, units, idle, somenum, rate, duty):
-		pass
+		self._terminal = _counter_terminal(chan)
+		self._rate = rate
 
 	def CfgImplicitTiming(self, mode, npoints):
 		pass	
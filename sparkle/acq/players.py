@@ -3,10 +3,12 @@ import os
 import platform
 import threading
 
+import numpy as np
 import yaml
 
 from sparkle.acq.daq_tasks import AITask, AITaskFinite, AOTaskFinite, \
-    DigitalOutTask
+    CounterOutTask, DigitalOutTask, get_counter_terminal
+from sparkle.acq.ring_buffer import RingBuffer
 
 if platform.system() == 'Windows':
     import win32com.client
@@ -193,9 +195,70 @@ class AbstractPlayerBase(object):
         self.trigger_dest = trigger
 
 class FinitePlayer(AbstractPlayerBase):
-    """For finite generation/acquisition tasks"""
-    def __init__(self):
+    """For finite generation/acquisition tasks
+
+    :param persistent: see :meth:`set_persistent`
+    :type persistent: bool
+    """
+    def __init__(self, persistent=False):
         super(FinitePlayer, self).__init__()
+        self.persistent = persistent
+        # settings the current persistent tasks were created with
+        self._ai_config = None
+        self._ao_config = None
+        # hardware rep clock, see set_rep_clock
+        self.reprate = None
+        self.clock_chan = None
+        self.clock = None
+
+    def set_persistent(self, persistent):
+        """Sets whether the device tasks are kept between repetitions.
+
+        By default, new input and output tasks are created, and the
+        stimulus written, for every repetition. Persistent tasks are
+        created on start, and only re-created if the channels, samplerates
+        or durations change. The output buffer is only rewritten when
+        :meth:`set_stim<AbstractPlayerBase.set_stim>` has been called, and
+        the output re-arms itself on each start of the acquisition, using a
+        retriggerable start.
+
+        :param persistent: whether to keep tasks between repetitions
+        :type persistent: bool
+        """
+        self.persistent = persistent
+
+    def set_rep_clock(self, reprate, chan=None):
+        """Sets a device counter to trigger each repetition, instead of
+        software. Tasks are kept between repetitions, as for
+        :meth:`set_persistent`, and the acquisition re-arms itself for each
+        counter pulse, so :meth:`run` only has to read each repetition's
+        data before the device input buffer fills. The first :meth:`run`
+        after :meth:`start` starts the counter, and changing the stimulus
+        restarts it. The stimulus must be shorter than the interval
+        between repetitions.
+
+        :param reprate: repetitions per second, or None to start each repetition from software
+        :type reprate: float
+        :param chan: counter channel to generate the clock on, default is counter 0 of the AI device
+        :type chan: str
+        """
+        self.reprate = reprate
+        self.clock_chan = chan
+
+    def _clock_chan(self):
+        if self.clock_chan is not None:
+            return self.clock_chan
+        aichan = self.aichan
+        if isinstance(aichan, list):
+            aichan = aichan[0]
+        return aichan.strip('/').split('/')[0] + '/ctr0'
+
+    def _stop_clock(self):
+        """Halts the rep clock, and disarms the acquisition it triggers"""
+        if self.clock is not None:
+            self.clock.stop()
+            self.clock = None
+            self.aitask.rearm()
 
     def start(self):
         """Writes output buffer and settings to device
@@ -213,6 +276,11 @@ class FinitePlayer(AbstractPlayerBase):
         self.ngenerated = 0
         self.nacquired = 0
 
+        if self.persistent or self.reprate is not None:
+            # tasks are not re-created between runs, so there is
+            # nothing more for the lock to guard
+            self.daq_lock.release()
+
         return self.reset()
 
     def run(self):
@@ -224,6 +292,10 @@ class FinitePlayer(AbstractPlayerBase):
             if self.aotask is None:
                 print u"You must arm the calibration first"
                 return
+            if self.reprate is not None:
+                return self._run_clocked()
+            if self.persistent:
+                return self._run_persistent()
             # acquire data and stop task, lock must have been release by
             # previous reset
             self.daq_lock.acquire()
@@ -249,9 +321,101 @@ class FinitePlayer(AbstractPlayerBase):
 
         return data
 
+    def run_batch(self, nreps, interval):
+        """Presents the current stimulus *nreps* times, in a single
+        generation/acquisition, so that the repetitions are timed by the
+        device sample clock rather than by software. The output buffer
+        holds every repetition, each followed by silence up to the start
+        of the next. Independent of :meth:`start`, :meth:`run` and
+        :meth:`reset`; the tasks are created and cleared here.
+
+        :param nreps: number of repetitions
+        :type nreps: int
+        :param interval: time between the starts of consecutive repetitions (seconds). Must not be shorter than the stimulus or the recording window
+        :type interval: float
+        :returns: numpy.ndarray -- responses, shape (reps, channels, samples), a view of the single acquisition buffer
+        """
+        response_npts = int(self.aitime*self.aifs)
+        ai_period = int(round(interval*self.aifs))
+        ao_period = int(round(interval*self.fs))
+        if response_npts > ai_period or self.stim.size > ao_period:
+            raise ValueError("Interval of {}s is shorter than the stimulus or recording window".format(interval))
+
+        self.daq_lock.acquire()
+        try:
+            self.tone_lock.acquire()
+            try:
+                output = np.zeros((nreps, ao_period), dtype=self.stim.dtype)
+                output[:, :self.stim.size] = self.stim
+                output = output.reshape(-1)
+                self.stim_changed = False
+            finally:
+                self.tone_lock.release()
+
+            self.aitask = AITaskFinite(self.aichan, self.aifs, nreps*ai_period,
+                                       trigsrc=self.trigger_dest)
+            self.aotask = AOTaskFinite(self.aochan, self.fs, output.size,
+                                       trigsrc=u"ai/StartTrigger")
+            self.aotask.write(output)
+            if self.attenuator is not None:
+                self.attenuator.SetAtten(self.atten)
+            self.aotask.StartTask()
+            self.aitask.StartTask()
+            # the acquisition lasts every interval of the batch
+            data = self.aitask.read(timeout=nreps*interval + 10.0)
+            self.ngenerated += nreps
+            self.nacquired += nreps
+        finally:
+            self.stop()
+            self.daq_lock.release()
+
+        # (chans, reps*period) -> (reps, chans, samples), without copying
+        nchans = data.shape[0]
+        return data.reshape(nchans, nreps, ai_period).transpose(1, 0, 2)[:, :, :response_npts]
+
+    def _run_clocked(self):
+        """Reads the next repetition triggered by the rep clock, starting
+        the clock if it isn't running"""
+        try:
+            if self.clock is None:
+                # arm the acquisition before the first trigger
+                self.aitask.StartTask()
+                self.clock = CounterOutTask(self._clock_chan(), self.reprate)
+                self.clock.start()
+            data = self.aitask.read(wait_done=False)
+            self.nacquired += 1
+        except:
+            print u'ERROR! TERMINATE!'
+            self.stop()
+            raise
+
+        return data
+
+    def _run_persistent(self):
+        """Starts the acquisition, which triggers the already armed output"""
+        try:
+            self.aitask.StartTask()
+            data = self.aitask.read()
+            self.nacquired += 1
+            self.aitask.rearm()
+            if self.stim.size > self.aitime*self.fs:
+                # output longer than the recording window is cut off,
+                # as for non-persistent tasks
+                self.aotask.StopTask()
+                self.aotask.StartTask()
+        except:
+            print u'ERROR! TERMINATE!'
+            self.stop()
+            raise
+
+        return data
+
     def reset(self):
         """Rearms the gen/acq task, to the same channels as before"""
 
+        if self.persistent or self.reprate is not None:
+            return self._reset_persistent()
+
         response_npts = int(self.aitime*self.aifs)
         try:
             self.aitask = AITaskFinite(self.aichan, self.aifs, response_npts, trigsrc=self.trigger_dest)
@@ -265,23 +429,101 @@ class FinitePlayer(AbstractPlayerBase):
         self.daq_lock.release()
         return new_gen
 
+    def _reset_persistent(self):
+        """Brings the persistent tasks up to date with the current settings,
+        re-creating a task only if its configuration changed"""
+        response_npts = int(self.aitime*self.aifs)
+        clocked = self.reprate is not None
+        if clocked:
+            trigger = get_counter_terminal(self._clock_chan())
+        else:
+            trigger = self.trigger_dest
+        ai_config = (self.aichan, self.aifs, response_npts, trigger, self.reprate)
+        try:
+            if self.aitask is None or ai_config != self._ai_config:
+                if self.aitask is not None:
+                    self._stop_clock()
+                    self.aitask.stop()
+                    # the output is triggered by this task
+                    self._stop_generation()
+                self.aitask = AITaskFinite(self.aichan, self.aifs, response_npts,
+                                           trigsrc=trigger, retriggerable=clocked)
+                self._ai_config = ai_config
+            if self.stim_changed:
+                # reps triggered while the output is rewritten
+                # would go without a stimulus
+                self._stop_clock()
+            new_gen = self._regenerate(u"ai/StartTrigger")
+        except:
+            print u'ERROR! TERMINATE!'
+            self.stop()
+            raise
+
+        return new_gen
+
+    def _regenerate(self, trigger):
+        """Re-arms the persistent analog output, only writing to the device
+        if the stimulus has changed since the last write"""
+        self.tone_lock.acquire()
+        try:
+            npts = self.stim.size
+            ao_config = (self.aochan, self.fs, npts)
+            if self.aotask is not None and ao_config != self._ao_config:
+                self._stop_generation()
+            if self.aotask is None:
+                self.aotask = AOTaskFinite(self.aochan, self.fs, npts, trigsrc=trigger,
+                                           retriggerable=True)
+                self._ao_config = ao_config
+                self.stim_changed = True
+            elif self.stim_changed:
+                # disarm to replace the buffer contents
+                self.aotask.StopTask()
+
+            self.ngenerated +=1
+            if self.stim_changed:
+                self.aotask.write(self.stim)
+                if self.attenuator is not None:
+                    self.attenuator.SetAtten(self.atten)
+                # waits for the trigger from the acquisition
+                self.aotask.StartTask()
+                new_gen = self.stim
+            else:
+                new_gen = None
+            self.stim_changed = False
+        finally:
+            self.tone_lock.release()
+        return new_gen
+
+    def _stop_generation(self):
+        self.aotask.stop()
+        self.aotask = None
+        self._ao_config = None
+
     def stop(self):
         """Halts the acquisition, this must be called before resetting acquisition"""
         try:
+            if self.clock is not None:
+                self.clock.stop()
             self.aitask.stop()
             self.aotask.stop()
             pass
         except:     
             print u"No task running"
+        self.clock = None
         self.aitask = None
         self.aotask = None
+        self._ai_config = None
+        self._ao_config = None
 
 
 class ContinuousPlayer(AbstractPlayerBase):
     """This is a continuous player for a chart acquitision operation"""
+    # seconds of input held in the ring buffer
+    ring_duration = 5.
     def __init__(self):
         super(ContinuousPlayer, self).__init__()
         self.on_read = lambda x: x # placeholder
+        self.ring = None
 
     def start_continuous(self, aichans, update_hz=10):
         """Begins a continuous analog generation, calling a provided function
@@ -297,14 +539,18 @@ class ContinuousPlayer(AbstractPlayerBase):
         self.ngenerated = 0 # number of stimuli presented during chart run
         npts = int(self.aifs/update_hz) #update display at 10Hz rate
         nchans = len(aichans)
+        # reads go into preallocated blocks, which consumers take
+        # views of with ring.reader()
+        nblocks = max(int(self.ring_duration*update_hz), 1) + 1
+        self.ring = RingBuffer(nblocks, nchans, npts)
         self.aitask = AITask(aichans, self.aifs, npts*5*nchans)
-        self.aitask.register_callback(self._read_continuous, npts)
+        self.aitask.register_callback(self._read_continuous, npts, ring=self.ring)
         self.aitask.start()
 
     def set_read_function(self, fun):
         """Set the function to be executed for every read from the device buffer
 
-        :param fun: callable which must take a numpy.ndarray as the only positional argument
+        :param fun: callable which must take a numpy.ndarray as the only positional argument. This is a view of the ring buffer, see :class:`RingReader<sparkle.acq.ring_buffer.RingReader>` for how long it is valid
         :type fun: function
         """
         self.on_read = fun
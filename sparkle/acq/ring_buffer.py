@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """Fixed size, preallocated store for continuously acquired samples.
+
+    The buffer is a ring of equal sized blocks, one block per read from the
+    device, each holding (channels, samples). The device read fills the
+    next block in place, and consumers get views of the filled blocks
+    through their own :class:`RingReader`, so no samples are copied or
+    allocated after creation. The producer never waits: when it laps a
+    consumer, the consumer's unread blocks are overwritten, and counted as
+    dropped by that consumer's reader.
+
+    :param nblocks: number of blocks in the ring. One block is always held for the device to write to, so consumers can fall at most *nblocks* - 1 blocks behind
+    :type nblocks: int
+    :param nchans: number of channels per block
+    :type nchans: int
+    :param npts: number of samples per channel per block
+    :type npts: int
+    :param dtype: sample type. The DAQmx driver reads float64
+    :type dtype: numpy.dtype
+    """
+    def __init__(self, nblocks, nchans, npts, dtype=np.float64):
+        if nblocks < 2:
+            raise ValueError("Ring buffer needs at least 2 blocks")
+        self._data = np.zeros((nblocks, nchans, npts), dtype=dtype)
+        self.dtype = self._data.dtype
+        self.nblocks = nblocks
+        # total number of blocks committed
+        self.written = 0
+        # number of times the producer overwrote a block no reader had read
+        self.overruns = 0
+        self._readers = []
+        self._lock = threading.Lock()
+
+    @property
+    def block_shape(self):
+        """(channels, samples) shape of a block"""
+        return self._data.shape[1:]
+
+    def write_slot(self):
+        """The block the next read from the device is to be written to.
+        Call :meth:`commit` once it is filled.
+
+        :returns: numpy.ndarray -- (channels, samples) view into the ring
+        """
+        return self._data[self.written % self.nblocks]
+
+    def commit(self):
+        """Marks the block from :meth:`write_slot` as filled, and makes it
+        available to readers"""
+        with self._lock:
+            self.written += 1
+            oldest = self.written - (self.nblocks - 1)
+            if any([reader.nread < oldest for reader in self._readers]):
+                self.overruns += 1
+
+    def reader(self, from_oldest=False):
+        """Creates a consumer of the blocks committed from now on
+
+        :param from_oldest: start from the oldest block still in the ring, instead of the next one committed
+        :type from_oldest: bool
+        :returns: :class:`RingReader`
+        """
+        with self._lock:
+            if from_oldest:
+                start = max(self.written - (self.nblocks - 1), 0)
+            else:
+                start = self.written
+            reader = RingReader(self, start)
+            self._readers.append(reader)
+        return reader
+
+    def remove_reader(self, reader):
+        """Stops accounting for *reader* in the overrun count"""
+        with self._lock:
+            self._readers.remove(reader)
+
+    def _views(self, start, stop):
+        """Views of the blocks numbered *start* to *stop*, at most two, as
+        the range may wrap around the end of the ring"""
+        first = start % self.nblocks
+        last = first + (stop - start)
+        if last <= self.nblocks:
+            return [self._data[first:last]]
+        return [self._data[first:], self._data[:last - self.nblocks]]
+
+
+class RingReader(object):
+    """A consumer's position in a :class:`RingBuffer`, created by
+    :meth:`RingBuffer.reader`. Each reader sees every block once, unless
+    the producer overwrites it first, in which case it is counted in
+    :attr:`dropped`.
+    """
+    def __init__(self, ring, start):
+        self.ring = ring
+        self.nread = start
+        # number of blocks overwritten before this reader got to them
+        self.dropped = 0
+
+    def available(self):
+        """Number of blocks ready to be read
+
+        :returns: int
+        """
+        return min(self.ring.written - self.nread, self.ring.nblocks - 1)
+
+    def read(self, max_blocks=None):
+        """Takes the unread blocks, oldest first. The returned arrays are
+        views into the ring, valid until the producer laps this reader
+        again; copy them if they are kept longer.
+
+        :param max_blocks: most blocks to take, default all available
+        :type max_blocks: int
+        :returns: list<numpy.ndarray> -- arrays of shape (blocks, channels, samples), two if the blocks wrap around the end of the ring, or none if there is nothing to read
+        """
+        with self.ring._lock:
+            oldest = self.ring.written - (self.ring.nblocks - 1)
+            if self.nread < oldest:
+                self.dropped += oldest - self.nread
+                self.nread = oldest
+            stop = self.ring.written
+            if max_blocks is not None:
+                stop = min(stop, self.nread + max_blocks)
+            if stop == self.nread:
+                return []
+            views = self.ring._views(self.nread, stop)
+            self.nread = stop
+        return views
+
+    def read_blocks(self, max_blocks=None):
+        """As :meth:`read`, but as one view per block
+
+        :returns: list<numpy.ndarray> -- (channels, samples) arrays
+        """
+        return [block for chunk in self.read(max_blocks) for block in chunk]
@@ -71,7 +71,7 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
-    def init_data(self, key, dims=None, mode='finite', nested_name=None):
+    def init_data(self, key, dims=None, mode='finite', nested_name=None, dtype=None):
         """
         Initializes a new dataset
 
@@ -87,8 +87,10 @@ class AcquisitionData(object):
             * if mode == 'calibration', this is the total size
         :param mode: The kind of acquisition taking place
         :type mode: str
-        :param nested_name: If mode is calibration, then this will be the dataset name created under the group key. Ignored for other modes.
+        :param nested_name: If mode is calibration, then this will be the dataset name created under the group key. If mode is finite, creates a dataset of this name under the group key, instead of the next test_#, for data to go along with the current test. Such a dataset is not listed by :meth:`dataset_names` or :meth:`all_datasets`. Ignored for other modes.
         :type nested_name: str
+        :param dtype: Type of the stored data. Default is 32 bit float; pass :func:`signal_dtype()<sparkle.tools.precision.signal_dtype>` to store data as it is held in memory.
+        :type dtype: numpy.dtype
         """
         raise NotImplementedError
 
@@ -114,6 +116,22 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
+    def append_rows(self, key, rows, nested_name=None):
+        """
+        Appends a stack of data, as if each item along the first axis 
+        of *rows* were passed to :meth:`append` in turn. Subclasses may 
+        write the stack in fewer operations.
+
+        :param key: name of the dataset/group to append to
+        :type key: str
+        :param rows: data to add to file, one item per append
+        :type rows: numpy.ndarray
+        :param nested_name: See :meth:`append`
+        :type nested_name: str
+        """
+        for row in rows:
+            self.append(key, row, nested_name)
+
     def insert(self, key, index, data):
         """
         Inserts data to index location. For 'finite' mode only. Does not 
@@ -227,6 +245,16 @@ class AcquisitionData(object):
         """
         raise NotImplementedError
 
+    def refresh(self, key=None):
+        """Picks up data written to the file since it was opened, if it is
+        being read while written by another process. Does nothing for
+        files that cannot be.
+
+        :param key: The name of the dataset to refresh, ``None`` refreshes the whole file
+        :type key: str
+        """
+        pass
+
 
 def increment(index, dims, data_shape):
     """Increments a given index according to the shape of the data added
@@ -0,0 +1,172 @@
+import logging
+import Queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class AsyncDataWriter(object):
+    """Writes to a data file on a thread of its own, so that the acquisition
+    thread does not wait on the disk.
+
+    Has the writing methods of :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`,
+    which queue the write and return immediately. Consecutive appends of
+    the same shape to the same dataset are taken off the queue together,
+    and written with one :meth:`append_rows<sparkle.data.acqdata.AcquisitionData.append_rows>`.
+    When the queue is full, writing blocks until there is room, so memory
+    use is bounded if the disk falls behind. Any other attribute, e.g.
+    :meth:`get_data`, waits for the queued writes to finish, then goes to
+    the data file, so the writer can stand in for the data file it wraps.
+    Other threads can read the data file itself while it is written; its
+    methods take turns with the writer thread.
+
+    An error on the writer thread is raised again from every later call to
+    the writer, including :meth:`stop`, so the acquisition using it ends.
+    The writes that were already queued are not made, and are counted as
+    dropped in :meth:`stats`.
+
+    :param datafile: data file to write to. Should not be used directly until :meth:`stop`
+    :type datafile: :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`
+    :param maxsize: most writes held in the queue
+    :type maxsize: int
+    :param max_batch: most appends to write together
+    :type max_batch: int
+    """
+    queued_methods = ['append', 'append_rows', 'append_trace_info', 'set_metadata',
+                      'insert', 'init_group', 'init_data', 'backup', 'trim',
+                      'consolidate', 'delete_group']
+    def __init__(self, datafile, maxsize=64, max_batch=32):
+        self.datafile = datafile
+        self.max_batch = max_batch
+        self._queue = Queue.Queue(maxsize)
+        # item taken off the queue while batching, not yet written
+        self._held = []
+        self._error = None
+        self._thread = None
+
+        self.nqueued = 0
+        self.nwrites = 0
+        self.ndropped = 0
+        self.max_depth = 0
+        self.blocked_time = 0.
+        self.total_latency = 0.
+        self.max_latency = 0.
+
+    def start(self):
+        """Starts the writer thread"""
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Finishes the queued writes, and ends the writer thread
+
+        :returns: the wrapped data file
+        """
+        if self._thread is not None:
+            self._put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
+        return self.datafile
+
+    def flush(self):
+        """Blocks until all queued writes are done"""
+        self._queue.join()
+        self._raise_error()
+
+    def __getattr__(self, name):
+        if name in self.queued_methods:
+            def queue_write(*args, **kwargs):
+                self._raise_error()
+                if name == 'append':
+                    # the caller may reuse the array
+                    args = (args[0], np.array(args[1])) + args[2:]
+                self._put((name, args, kwargs, time.time()))
+            return queue_write
+        self.flush()
+        return getattr(self.datafile, name)
+
+    def stats(self):
+        """Summary of the writes so far
+
+        :returns: dict -- writes queued, writes to the data file (after batching), writes dropped after an error, the deepest the queue got, seconds spent waiting for room in the queue, and mean and max seconds from queueing to written
+        """
+        if self.nqueued > 0:
+            mean_latency = self.total_latency/self.nqueued
+        else:
+            mean_latency = 0.
+        return {'queued': self.nqueued, 'writes': self.nwrites, 'dropped': self.ndropped,
+                'max_depth': self.max_depth, 'blocked_time': self.blocked_time,
+                'mean_latency': mean_latency, 'max_latency': self.max_latency}
+
+    def _put(self, item):
+        if self._queue.full():
+            t0 = time.time()
+            self._queue.put(item)
+            self.blocked_time += time.time() - t0
+        else:
+            self._queue.put(item)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _next(self):
+        if self._held:
+            return self._held.pop()
+        return self._queue.get()
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                self._queue.task_done()
+                return
+            items = [item]
+            name, args, kwargs, stamp = item
+            if name == 'append':
+                items.extend(self._gather_appends(item))
+            try:
+                if self._error is None:
+                    if len(items) > 1:
+                        rows = np.array([i[1][1] for i in items])
+                        self.datafile.append_rows(args[0], rows, *args[2:], **kwargs)
+                    else:
+                        getattr(self.datafile, name)(*args, **kwargs)
+                    self.nwrites += 1
+                else:
+                    self.ndropped += len(items)
+            except:
+                logger = logging.getLogger('main')
+                logger.exception("Error writing to data file")
+                self._error = sys.exc_info()
+            now = time.time()
+            for i in items:
+                latency = now - i[3]
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.nqueued += 1
+                self._queue.task_done()
+
+    def _gather_appends(self, first):
+        """Takes the appends to the same dataset as *first* waiting in the
+        queue, without waiting for more"""
+        name, args, kwargs, stamp = first
+        gathered = []
+        while len(gathered) < self.max_batch - 1:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None and item[0] == 'append' and item[1][0] == args[0] \
+                    and item[1][2:] == args[2:] and item[2] == kwargs \
+                    and item[1][1].shape == args[1].shape:
+                gathered.append(item)
+            else:
+                self._held.append(item)
+                break
+        return gathered
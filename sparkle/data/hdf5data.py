@@ -1,38 +1,146 @@
 import ctypes
+import functools
 import glob
 import json
 import logging
 import os
+import posixpath
+import re
 import socket
+import threading
 import time
 
 import h5py
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
 from sparkle.data.acqdata import AcquisitionData, increment
 from sparkle.tools.exceptions import DataIndexError, DisallowedFilemodeError, \
     OverwriteFileError, ReadOnlyError
 from sparkle.tools.util import convert2native, max_str_num, create_unique_path
 from sparkle.tools.doc_inherit import doc_inherit
 
+# trace info for a dataset is stored, one JSON string per trace, in a
+# dataset named after it with this suffix
+STIM_TABLE_SUFFIX = '_stim'
+# largest trace info also written to the dataset's 'stim' attribute, as
+# older versions read it from there; attributes are limited to 64kB
+MAX_STIM_ATTR = 60000
+# compression filters for datasets
+COMPRESSION_FILTERS = [None, 'gzip', 'lzf']
+# backups are journaled to files named after the data file with this suffix
+JOURNAL_NAME = '_autosave_journal'
+# largest backup journal (bytes) kept when a file is closed safely, see
+# HDF5Data.set_journal_limit
+JOURNAL_LIMIT = 512*2**20
+# how the space of deleted data is reclaimed when a file is closed: by
+# copying the file, on the closing thread or on a thread of its own, by
+# moving the data stored after the deleted data into its place, or not
+# until the sparkle-repack command is run
+REPACK_POLICIES = ['blocking', 'background', 'inplace', 'defer']
+# file attribute marking a file with deleted data to reclaim
+REPACK_ATTR = 'needs_repack'
+# how long a reader waits for the writer to go back into SWMR mode
+# when refreshing (seconds)
+SWMR_REOPEN_TIMEOUT = 2.
+# dataset through which a writer tells the readers following the file
+# whether it is in SWMR mode (1), or leaving it (0)
+SWMR_STATE = '.swmr_state'
+# how long a writer leaving SWMR mode waits for the readers following the
+# file to let go of it (seconds)
+SWMR_RELEASE_TIMEOUT = 5.
+
+
+def _synchronized(method):
+    """Runs *method* holding the file's lock, so that a writer thread and
+    the threads reading the file take turns with it"""
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+def _follows_writer(method):
+    """Has a reader following a file written in SWMR mode wait for the
+    writer to come back to SWMR mode, if it is leaving it, before *method*
+    reads the file"""
+    @functools.wraps(method)
+    def following(self, *args, **kwargs):
+        self._follow_writer()
+        return method(self, *args, **kwargs)
+    return following
+
 class HDF5Data(AcquisitionData):
-    def __init__(self, filename, user='unknown', filemode='w-'):
+    """Data file in HDF5 format. Takes the arguments of
+    :class:`AcquisitionData<sparkle.data.acqdata.AcquisitionData>`, and
+
+    :param swmr: Whether the file is read while written (HDF5 single writer, multiple reader mode). A writer keeps the file so that readers that are also *swmr* can follow the data as it is written, which needs files created so, and readable by HDF5 1.10 or later only. A reader picks up what has been written with :meth:`refresh`, and must keep reading or refreshing, or close the file, for the writer to create new datasets
+    :type swmr: bool
+    """
+    def __init__(self, filename, user='unknown', filemode='w-', swmr=False):
         super(HDF5Data, self).__init__(filename, user, filemode)
+        # held by each method that uses the file, as the file may be written
+        # on a writer thread and read on others, e.g. by data review
+        self.lock = threading.RLock()
+
+        # storage layout of new datasets, see set_layout
+        self.chunks = None
+        self.compression = None
+        self.compression_opts = None
+        self.shuffle = False
+
+        # changes since the last checkpoint of the backup journal
+        self._changed_data = set()
+        self._changed_attrs = set()
+        self._deleted = []
+        # see set_journal_limit
+        self.journal_limit = JOURNAL_LIMIT
+
+        # see set_repack_policy
+        self.repack_policy = 'blocking'
+        self.repack_progress = None
+        # lowest offset in the file of the data deleted while open
+        self._freed_offset = None
+
+        self.swmr = swmr
+        # whether the file is in SWMR mode, which lasts until it is closed
+        self._live = False
+        # attributes set in SWMR mode, (path, attrdict), set when it is left
+        self._held_metadata = []
+
+        # the file may still be being repacked from when it was last closed
+        wait_for_repack(filename)
 
         logger = logging.getLogger('main')
-        try:
-            # reload backup files, if present -- it means the program crashed
-            # If the data file is corrupted it may still load, but the previously
-            # gathered data could be inaccessible, so load from backup to be safe.
-            backup_dir, backup_filename, prev_backups = autosave_filenames(filename)
-            if len(prev_backups) > 0:
-                # reassemble data from pieces
-                self.hdf5 = recover_data_from_backup(filename, prev_backups)
-                logger.info('Recovered data file %s' % filename)
-            else:
-                self.hdf5 = h5py.File(filename, filemode)
-        except:
-            raise
+        # reload backup files, if the program crashed with the file open.
+        # If the data file is corrupted it may still load, but the previously
+        # gathered data could be inaccessible, so load from backup to be safe.
+        backup_dir, backup_filename, prev_backups = autosave_filenames(filename)
+        journal_valid = journal_is_valid(filename)
+        if needs_recovery(filename, prev_backups) and not (swmr and filemode == 'r'):
+            # reassemble data from pieces
+            self.hdf5 = recover_data_from_backup(filename, prev_backups)
+            logger.info('Recovered data file %s' % filename)
+            # the journal holds what is now in the file, unless the file was
+            # recovered from the backups of an older version
+            journal_valid = journal_is_used(prev_backups)
+            if filemode == 'r':
+                self.hdf5.close()
+                if journal_valid:
+                    end_journal(filename)
+                self.hdf5 = _open_file(filename, filemode, swmr)
+        else:
+            # a reader following a file being written does not recover it
+            self.hdf5 = _open_file(filename, filemode, swmr)
+
+        if swmr and filemode != 'r' and not _swmr_format(self.hdf5):
+            logger.warning('Data file %s was not created to be read while written' % filename)
+            self.swmr = False
 
         if filemode == 'w-':
             self.hdf5.attrs['date'] = time.strftime('%Y-%m-%d')
@@ -43,35 +151,167 @@ class HDF5Data(AcquisitionData):
 
             logger.info('Created data file %s' % filename)
         else:
-            # find highet numbered test.. tight coupling to acquisition classes
-            # print 'data file keys', self.hdf5.keys()
-            group_prefix = 'segment_'
-            dset_prefix = 'test_'
-            gnum = max_str_num(group_prefix, self.hdf5.keys())
-            if gnum > 0:
-                self.test_count = max_str_num(dset_prefix, self.hdf5[group_prefix + str(gnum)].keys())
-            else:
-                self.test_count = 0
+            self.test_count = self._count_tests()
+            # repacking was deferred, or did not finish, last time
+            self.needs_repack = REPACK_ATTR in self.hdf5.attrs
 
             logger.info('Opened data file %s' % filename)
 
         if filemode != 'r':
-            # immediately make a backup, even if no data data (save attributes)
-            copy_backup(self.hdf5)
+            # the journal already holds everything in the file if it was
+            # closed safely, otherwise start over, with a copy of everything
+            start_journal(self.hdf5, journal_valid)
+
+    def _count_tests(self):
+        # find highet numbered test.. tight coupling to acquisition classes
+        # print 'data file keys', self.hdf5.keys()
+        group_prefix = 'segment_'
+        dset_prefix = 'test_'
+        gnum = max_str_num(group_prefix, self.hdf5.keys())
+        if gnum > 0:
+            return max_str_num(dset_prefix, self.hdf5[group_prefix + str(gnum)].keys())
+        else:
+            return 0
+
+    def set_layout(self, chunks=None, compression=None, compression_opts=None, shuffle=False):
+        """Sets how new datasets are stored. Datasets already created keep
+        their layout. Does not apply to continuous recordings.
+
+        :param chunks: None to store datasets contiguously, 'write' to chunk them by the unit data is written in, e.g. (1, 1, channels, samples) for a protocol test, or a chunk shape to use for datasets of as many dimensions, others being chunked by the write unit
+        :type chunks: str or tuple
+        :param compression: compression filter, 'gzip' or 'lzf'. Datasets are chunked by the write unit if *chunks* is None
+        :type compression: str
+        :param compression_opts: option for the filter, for gzip the level, 0-9
+        :type compression_opts: int
+        :param shuffle: whether to shuffle the bytes of samples before compression, which usually helps it
+        :type shuffle: bool
+        """
+        if compression not in COMPRESSION_FILTERS:
+            raise ValueError("Unknown compression filter: {}".format(compression))
+        if chunks is not None and chunks != 'write' and not isinstance(chunks, tuple):
+            raise ValueError("Chunks must be None, 'write' or a shape: {}".format(chunks))
+        self.chunks = chunks
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+
+    def layout(self):
+        """The storage layout of new datasets
+
+        :returns: dict -- keyword arguments for :meth:`set_layout`
+        """
+        return {'chunks': self.chunks, 'compression': self.compression,
+                'compression_opts': self.compression_opts, 'shuffle': self.shuffle}
+
+    def set_repack_policy(self, policy, progress=None):
+        """Sets how the space of deleted data is reclaimed when the file is
+        closed. Deleting data leaves space in the file that HDF5 does not
+        reuse once the file is closed.
+
+        :param policy: 'blocking' to repack the file, by copying it, on :meth:`close`; 'background' to do so on a thread of its own, which :meth:`close` does not wait for; 'inplace' to move the data stored after the deleted data into its place before closing, which is cheaper, but may not reclaim all of the space; 'defer' to leave the file to be repacked by the sparkle-repack command
+        :type policy: str
+        :param progress: called as a copy repack goes, with the bytes of data copied and the total
+        :type progress: callable
+        """
+        if policy not in REPACK_POLICIES:
+            raise ValueError("Unknown repack policy: {}".format(policy))
+        self.repack_policy = policy
+        self.repack_progress = progress
+
+    def set_journal_limit(self, limit):
+        """Sets the largest the backup journal may be and still be kept
+        when the file is closed safely, so that it does not need to be
+        started over, with a copy of the entire file, when the file is next
+        opened. A larger journal is removed on closing.
+
+        :param limit: size of the journal's checkpoint files, in bytes. 0 to never keep the journal, None to always keep it
+        :type limit: int
+        """
+        if limit is not None and limit < 0:
+            raise ValueError("Journal limit must not be negative: {}".format(limit))
+        self.journal_limit = limit
+
+    def _layout_args(self, dims):
+        """Arguments to h5py create_dataset for the current layout, for a
+        dataset of shape *dims*"""
+        chunks = self.chunks
+        if chunks is None and (self.compression is not None or self.shuffle):
+            chunks = 'write'
+        if chunks is None:
+            return {}
+        if chunks == 'write' or len(chunks) != len(dims):
+            # one chunk per append: of (channels, samples), or of samples
+            # for 2 dimensional data
+            nwrite = 2 if len(dims) > 2 else 1
+            chunks = (1,)*(len(dims) - nwrite) + tuple(dims[len(dims)-nwrite:])
+        args = {'chunks': chunks, 'shuffle': self.shuffle}
+        if self.compression is not None:
+            args['compression'] = self.compression
+            args['compression_opts'] = self.compression_opts
+        return args
+
+    @_synchronized
+    def suspend(self):
+        """Closes the file, so that another process may open it to 
+        write to, until :meth:`resume`. Nothing may be read or written 
+        in between. The backup journal is brought up to date, and left
+        for the other process to carry on.
+        """
+        self._stop_live()
+        self.checkpoint()
+        self.hdf5.close()
+        end_journal(self.filename)
+
+        logger = logging.getLogger('main')
+        logger.debug('Suspended data file %s' % self.filename)
+
+    @_synchronized
+    def resume(self):
+        """Reopens the file after :meth:`suspend`, picking up whatever 
+        was written to it in the meantime"""
+        journal_valid = journal_is_valid(self.filename)
+        self.hdf5 = _open_file(self.filename, 'a', self.swmr)
+        self.test_count = self._count_tests()
+        # the other process may have left deleted data to reclaim
+        self.needs_repack = self.needs_repack or REPACK_ATTR in self.hdf5.attrs
+        start_journal(self.hdf5, journal_valid)
+
+        logger = logging.getLogger('main')
+        logger.debug('Resumed data file %s' % self.filename)
 
     @doc_inherit
+    @_synchronized
     def close(self):
         # bad hack!
         if 'closed' in self.hdf5.__repr__().lower():
             return
 
         fname = self.hdf5.filename
+        if self.filemode != 'r':
+            self._stop_live()
+            if SWMR_STATE in self.hdf5:
+                # no writer to follow anymore
+                del self.hdf5[SWMR_STATE]
 
         # if there was no data saved, just remove the file
         if len(self.hdf5.keys()) == 0:
             remove = True
         else:
             remove = False
+            if self.filemode != 'r':
+                self._changed_attrs.update(_write_stim_attrs(self.hdf5))
+                if self.needs_repack and self.repack_policy == 'inplace':
+                    # free space is forgotten once the file is closed, so only
+                    # what was deleted since it was opened can be reclaimed
+                    if self._freed_offset is not None:
+                        compact(self.hdf5, self._freed_offset)
+                    self.needs_repack = REPACK_ATTR in self.hdf5.attrs
+                elif self.needs_repack and REPACK_ATTR not in self.hdf5.attrs:
+                    # marked until the repack is done, in case it is interrupted
+                    self.hdf5.attrs[REPACK_ATTR] = True
+                    self._attrs_changed('')
+                self.checkpoint()
+        writable = self.filemode != 'r'
 
         self.hdf5.close()
 
@@ -80,20 +320,182 @@ class HDF5Data(AcquisitionData):
 
         if remove:
             os.remove(fname)
+            remove_backup(fname)
+        elif self.needs_repack and writable:
+            if self.repack_policy == 'blocking':
+                repack_file(fname, self.repack_progress)
+                # the journal still holds what was deleted, so start a new one
+                # next time, rather than keep it around
+                remove_backup(fname)
+            else:
+                self._close_journal(fname)
+                if self.repack_policy == 'background':
+                    repack_in_background(fname, self.repack_progress)
+                else:
+                    logger.info('Deferred repacking data file %s' % fname)
+        elif writable:
+            self._close_journal(fname)
+
+    def _close_journal(self, fname):
+        # now that data is closed and safe, the journal is kept as a copy
+        # of it, so it does not need to be copied again when reopened,
+        # unless it has grown so large that copying would be cheaper
+        size = journal_size(fname)
+        if self.journal_limit is not None and size > self.journal_limit:
+            remove_backup(fname)
+            logger = logging.getLogger('main')
+            logger.debug('Removed backup journal of %d bytes, over the limit of %d' % (size, self.journal_limit))
         else:
-            if self.needs_repack:
-                _repack(fname)
+            end_journal(fname)
+
+    @_synchronized
+    def refresh(self, key=None):
+        """Picks up what a writer in SWMR mode wrote to the file since it was
+        opened, or last refreshed. Only for files opened read-only, and
+        *swmr*; does nothing otherwise
 
-        # now that data is closed and safe, clean up backupfile
-        remove_backup(fname)
+        :param key: dataset to refresh the extent of, or None to reopen the file, to also pick up groups and datasets created since. The writer leaves SWMR mode while it creates them, and the file is reopened then too
+        :type key: str
+        """
+        if not self.swmr or self.filemode != 'r':
+            return
+        if key is not None and self.hdf5.id.valid and not self._writer_out():
+            self.hdf5[key].refresh()
+            return
+        self._reopen()
+
+    def _writer_out(self):
+        """Whether the writer of a file being followed is leaving SWMR mode,
+        so the file is about to change in ways readers cannot follow"""
+        if SWMR_STATE not in self.hdf5:
+            return False
+        state = self.hdf5[SWMR_STATE]
+        state.refresh()
+        return state[0] == 0
+
+    def _follow_writer(self):
+        """Reopens a file being followed if its writer is leaving SWMR mode,
+        or a reopen did not finish, once the writer is back"""
+        if not self.swmr or self.filemode != 'r':
+            return
+        if not self.hdf5.id.valid or self._writer_out():
+            self._reopen()
+
+    def _reopen(self):
+        """Reopens a file being followed, once its writer is in SWMR mode.
+        If it has not come back within *SWMR_REOPEN_TIMEOUT* seconds,
+        IOError is raised, and the file is reopened by the next read"""
+        # a file already open in this process is not read again when opened
+        # a second time, so the old handle is closed first
+        if self.hdf5.id.valid:
+            self.hdf5.close()
+        deadline = time.time() + SWMR_REOPEN_TIMEOUT
+        while True:
+            try:
+                self.hdf5 = _open_file(self.filename, 'r', True)
+                if not self._writer_out():
+                    break
+                self.hdf5.close()
+            except IOError:
+                # cannot be opened while out of SWMR mode
+                pass
+            if time.time() > deadline:
+                raise IOError("Writer of data file {} did not go back to SWMR mode within {} s".format(
+                              self.filename, SWMR_REOPEN_TIMEOUT))
+            time.sleep(0.05)
+        self.test_count = self._count_tests()
+
+    def _start_live(self):
+        """Puts the file in SWMR mode, if it is *swmr*, before writing data,
+        so readers can follow it"""
+        if self.swmr and not self._live:
+            if SWMR_STATE not in self.hdf5:
+                self.hdf5.create_dataset(SWMR_STATE, (1,), dtype=np.int8)
+            self.hdf5[SWMR_STATE][0] = 1
+            self.hdf5.swmr_mode = True
+            self._live = True
+
+    def _stop_live(self):
+        """Takes the file out of SWMR mode, before creating or deleting
+        groups, datasets or attributes, which cannot be done in it. SWMR
+        mode lasts until the file is closed, so it is reopened. Readers
+        following the file are told first, so that they let go of it, and
+        wait for it to come back, rather than read it while it changes. If
+        they do not let go within *SWMR_RELEASE_TIMEOUT* seconds, IOError
+        is raised, and the file stays in SWMR mode"""
+        if not self._live:
+            return
+        self.hdf5[SWMR_STATE][0] = 0
+        self.hdf5.flush()
+        if not _wait_for_readers(self.filename, SWMR_RELEASE_TIMEOUT):
+            # the readers still have the file open, which would keep it
+            # from being opened again, so stay in SWMR mode
+            self.hdf5[SWMR_STATE][0] = 1
+            self.hdf5.flush()
+            raise IOError("Readers following data file {} did not let go of it within {} s, "
+                          "so it cannot leave SWMR mode".format(self.filename, SWMR_RELEASE_TIMEOUT))
+        self.hdf5.close()
+        self.hdf5 = _open_file(self.filename, 'a', True)
+        self._live = False
+        for path in self.datasets:
+            self.datasets[path] = self.hdf5[path]
+        held, self._held_metadata = self._held_metadata, []
+        for path, attrdict in held:
+            self._write_metadata(path, attrdict)
+
+    @_synchronized
+    def checkpoint(self):
+        """Saves the changes to the data since the last checkpoint to the
+        backup journal, from which the data can be recovered if the file is
+        corrupted. Only the datasets written to, and the attributes set,
+        since then, are saved. Attributes held back in SWMR mode are set
+        first, taking the file out of it.
+        """
+        if self._held_metadata:
+            self._stop_live()
+        if not (self._changed_data or self._changed_attrs or self._deleted):
+            return
+        write_checkpoint(self.hdf5, self._changed_data, self._changed_attrs, self._deleted)
+        self._changed_data = set()
+        self._changed_attrs = set()
+        self._deleted = []
+
+    def _data_changed(self, path):
+        self._changed_data.add(path.strip('/'))
+        if self._live:
+            # so readers see it. Flushing the dataset alone leaves out where
+            # the file ends, when the data was given new space
+            self.hdf5.flush()
+
+    def _attrs_changed(self, path):
+        self._changed_attrs.add(path.strip('/'))
+
+    def _freed(self, key):
+        """Notes where the data of *key*, about to be deleted, is stored,
+        for :func:`compact`"""
+        offset = _lowest_offset(self.hdf5[key])
+        if offset is not None and (self._freed_offset is None or offset < self._freed_offset):
+            self._freed_offset = offset
+
+    def _removed(self, path):
+        path = path.strip('/')
+        self._deleted.append(path)
+        # nothing under it needs saving anymore
+        for changed in [self._changed_data, self._changed_attrs]:
+            for changed_path in list(changed):
+                if changed_path == path or changed_path.startswith(path + '/'):
+                    changed.remove(changed_path)
 
     @doc_inherit
+    @_synchronized
     def init_group(self, key, mode='finite'):
         # regular error thrown for write attempt on read only not informative enough for me
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
+        self._stop_live()
         # self.groups[key] = self.hdf5.create_group(key)
         self.hdf5.create_group(key)
+        self._attrs_changed(key)
         self.meta[key] = {'mode': mode}
         if mode == 'calibration':
             self.set_metadata(key, {'start': time.strftime('%H:%M:%S'), 
@@ -103,25 +505,37 @@ class HDF5Data(AcquisitionData):
         logger.info('Created data group %s' % key)
 
     @doc_inherit
-    def init_data(self, key, dims=None, mode='finite', nested_name=None):
-        if self.hdf5.mode == 'r':
+    @_synchronized
+    def init_data(self, key, dims=None, mode='finite', nested_name=None, dtype=None):
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
+        self._stop_live()
+        if dtype is None:
+            # h5py default
+            dtype = np.float32
         if mode == 'calibration':
             if nested_name is None:
                 nested_name = 'signal'
             setname = nested_name
             setpath ='/'.join([key, setname])
-            self.hdf5[key].create_dataset(setname, dims)
+            self.hdf5[key].create_dataset(setname, dims, dtype=dtype, **self._layout_args(dims))
             self.meta[nested_name] = {'cursor':[0]*len(dims)}
             if nested_name == 'signal' or 'reference_tone':
                 self.set_metadata(setpath, {'stim': '[]'})
+        elif mode == 'finite' and nested_name is not None:
+            # a dataset to go along with the current test
+            setname = nested_name
+            setpath ='/'.join([key, setname])
+            self.hdf5[key].create_dataset(setname, dims, dtype=dtype, **self._layout_args(dims))
+            self.hdf5[setpath].attrs['data_of'] = key + '/test_' + str(self.test_count)
+            self.meta[setname] = {'cursor':[0]*len(dims)}
         elif mode == 'finite':
             self.test_count +=1
             setname = 'test_'+str(self.test_count)
             setpath ='/'.join([key, setname])
             if not key in self.hdf5:
                 self.init_group(key)
-            self.hdf5[key].create_dataset(setname, dims)
+            self.hdf5[key].create_dataset(setname, dims, dtype=dtype, **self._layout_args(dims))
             self.meta[setname] = {'cursor':[0]*len(dims)}
             self.set_metadata(setpath, {'start': time.strftime('%H:%M:%S'), 
                               'mode':mode, 'stim': '[]'})
@@ -130,29 +544,44 @@ class HDF5Data(AcquisitionData):
                 print "open acquisition only for single dimension data"
                 return
             setname = key
-            self.hdf5.create_dataset(setname, ((self.open_set_size,) + dims), maxshape=((None,) + dims))
+            self.hdf5.create_dataset(setname, ((self.open_set_size,) + dims), maxshape=((None,) + dims), dtype=dtype,
+                                     **self._layout_args((self.open_set_size,) + dims))
             self.meta[key] = {'mode':mode, 'cursor':0}
             setpath = key
             self.set_metadata(setpath, {'start': time.strftime('%H:%M:%S'), 
                               'mode':mode, 'stim': '[]'})
         elif mode == 'continuous':
-            self.datasets[key+'_set1'] = self.hdf5.create_dataset(key+'_set1', (self.chunk_size,))
+            self.datasets[key+'_set1'] = self.hdf5.create_dataset(key+'_set1', (self.chunk_size,), dtype=dtype)
             self.datasets[key+'_set1'].attrs['stim'] = ''
-            self.meta[key] = {'mode':mode, 'set_counter':1, 'cursor':0, 'start': time.strftime('%H:%M:%S')}
+            self.meta[key] = {'mode':mode, 'set_counter':1, 'cursor':0, 'start': time.strftime('%H:%M:%S'),
+                              'dtype': dtype}
             # create a dataset for the key itself, so to allow setting attributes, 
             # that will get copied after consolidation
             setname = key
             self.hdf5.create_dataset(key, (1,))
+            self._data_changed(key+'_set1')
         else:
             raise Exception("Unknown acquisition mode")
+        if mode in ['open', 'continuous']:
+            self._data_changed(key)
+        else:
+            self._data_changed(key + '/' + setname)
+        if self.swmr and (mode == 'calibration' or mode in ['finite', 'open'] and nested_name is None):
+            # trace info is added while the file is live, when the table for
+            # it cannot be created
+            self._data_changed(_stim_table(self.hdf5, setpath).name)
+        elif self.swmr and mode == 'continuous':
+            self._data_changed(_stim_table(self.hdf5, key+'_set1').name)
         
         logger = logging.getLogger('main')
         logger.info('Created data set %s' % setname)
 
     @doc_inherit
+    @_synchronized
     def append(self, key, data, nested_name=None):
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
+        self._start_live()
         # make sure data is numpy array
         data = np.array(data)
         mode = self.meta[key]['mode']
@@ -173,6 +602,7 @@ class HDF5Data(AcquisitionData):
             self.hdf5[key][setname][tuple(index)] = data[:]
             dims = self.hdf5[key][setname].shape
             increment(current_location, dims, data.shape)
+            self._data_changed(key + '/' + setname)
 
         elif mode =='open':
             current_index = self.meta[key]['cursor']
@@ -181,6 +611,7 @@ class HDF5Data(AcquisitionData):
             if current_index == self.hdf5[key].shape[0]:
                 self.hdf5[key].resize(current_index+self.open_set_size, axis=0)
             self.meta[key]['cursor'] = current_index
+            self._data_changed(key)
         elif mode =='continuous':
             # assumes size of data < chunk size
             setnum = self.meta[key]['set_counter']
@@ -195,33 +626,79 @@ class HDF5Data(AcquisitionData):
                     self.datasets[key+'_set'+str(setnum)][current_index:] = data[:nleft]
 
                 print 'starting new set'
+                self._data_changed(key+'_set'+str(setnum))
+                self._stop_live()
                 setnum +=1
                 current_index = 0
                 end_index = data[nleft:].size
-                self.datasets[key+'_set'+str(setnum)] = self.hdf5.create_dataset(key+'_set'+str(setnum), (self.chunk_size,))
+                self.datasets[key+'_set'+str(setnum)] = self.hdf5.create_dataset(key+'_set'+str(setnum), (self.chunk_size,), dtype=self.meta[key]['dtype'])
                 self.datasets[key+'_set'+str(setnum)][current_index:end_index] = data[nleft:]
                 self.datasets[key+'_set'+str(setnum)].attrs['stim'] = ''
+                if self.swmr:
+                    self._data_changed(_stim_table(self.hdf5, key+'_set'+str(setnum)).name)
 
             self.meta[key]['set_counter'] = setnum
             self.meta[key]['cursor'] = end_index
+            self._data_changed(key+'_set'+str(setnum))
+
+    @doc_inherit
+    @_synchronized
+    def append_rows(self, key, rows, nested_name=None):
+        if self.filemode == 'r':
+            raise ReadOnlyError(self.filename)
+        self._start_live()
+        rows = np.asarray(rows)
+        mode = self.meta[key]['mode']
+        if nested_name is None and mode == 'finite':
+            setname = 'test_'+str(self.test_count)
+        elif nested_name is not None:
+            setname = nested_name
+        else:
+            setname = 'signal'
+        if mode not in ['finite', 'calibration'] or rows.shape[1:] == (1,) \
+                or rows.ndim > len(self.hdf5[key][setname].shape):
+            return super(HDF5Data, self).append_rows(key, rows, nested_name)
+
+        dset = self.hdf5[key][setname]
+        dims = dset.shape
+        current_location = self.meta[setname]['cursor']
+        row_shape = rows.shape[1:]
+        irow = 0
+        while irow < rows.shape[0]:
+            index = current_location[:len(dims)-len(row_shape)]
+            # write as many rows as fit along the axis the rows step through
+            nrows = min(rows.shape[0] - irow, dims[len(index)-1] - index[-1])
+            if nrows <= 0:
+                # data set is full
+                raise DataIndexError()
+            dset[tuple(index[:-1]) + (slice(index[-1], index[-1]+nrows),)] = rows[irow:irow+nrows]
+            increment(current_location, dims, (nrows,) + row_shape)
+            irow += nrows
+        self._data_changed(key + '/' + setname)
 
     @doc_inherit
+    @_synchronized
     def insert(self, key, index, data):
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
+        self._start_live()
         mode = self.meta[key]['mode']
         if mode == 'finite':
             setname = 'test_'+str(self.test_count)
             # turn the index into a tuple so not to trigger advanced indexing
             index = tuple(index)
             self.hdf5[key][setname][index] = data[:]
+            self._data_changed(key + '/' + setname)
         else:
             print "insert not supported for mode: ", mode
 
+    @_synchronized
     def backup(self, key):
-        backup(self.hdf5, key)
+        self.checkpoint()
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def get_data(self, key, index=None):
         if not hasattr(self.hdf5[key], 'shape'):
             return None
@@ -233,28 +710,48 @@ class HDF5Data(AcquisitionData):
         return data
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def get_info(self, key, inherited=False):
         if key == '':
-            return dict(self.hdf5.attrs.items())
+            attrs = dict(self.hdf5.attrs.items())
+            attrs.update(self._held_info(key))
+            return attrs
         else:
             attrs = dict(self.hdf5[key].attrs.items())
+            attrs.update(self._held_info(key))
             if inherited and hasparent(key):
                 attrs.update(self.get_info('/'.join(key.split('/')[:-1]), True))
                 return attrs
             else:
                 return attrs
 
+    def _held_info(self, key):
+        """Attributes of *key* set in SWMR mode, not yet in the file"""
+        attrs = {}
+        for path, attrdict in self._held_metadata:
+            if path == key.strip('/'):
+                attrs.update(attrdict)
+        return attrs
+
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def get_trace_stim(self, key):
-        if key in self.hdf5 and 'stim' in self.hdf5[key].attrs:
+        if key + STIM_TABLE_SUFFIX in self.hdf5:
+            return [json.loads(doc) for doc in self.hdf5[key + STIM_TABLE_SUFFIX][:]]
+        elif key in self.hdf5 and 'stim' in self.hdf5[key].attrs:
+            # written before trace info tables
             return json.loads(self.hdf5[key].attrs['stim'])
         else:
             return None
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def get_calibration(self, key, reffreq):
         cal_vector = self.hdf5[key]['calibration_intensities'].value
-        stim_info = json.loads(self.hdf5[key+'/signal'].attrs['stim'])
+        stim_info = self.get_trace_stim(key+'/signal')
         fs = stim_info[0]['samplerate_da']
         npts = len(cal_vector)
         frequencies = np.arange(npts)/(float((npts-1)*2)/fs)
@@ -268,6 +765,8 @@ class HDF5Data(AcquisitionData):
         return (cal_vector, frequencies)
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def calibration_list(self):
         cal_names = []
         for grpky in self.hdf5.keys():
@@ -275,6 +774,7 @@ class HDF5Data(AcquisitionData):
                 cal_names.append(grpky)
         return cal_names
 
+    @_synchronized
     def trim(self, key):
         """
         Removes empty rows from dataset... I am still wanting to use this???
@@ -282,9 +782,12 @@ class HDF5Data(AcquisitionData):
         :param key: the dataset to trim
         :type key: str
         """
+        self._start_live()
         current_index = self.meta[key]['cursor']
         self.hdf5[key].resize(current_index, axis=0)
+        self._data_changed(key)
 
+    @_synchronized
     def consolidate(self, key):
         """
         Collapses a 'continuous' acquisition into a single dataset.
@@ -297,6 +800,7 @@ class HDF5Data(AcquisitionData):
         if self.meta[key]['mode'] not in ['continuous']:
             print "consolidation not supported for mode: ", self.meta[key]['mode']
             return
+        self._stop_live()
 
         # get a copy of the attributes saved, then delete placeholder
         attr_tmp = self.hdf5[key].attrs.items()
@@ -306,105 +810,135 @@ class HDF5Data(AcquisitionData):
         setnum -= 1 # convert from 1-indexed to 0-indexed
         current_index = self.meta[key]['cursor']
         total_samples = (self.chunk_size * setnum) + current_index
-        self.datasets[key] = self.hdf5.create_dataset(key, (total_samples,))
-        self.datasets[key].attrs['stim'] = '[ ' # space in case empty, closing replaces the space and not the [
+        self.datasets[key] = self.hdf5.create_dataset(key, (total_samples,), dtype=self.datasets[key+'_set1'].dtype)
         self.datasets[key].attrs['start'] = self.meta[key]['start']
         self.datasets[key].attrs['mode'] = 'continuous'
 
         for iset in range(0, setnum):
             self.datasets[key][iset*self.chunk_size:(iset+1)*self.chunk_size] = self.datasets[key+'_set'+str(iset+1)][:]
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + self.datasets[key+'_set'+str(iset+1)].attrs['stim']
         
         # last set may not be complete
         if current_index != 0:
             self.datasets[key][setnum*self.chunk_size:(setnum*self.chunk_size)+current_index] = self.datasets[key+'_set'+str(setnum+1)][:current_index]
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + self.datasets[key+'_set'+str(setnum+1)].attrs['stim']
 
-        # make sure we have a closing bracket
-        if self.datasets[key].attrs['stim'][-1] != ']':
-            self.datasets[key].attrs['stim'] = self.datasets[key].attrs['stim'] + ']'
-        
         # copy back attributes from placeholder
         for k, v in attr_tmp:
             self.datasets[key].attrs[k] = v
+        self.datasets[key].attrs['stim'] = '[]'
+
+        # gather the trace info of all the sets
+        for iset in range(setnum+1):
+            set_table = key+'_set'+str(iset+1)+STIM_TABLE_SUFFIX
+            if set_table in self.hdf5:
+                for doc in self.hdf5[set_table][:]:
+                    self._data_changed(_append_stim(self.hdf5, key, doc))
+        self._data_changed(key)
 
         # now go ahead and delete fractional sets.
         for iset in range(setnum+1):
+            self._freed(key+'_set'+str(iset+1))
             del self.datasets[key+'_set'+str(iset+1)]
             del self.hdf5[key+'_set'+str(iset+1)]
+            self._removed(key+'_set'+str(iset+1))
+            if key+'_set'+str(iset+1)+STIM_TABLE_SUFFIX in self.hdf5:
+                del self.hdf5[key+'_set'+str(iset+1)+STIM_TABLE_SUFFIX]
+                self._removed(key+'_set'+str(iset+1)+STIM_TABLE_SUFFIX)
 
-        print 'consolidated', self.hdf5.keys()
-        print 'stim attr', self.datasets[key].attrs['stim']
-        print
+        logger = logging.getLogger('main')
+        logger.debug('Consolidated data set %s' % key)
         self.needs_repack = True
 
     @doc_inherit
+    @_synchronized
     def delete_group(self, key):
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
+        self._stop_live()
+        self._freed(key)
         del self.hdf5[key]
+        self._removed(key)
         self.needs_repack = True
 
         logger = logging.getLogger('main')
         logger.info('Deleted data group %s' % key)
 
     @doc_inherit
+    @_synchronized
     def set_metadata(self, key, attrdict, signal=False):
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
         # key is an iterable of group keys (str), with the last
         # string being the attribute name
         if key == '':
-             for attr, val in attrdict.iteritems():
-                self.hdf5.attrs[attr] = val
+            path = key
         else:
-            for attr, val in attrdict.iteritems():
-                if val is None:
-                    val = '' # can't save None attribute value to HDF5
-                if signal:
-                    mode = self.meta[key]['mode']
-                    if mode == 'finite':
-                        setname = key + '/' + 'test_'+str(self.test_count)
-                    elif mode == 'calibration':
-                        setname = key + '/signal'
-                    self.hdf5[setname].attrs[attr] = val
-                else:
-                    self.hdf5[key].attrs[attr] = val
+            attrdict = dict([(attr, '' if val is None else val) for attr, val in attrdict.iteritems()])
+            if signal:
+                mode = self.meta[key]['mode']
+                if mode == 'finite':
+                    path = key + '/' + 'test_'+str(self.test_count)
+                elif mode == 'calibration':
+                    path = key + '/signal'
+            else:
+                path = key
+        if self._live:
+            # attributes cannot be set in SWMR mode, so they are held until
+            # the file leaves it, for the next test or the end of the run
+            self._held_metadata.append((path, dict(attrdict)))
+        else:
+            self._write_metadata(path, attrdict)
+
+    def _write_metadata(self, path, attrdict):
+        if path == '':
+            attrs = self.hdf5.attrs
+        else:
+            attrs = self.hdf5[path].attrs
+        for attr, val in attrdict.iteritems():
+            attrs[attr] = val
+        self._attrs_changed(path)
 
     @doc_inherit
+    @_synchronized
     def append_trace_info(self, key, stim_data):
-        if self.hdf5.mode == 'r':
+        if self.filemode == 'r':
             raise ReadOnlyError(self.filename)
         # append data to json list?
         if not isinstance(stim_data, basestring):
             stim_data = json.dumps(convert2native(stim_data))
         mode = self.meta[key]['mode']
         if mode == 'open':
-            _append_stim(self.hdf5, key, stim_data)
-        if mode == 'finite':
+            setname = key
+        elif mode == 'finite':
             setname = key + '/' + 'test_'+str(self.test_count)
-            _append_stim(self.hdf5, setname, stim_data)
         elif mode =='continuous':
             setnum = self.meta[key]['set_counter']
             setname = key+'_set'+str(setnum)
-            _append_stim(self.hdf5, setname, stim_data)
         elif mode == 'calibration':
             if 'Pure Tone' in stim_data:
                 setname =  key + '/' + 'reference_tone'
             else:
                 setname = key + '/' + 'signal'
-            _append_stim(self.hdf5, setname, stim_data)
+        if setname + STIM_TABLE_SUFFIX in self.hdf5:
+            self._start_live()
+        else:
+            # the table is created with the first addition
+            self._stop_live()
+        self._data_changed(_append_stim(self.hdf5, setname, stim_data))
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def keys(self, key=None):
         if key is None or key == self.filename or key == '':
-            return self.hdf5.keys()
+            return [name for name in self.hdf5.keys() if name != SWMR_STATE]
         elif key in self.hdf5 and hasattr(self.hdf5[key], 'keys'):
             return self.hdf5[key].keys()
         else:
             return None
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def all_datasets(self):
         self._dsets = []
         self.hdf5.visititems(self._gather_datasets)
@@ -413,6 +947,8 @@ class HDF5Data(AcquisitionData):
         return self._dsets
 
     @doc_inherit
+    @_synchronized
+    @_follows_writer
     def dataset_names(self):
         self._dset_names = []
         self.hdf5.visititems(self._gather_names)
@@ -421,11 +957,13 @@ class HDF5Data(AcquisitionData):
         return self._dset_names
 
     def _gather_datasets(self, name, item):
-        if hasattr(item, 'shape'):
+        # trace info tables, and data to go along with a test, belong to
+        # their datasets
+        if hasattr(item, 'shape') and not _belongs_to_dataset(item) and name != SWMR_STATE:
             self._dsets.append(item)
 
     def _gather_names(self, name, item):
-        if hasattr(item, 'shape'):
+        if hasattr(item, 'shape') and not _belongs_to_dataset(item) and name != SWMR_STATE:
             self._dset_names.append(name)
 
     def _repr_html_(self):
@@ -447,30 +985,6 @@ def hasparent(key):
         path.remove('')
     return len(path) > 1
 
-def copy_backup(h5file):
-    # assemble backup file filename
-    backup_dir, backup_filename, prev_backups = autosave_filenames(h5file.filename)
-    logger = logging.getLogger('main')
-    logger.debug('Backing up data: %s' % backup_filename)
-    
-    # open a new hdf5 file for backup
-    backup_file = h5py.File(backup_filename, 'w')
-
-    # copy the contents of main data file to the backup
-    for group in h5file.keys():
-        h5file.copy(group, backup_file)
-    # copy the file attributes
-    for attr in h5file.attrs:
-        backup_file.attrs[attr] = h5file.attrs[attr]
-
-    # importantly, close the file, so it is safe from corruption
-    backup_file.close()
-    
-    logger.debug('Backup safe %s' % backup_filename)        
-    #  whole file is backed up, so delete any previous backups to free up space
-    for prevf in prev_backups:
-        os.remove(prevf)
-
 def autosave_filenames(data_file_name):
     parent_dir, filename = os.path.split(data_file_name)
     backup_dir = os.path.join(parent_dir, '.backup')
@@ -489,22 +1003,195 @@ def autosave_filenames(data_file_name):
 
     return backup_dir, backup_filename, prev_backup_files  
 
-def backup(from_h5file, dataset_key):
-    backup_dir, backup_filename, prevs = autosave_filenames(from_h5file.filename)
+def journal_filenames(data_file_name):
+    """Files of the backup journal of a data file
+
+    :returns: (str, list<str>) -- the journal's state file, and its checkpoint files, oldest first
+    """
+    backup_dir, backup_filename, prev_backups = autosave_filenames(data_file_name)
+    basefname, ext = os.path.splitext(os.path.basename(data_file_name))
+    state_filename = os.path.join(backup_dir, basefname + JOURNAL_NAME + '.json')
+    checkpoints = [fname for number, fname in _checkpoint_files(data_file_name, prev_backups)]
+    return state_filename, checkpoints
+
+def journal_size(data_file_name):
+    """Total size of the checkpoint files of the backup journal of a data
+    file, in bytes"""
+    return sum([os.path.getsize(fname) for fname in journal_filenames(data_file_name)[1]])
+
+def _checkpoint_files(data_file_name, backup_files):
+    """Numbers and names of the checkpoint files among *backup_files*, in order"""
+    basefname, ext = os.path.splitext(os.path.basename(data_file_name))
+    pattern = re.compile(re.escape(basefname + JOURNAL_NAME) + r'_(\d+)' + re.escape(ext) + '$')
+    numbered = []
+    for fname in backup_files:
+        match = pattern.match(os.path.basename(fname))
+        if match is not None:
+            numbered.append((int(match.group(1)), fname))
+    return sorted(numbered)
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime]
+
+def _read_journal_state(data_file_name):
+    state_filename, checkpoints = journal_filenames(data_file_name)
+    if not os.path.isfile(state_filename):
+        return None
+    with open(state_filename, 'r') as state_file:
+        return json.load(state_file)
+
+def _write_journal_state(data_file_name, state):
+    state_filename, checkpoints = journal_filenames(data_file_name)
+    # write the new state beside the old, so there is always a whole one
+    with open(state_filename + 'tmp', 'w') as state_file:
+        json.dump(state, state_file)
+    if os.name == 'nt' and os.path.isfile(state_filename):
+        os.remove(state_filename)
+    os.rename(state_filename + 'tmp', state_filename)
+
+def journal_is_valid(data_file_name):
+    """Whether the backup journal of a data file holds everything in it:
+    the file was closed safely, and has not changed since"""
+    state = _read_journal_state(data_file_name)
+    return state is not None and not state['open'] and os.path.isfile(data_file_name) \
+        and state['stamp'] == _file_stamp(data_file_name) \
+        and len(journal_filenames(data_file_name)[1]) > 0
+
+def journal_is_used(backup_files):
+    """Whether *backup_files* are all of a backup journal, rather than
+    backups made by older versions"""
+    return all([JOURNAL_NAME in os.path.basename(fname) for fname in backup_files])
+
+def needs_recovery(data_file_name, backup_files):
+    """Whether a data file was left open when the program ended, so may be
+    corrupted, and should be recovered from *backup_files*"""
+    if not os.path.isfile(data_file_name) or len(backup_files) == 0:
+        return False
+    if not journal_is_used(backup_files):
+        # older versions removed their backups when the file was closed
+        return True
+    state = _read_journal_state(data_file_name)
+    return state is not None and state['open']
+
+def start_journal(h5file, journal_valid):
+    """Marks the backup journal of *h5file* as in use. Unless
+    *journal_valid*, it is started over with a copy of everything in the file"""
+    filename = h5file.filename
+    if not journal_valid:
+        remove_backup(filename)
+        datasets = []
+        groups = []
+        def gather(name, item):
+            if isinstance(item, h5py.Dataset):
+                datasets.append(name)
+            else:
+                groups.append(name)
+        h5file.visititems(gather)
+        write_checkpoint(h5file, datasets, groups, [])
+    _write_journal_state(filename, {'open': True})
+
+def end_journal(data_file_name):
+    """Marks the backup journal as holding everything in a data file, which
+    has been closed"""
+    _write_journal_state(data_file_name, {'open': False, 'stamp': _file_stamp(data_file_name)})
+
+def write_checkpoint(h5file, datasets, attr_paths, deleted):
+    """Adds a checkpoint to the backup journal of *h5file*
+
+    :param h5file: open data file
+    :type h5file: h5py.File
+    :param datasets: paths of the datasets to copy
+    :type datasets: list<str>
+    :param attr_paths: paths of the groups or datasets to copy the attributes of. The file attributes are always copied
+    :type attr_paths: list<str>
+    :param deleted: paths of the groups or datasets deleted since the last checkpoint, in order
+    :type deleted: list<str>
+    """
+    backup_dir, backup_filename, prev_backups = autosave_filenames(h5file.filename)
+    checkpoints = _checkpoint_files(h5file.filename, prev_backups)
+    if len(checkpoints) > 0:
+        number = checkpoints[-1][0] + 1
+    else:
+        number = 0
+    basefname, ext = os.path.splitext(os.path.basename(h5file.filename))
+    checkpoint_filename = os.path.join(backup_dir, '{}{}_{:05d}{}'.format(basefname, JOURNAL_NAME, number, ext))
     logger = logging.getLogger('main')
-    logger.debug('Backing up data: %s, data set: %s' % (backup_filename, dataset_key))
-    backup_file = h5py.File(backup_filename, 'w')
-    from_h5file.copy(dataset_key, backup_file, dataset_key)
-    
-    # copy over any group attrs
-    dataset_path = dataset_key.split('/')
-    current_path = ''
-    for parent in dataset_path[:-1]:
-        current_path += '/' + parent
-        for attr in from_h5file[current_path].attrs:
-            backup_file[current_path].attrs[attr] = from_h5file[current_path].attrs[attr]
-    
-    backup_file.close()
+    logger.debug('Backing up data: %s, %d data sets' % (checkpoint_filename, len(datasets)))
+
+    # written under another name until it is complete, so a checkpoint
+    # cut short is never replayed
+    checkpoint = h5py.File(checkpoint_filename + 'tmp', 'w')
+    for attr in h5file.attrs:
+        checkpoint.attrs[attr] = h5file.attrs[attr]
+    for path in sorted(datasets):
+        if path not in h5file:
+            continue
+        parent = _copy_parents(h5file, checkpoint, path)
+        h5file.copy(path, parent, posixpath.basename(path))
+    journal = checkpoint.create_group('.journal')
+    journal.attrs['deleted'] = json.dumps(list(deleted))
+    records = journal.create_group('attrs')
+    attr_records = []
+    for path in sorted(attr_paths):
+        if path == '' or path in datasets or path not in h5file:
+            continue
+        record = records.create_group(str(len(attr_records)))
+        for attr in h5file[path].attrs:
+            record.attrs[attr] = h5file[path].attrs[attr]
+        attr_records.append((path, isinstance(h5file[path], h5py.Group)))
+    journal.attrs['attr_paths'] = json.dumps(attr_records)
+
+    # importantly, close the file, so it is safe from corruption
+    checkpoint.close()
+    os.rename(checkpoint_filename + 'tmp', checkpoint_filename)
+    logger.debug('Backup safe %s' % checkpoint_filename)
+
+def _copy_parents(from_file, to_file, path):
+    """Creates the groups above *path* in *to_file*, with their attributes
+
+    :returns: the parent group of *path* in *to_file*
+    """
+    parent = posixpath.dirname(path)
+    if parent == '':
+        return to_file['/']
+    group = to_file.require_group(parent)
+    for attr in from_file[parent].attrs:
+        group.attrs[attr] = from_file[parent].attrs[attr]
+    return group
+
+def replay_checkpoint(checkpoint, to_file):
+    """Applies a checkpoint of the backup journal to *to_file*
+
+    :param checkpoint: checkpoint file of a backup journal
+    :type checkpoint: h5py.File
+    :param to_file: file to recover into
+    :type to_file: h5py.File
+    """
+    journal = checkpoint['.journal']
+    for path in json.loads(journal.attrs['deleted']):
+        if path in to_file:
+            del to_file[path]
+    datasets = []
+    def gather_datasets(name, item):
+        if isinstance(item, h5py.Dataset) and not name.startswith('.journal'):
+            datasets.append(name)
+    checkpoint.visititems(gather_datasets)
+    for path in datasets:
+        if path in to_file:
+            del to_file[path]
+        parent = _copy_parents(checkpoint, to_file, path)
+        checkpoint.copy(path, parent, posixpath.basename(path))
+    for index, (path, is_group) in enumerate(json.loads(journal.attrs['attr_paths'])):
+        if is_group:
+            to_file.require_group(path)
+        elif path not in to_file:
+            continue
+        record = journal['attrs'][str(index)]
+        for attr in record.attrs:
+            to_file[path].attrs[attr] = record.attrs[attr]
+    for attr in checkpoint.attrs:
+        to_file.attrs[attr] = checkpoint.attrs[attr]
 
 def remove_backup(filename):
     backup_dir, xx, backup_files = autosave_filenames(filename)
@@ -520,7 +1207,11 @@ def remove_backup(filename):
 
 def recover_data_from_backup(filename, backup_files):
     new_data = h5py.File(filename+'tmp', 'w-')
+    logger = logging.getLogger('main')
     for backup_fname in backup_files:
+        if JOURNAL_NAME in os.path.basename(backup_fname):
+            continue
+        # backups made by older versions
         backup = h5py.File(backup_fname, 'r')
         for key in backup.keys():
             # copy with overwrite or ignore existing doesn't exist,
@@ -531,6 +1222,15 @@ def recover_data_from_backup(filename, backup_files):
         for attr in backup.attrs:
             new_data.attrs[attr] = backup.attrs[attr]
         backup.close()
+    for number, checkpoint_fname in _checkpoint_files(filename, backup_files):
+        try:
+            checkpoint = h5py.File(checkpoint_fname, 'r')
+        except IOError:
+            logger.warning('Could not read backup %s, skipping' % checkpoint_fname)
+            continue
+        replay_checkpoint(checkpoint, new_data)
+        checkpoint.close()
+        logger.debug('Replayed backup %s' % checkpoint_fname)
 
     # close this file, so we can change the name
     new_data.close()
@@ -559,71 +1259,320 @@ def copy_group(from_file, to_file, key):
                 copy_group(from_file, to_file, '/'.join([key,subkey]))
 
 def _append_stim(container, key, stim_data):
-    if container[key].attrs['stim'] == '[]':
-         # first addition
-        existing_stim = '['
-    elif container[key].attrs['stim'] == '':
-        existing_stim = ''
+    """Adds the JSON string *stim_data* to the trace info table for
+    dataset *key*, creating the table on the first addition"""
+    table = _stim_table(container, key)
+    ndocs = table.shape[0]
+    table.resize((ndocs+1,))
+    table[ndocs] = stim_data
+    return table.name
+
+def _belongs_to_dataset(item):
+    """Whether *item* is stored alongside another dataset, rather than
+    being a recording itself"""
+    return 'stim_of' in item.attrs or 'data_of' in item.attrs
+
+def _stim_table(container, key):
+    """The trace info table for dataset *key*, which is created if there
+    is none"""
+    table_key = key + STIM_TABLE_SUFFIX
+    if table_key in container:
+        table = container[table_key]
     else:
-        # removing closing bracket and add comma
-        existing_stim = container[key].attrs['stim'][:-1] + ','
-    container[key].attrs['stim'] = existing_stim + stim_data + ']'
-
-
-def _repack(h5file):
+        table = container.create_dataset(table_key, (0,), maxshape=(None,),
+                                         chunks=(64,), dtype=h5py.special_dtype(vlen=str))
+        table.attrs['stim_of'] = key
+        # carry over trace info written before there were tables
+        existing = container[key].attrs.get('stim', '')
+        if existing not in ['', '[]']:
+            docs = [json.dumps(doc) for doc in json.loads(existing)]
+            table.resize((len(docs),))
+            table[:] = docs
+    return table
+
+def _write_stim_attrs(h5file):
+    """Writes the trace info tables to the 'stim' attribute of the datasets
+    they belong to, where it fits, so older versions can read it
+
+    :returns: list<str> -- the datasets written to
     """
-    Repack archive to remove freespace.
-               
-    Returns
-    -------
-    file : h5py File or None
-        If the input is a h5py.File then a h5py File instance of the
-        repacked archive is returned. The input File instance will no longer
-        be useable. 
+    tables = []
+    def gather_tables(name, item):
+        if isinstance(item, h5py.Dataset) and 'stim_of' in item.attrs:
+            tables.append(item)
+    h5file.visititems(gather_tables)
+    written = []
+    for table in tables:
+        key = table.attrs['stim_of']
+        if key not in h5file:
+            continue
+        stim = '[' + ','.join(table[:]) + ']'
+        if len(stim) <= MAX_STIM_ATTR and h5file[key].attrs.get('stim') != stim:
+            h5file[key].attrs['stim'] = stim
+            written.append(key)
+    return written
+
+
+def _open_file(filename, filemode, swmr):
+    """Opens a data file with h5py, for SWMR if *swmr*"""
+    if not swmr:
+        return h5py.File(filename, filemode)
+    if filemode == 'r':
+        return h5py.File(filename, 'r', libver='latest', swmr=True)
+    deadline = time.time() + SWMR_RELEASE_TIMEOUT
+    while True:
+        try:
+            return h5py.File(filename, filemode, libver='latest')
+        except IOError:
+            # readers following the file lock it for a moment as they open it
+            if filemode != 'a' or time.time() > deadline:
+                raise
+            time.sleep(0.01)
+
+def _wait_for_readers(filename, timeout):
+    """Waits for the readers of *filename*, which lock it while they have it
+    open, to close it
+
+    :returns: bool -- whether they did within *timeout* seconds
     """
-    f1, opened = _openfile(h5file) 
-    filename1 = f1.filename
-    filename2 = filename1 + '_repack_tmp'
-    f2 = h5py.File(filename2, 'w')
-    for key in f1.keys():
-        # print 'copying', key
-        f1.copy(key, f2)
-    f1.close()
-    f2.close()
-    filename_tmp = filename1 + '_repack_rename_tmp'
-    os.rename(filename1, filename_tmp)
-    os.rename(filename2, filename1) 
-    if opened:
-        f = None  
+    if fcntl is None:
+        # the lock cannot be checked on Windows, where opening the file
+        # again waits for the readers instead
+        return True
+    deadline = time.time() + timeout
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                return True
+            except IOError:
+                if time.time() > deadline:
+                    return False
+                time.sleep(0.01)
+    finally:
+        os.close(fd)
+
+def _swmr_format(h5file):
+    """Whether an open file is of a format that can be read while written"""
+    # version of the superblock
+    return h5file.id.get_create_plist().get_version()[0] >= 3
+
+def _lowest_offset(item):
+    """Lowest offset in the file of the storage of a group or dataset,
+    or None if it has none"""
+    offsets = []
+    def gather(name, member):
+        if isinstance(member, h5py.Dataset):
+            offsets.append(_storage_offset(member))
+    if isinstance(item, h5py.Dataset):
+        gather(item.name, item)
     else:
-        f = h5py.File(filename1)
-    os.remove(filename_tmp)
-    return f   
-
-def _openfile(h5file):
+        item.visititems(gather)
+    if len(offsets) == 0:
+        return None
+    return min(offsets)
+
+def _storage_offset(dataset):
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # chunked, so spread out, use where its header is
+        offset = h5py.h5o.get_info(dataset.id).addr
+    return offset
+
+def compact(h5file, freed_offset):
+    """Moves the datasets stored after *freed_offset* in an open file down
+    into the space freed by deleted data, where they fit, so that the file
+    is shorter once closed. HDF5 only reuses space freed while the file is
+    open, so this must be done before closing the file the data was
+    deleted from.
+
+    Cheaper than :func:`repack_file`, as only the data after the freed
+    space is rewritten, but the space is only reclaimed as far as the
+    data fits in it.
+
+    :param h5file: open data file
+    :type h5file: h5py.File
+    :param freed_offset: lowest offset in the file of the deleted data
+    :type freed_offset: int
+    :returns: int -- the number of datasets moved
     """
-    Open an archive if input is a path.
-    
-    Parameters
-    ----------
-    h5file : str or h5py.File
-        Filename or h5py.File instance of the archive.
-        
-    Returns
-    ------- 
-    f : h5py.File
-        Returns a h5py.File instance.
-    opened : bool
-        True is `h5file` is a path; False if `h5file` is a h5py.File object.   
-    
+    datasets = []
+    def gather(name, item):
+        if isinstance(item, h5py.Dataset):
+            offset = _storage_offset(item)
+            if offset > freed_offset:
+                datasets.append((offset, name))
+    h5file.visititems(gather)
+    moved = 0
+    for offset, name in sorted(datasets):
+        size = h5file.id.get_filesize()
+        copy_name = name + '_compact_tmp'
+        h5file.copy(name, copy_name)
+        if h5file.id.get_filesize() > size:
+            # did not fit in the free space, moving it would only make the
+            # file bigger
+            del h5file[copy_name]
+            continue
+        del h5file[name]
+        h5file.move(copy_name, name)
+        moved += 1
+    logger = logging.getLogger('main')
+    logger.debug('Compacted data file %s, moved %d data sets' % (h5file.filename, moved))
+    return moved
+
+def repack_file(filename, progress=None, stop_event=None):
+    """Repacks a data file to reclaim the space of deleted data, by copying
+    it to a new file, which replaces it.
+
+    The copy is made an object at a time, and how far it got is recorded
+    in it, so a repack that was interrupted, or stopped, carries on from
+    where it was, if the file has not changed since. Before the copy
+    replaces the file, it is checked to hold the same objects, with data of
+    the same sizes; if not, it is made again from the start.
+
+    :param filename: data file to repack, which must not be open
+    :type filename: str
+    :param progress: called after each object is copied, with the bytes of data copied so far, and the total
+    :type progress: callable
+    :param stop_event: when set, the repack stops after the object being copied
+    :type stop_event: :py:class:`threading.Event`
+    :returns: bool -- whether the repack finished
+    :raises: IOError if the copy made again does not match the file either
     """
-    if isinstance(h5file, h5py.File):
-        f = h5file
-        opened = False
-    elif isinstance(h5file, basestring):
-        f = h5py.File(h5file)
-        opened = True
-    else:
-        msg = "h5file must be a h5py.File object or a string (path)."
-        raise TypeError, msg    
-    return f, opened                 
+    logger = logging.getLogger('main')
+    tmp_filename = filename + '_repack_tmp'
+    stamp = json.dumps(_file_stamp(filename))
+    source = h5py.File(filename, 'r')
+    items = []
+    source.visititems(lambda name, item: items.append((name, isinstance(item, h5py.Dataset))))
+    # parents sort before their members
+    items.sort()
+    sizes = [source[name].id.get_storage_size() if is_data else 0 for name, is_data in items]
+    total = sum(sizes)
+
+    restarted = False
+    while True:
+        copy = _open_repack_copy(tmp_filename, stamp, _swmr_format(source))
+        ncopied = int(copy.attrs['repack_copied'])
+        if ncopied > 0:
+            logger.info('Resuming repack of %s at %d of %d' % (filename, ncopied, len(items)))
+
+        for index in range(ncopied, len(items)):
+            if stop_event is not None and stop_event.is_set():
+                source.close()
+                copy.close()
+                logger.info('Stopped repack of %s at %d of %d' % (filename, index, len(items)))
+                return False
+            name, is_data = items[index]
+            parent = posixpath.dirname(name) or '/'
+            if parent not in copy:
+                # missing what it recorded as copied, so will not match
+                break
+            if name in copy:
+                # partly copied before an interruption
+                del copy[name]
+            if is_data:
+                source.copy(name, copy[parent], posixpath.basename(name))
+            else:
+                group = copy.create_group(name)
+                for attr in source[name].attrs:
+                    group.attrs[attr] = source[name].attrs[attr]
+            copy.attrs['repack_copied'] = index + 1
+            copy.flush()
+            if progress is not None:
+                progress(sum(sizes[:index+1]), total)
+
+        # the copy is only trusted to replace the file once it holds the
+        # same, whether it was resumed or not
+        if _repack_copy_matches(copy, items, sizes):
+            break
+        copy.close()
+        os.remove(tmp_filename)
+        if restarted:
+            source.close()
+            raise IOError("Repacked copy of data file {} does not match it".format(filename))
+        logger.warning('Repacked copy of %s does not match it, starting over' % filename)
+        restarted = True
+
+    for attr in source.attrs:
+        if attr != REPACK_ATTR:
+            copy.attrs[attr] = source.attrs[attr]
+    del copy.attrs['repack_source']
+    del copy.attrs['repack_copied']
+    source.close()
+    copy.close()
+    filename_tmp = filename + '_repack_rename_tmp'
+    os.rename(filename, filename_tmp)
+    os.rename(tmp_filename, filename)
+    os.remove(filename_tmp)
+    logger.info('Repacked data file %s' % filename)
+    return True
+
+def _open_repack_copy(tmp_filename, stamp, swmr_format):
+    """Opens the copy a repack makes of the file with *stamp*, to carry on
+    with, or starts a new one if there is none for the file as it is now"""
+    copy = None
+    if os.path.isfile(tmp_filename):
+        try:
+            copy = h5py.File(tmp_filename, 'a')
+        except IOError:
+            # cut short writing
+            pass
+        if copy is not None and copy.attrs.get('repack_source') != stamp:
+            copy.close()
+            copy = None
+        if copy is None:
+            os.remove(tmp_filename)
+    if copy is None:
+        if swmr_format:
+            # so it can still be read while written
+            copy = h5py.File(tmp_filename, 'w', libver='latest')
+        else:
+            copy = h5py.File(tmp_filename, 'w')
+        copy.attrs['repack_source'] = stamp
+        copy.attrs['repack_copied'] = 0
+    return copy
+
+def _repack_copy_matches(copy, items, sizes):
+    """Whether *copy* holds the objects *items* of the file it was copied
+    from, with datasets of the same storage *sizes*"""
+    copied = []
+    copy.visititems(lambda name, item: copied.append((name, isinstance(item, h5py.Dataset))))
+    if sorted(copied) != items:
+        return False
+    for (name, is_data), size in zip(items, sizes):
+        if is_data and copy[name].id.get_storage_size() != size:
+            return False
+    return True
+
+# repacks running on threads of their own, by file name
+_repack_threads = {}
+
+def repack_in_background(filename, progress=None):
+    """Repacks a data file, as :func:`repack_file`, on a thread of its own.
+    The program does not exit until the repack is done
+
+    :returns: :py:class:`threading.Thread` -- the repack thread
+    """
+    thread = threading.Thread(target=_background_repack, args=(filename, progress))
+    _repack_threads[os.path.abspath(filename)] = thread
+    thread.start()
+    return thread
+
+def _background_repack(filename, progress):
+    try:
+        repack_file(filename, progress)
+        # the journal still holds what was deleted
+        remove_backup(filename)
+    except:
+        logger = logging.getLogger('main')
+        logger.exception('Error repacking data file %s' % filename)
+
+def wait_for_repack(filename):
+    """Waits for a repack of *filename* on a thread of its own, if there
+    is one, to finish"""
+    thread = _repack_threads.pop(os.path.abspath(filename), None)
+    if thread is not None:
+        thread.join()
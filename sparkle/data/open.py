@@ -2,7 +2,7 @@ from sparkle.data.batlabdata import BatlabData
 from sparkle.data.hdf5data import HDF5Data
 
 
-def open_acqdata(filename, user='unknown', filemode='w-'):
+def open_acqdata(filename, user='unknown', filemode='w-', swmr=False):
     """Opens and returns the correct AcquisitionData object according to filename extention.
 
     Supported extentions:
@@ -20,9 +20,18 @@ def open_acqdata(filename, user='unknown', filemode='w-'):
 
         data = open('mouse666.raw', filemode='r')
         print data.dataset_names()
+
+    to follow a sparkle data file as it is recorded, if it is being written with *swmr*::
+
+        data = open_acqdata('myexperiment.hdf5', filemode='r', swmr=True)
+        # later on...
+        data.refresh()
+        print data.dataset_names()
+
+    *swmr* is only for sparkle data, see :class:`HDF5Data<sparkle.data.hdf5data.HDF5Data>`
     """
     if filename.lower().endswith((".hdf5", ".h5")):
-        return HDF5Data(filename, user, filemode)
+        return HDF5Data(filename, user, filemode, swmr)
     elif filename.lower().endswith((".pst", ".raw")):
         return BatlabData(filename, user, filemode)
     else:
@@ -0,0 +1,76 @@
+"""Repacks Sparkle data files, to reclaim the space of data deleted from
+them. Files closed with repacking deferred, or whose repack was cut short,
+are marked as needing it; a repack that was cut short carries on from
+where it was.
+
+Usage::
+
+    sparkle-repack [--all] path [path ...]
+
+where each path is a data file, or a folder of them.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import h5py
+
+from sparkle.data.hdf5data import REPACK_ATTR, autosave_filenames, needs_recovery, \
+    remove_backup, repack_file
+
+
+def needs_repacking(filename):
+    """Whether a data file is marked as having deleted data to reclaim"""
+    h5file = h5py.File(filename, 'r')
+    marked = REPACK_ATTR in h5file.attrs
+    h5file.close()
+    return marked
+
+def data_files(paths):
+    """Data files named by *paths*, of files or folders"""
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for ext in ['*.hdf5', '*.h5']:
+                filenames.extend(sorted(glob.glob(os.path.join(path, ext))))
+        else:
+            filenames.append(path)
+    return filenames
+
+def repack(filename, out=sys.stdout):
+    """Repacks a data file, writing its progress to *out*
+
+    :returns: bool -- whether the file was repacked
+    """
+    backup_dir, backup_filename, prev_backups = autosave_filenames(filename)
+    if needs_recovery(filename, prev_backups):
+        # open elsewhere, or left open by a crash
+        out.write('{}: in use, or needs recovering, skipped\n'.format(filename))
+        return False
+    def progress(copied, total):
+        if total > 0:
+            out.write('\r{}: {:.0f}%'.format(filename, 100.*copied/total))
+            out.flush()
+    size = os.path.getsize(filename)
+    repack_file(filename, progress)
+    remove_backup(filename)
+    out.write('\r{}: {:.1f}MB reclaimed\n'.format(filename, (size - os.path.getsize(filename))/1e6))
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reclaims the space of deleted data in Sparkle data files")
+    parser.add_argument('paths', nargs='+', help="data files, or folders of them")
+    parser.add_argument('--all', action='store_true',
+                        help="repack every file, not only those marked as needing it")
+    args = parser.parse_args(argv)
+
+    for filename in data_files(args.paths):
+        if not os.path.isfile(filename):
+            print '{}: no such file'.format(filename)
+        elif args.all or needs_repacking(filename):
+            repack(filename)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -828,57 +828,67 @@ class ScrollingWidget(BasePlot):
         self.scrollPlot = self.plot(pen=pencolor)
 
         self.disableAutoRange()
+        self._deltax = None
+        self._windowsize = None
+        self._ybuf = None
 
     def setSr(self, fs):
         self._deltax = (1/float(fs))
+        self._allocate()
 
     def setWindowSize(self, winsz):
         self._windowsize = winsz
         # set range here then?
         x0 = self.getPlotItem().viewRange()[0][0]
         self.setXlim((x0, x0+winsz))
+        self._allocate()
+
+    def _allocate(self):
+        """Preallocates the plotted points for one window of data, so that
+        appending does not create new arrays"""
+        if self._deltax is None or self._windowsize is None:
+            return
+        npts = int(round(self._windowsize/self._deltax)) + 1
+        self._xbuf = np.zeros(npts)
+        self._ybuf = np.zeros(npts)
+        # times of the first npts samples after time 0
+        self._ramp = np.arange(1, npts+1)*self._deltax
+        self._count = 0
+        self._nsamples = 0
 
     def clearData(self):
         self.scrollPlot.setData(None)
         self.setXlim((0, self._windowsize))
+        self._count = 0
+        self._nsamples = 0
 
     def appendData(self, data):
         npoints_to_add = len(data)
-        xdata, ydata = self.scrollPlot.getData()
-        if xdata is None:
-            last_time = 0
-            xdata = []
-            ydata = []
-        else:
-            last_time = xdata[-1]
-
-        # print 'last_time', last_time, 'deltax', self.deltax, 'npoints_to_add', npoints_to_add
-        # x_to_append = np.arange(last_time+self._deltax, 
-        #                         last_time+self._deltax+(self._deltax*npoints_to_add),
-        #                         self._deltax)
-        x_to_append = np.linspace(last_time+self._deltax, 
-                                  last_time+self._deltax+(self._deltax*npoints_to_add), 
-                                  npoints_to_add)
-        # print 'lens', len(x_to_append), len(data), len(stim), last_time, npoints_to_add
-        # assert len(x_to_append) == len(data)
-        # assert len(x_to_append) == len(stim)
-        # print 'deltax', x_to_append[1] - x_to_append[0], self._deltax
-        # assert (x_to_append[1] - x_to_append[0]) == self._deltax
-
-        xdata = np.append(xdata, x_to_append)
-        ydata = np.append(ydata, data) 
-
-        # remove data that has gone off screen
-        xlim = self.getPlotItem().viewRange()[0]
-        removex, = np.where(xdata < xlim[0])
-
-        xdata = np.delete(xdata, removex)
-        ydata = np.delete(ydata, removex)
+        capacity = len(self._ybuf)
+        # samples that would scroll straight off screen aren't stored
+        skipped = max(npoints_to_add - capacity, 0)
+        data = data[skipped:]
+        n = len(data)
+
+        # shift the points still on screen to the front, in place
+        keep = min(self._count, capacity - n)
+        if keep < self._count:
+            self._xbuf[:keep] = self._xbuf[self._count-keep:self._count]
+            self._ybuf[:keep] = self._ybuf[self._count-keep:self._count]
+
+        xdata = self._xbuf[keep:keep+n]
+        xdata[:] = self._ramp[:n]
+        xdata += (self._nsamples + skipped)*self._deltax
+        self._ybuf[keep:keep+n] = data
+        self._count = keep + n
+        self._nsamples += npoints_to_add
 
         # assuming that samplerates must be the same
-        self.scrollPlot.setData(xdata, ydata)
+        xdata = self._xbuf[:self._count]
+        self.scrollPlot.setData(xdata, self._ybuf[:self._count])
 
         # now scroll axis limits
+        xlim = self.getPlotItem().viewRange()[0]
         if xlim[1] < xdata[-1]:
             xlim[1] += self._deltax*npoints_to_add
             xlim[0] += self._deltax*npoints_to_add
@@ -1,8 +1,10 @@
+import logging
 import threading
-import time
 
 import numpy as np
 
+from sparkle.data.async_writer import AsyncDataWriter
+from sparkle.run.interval_scheduler import IntervalScheduler
 
 class AbstractAcquisitionRunner(object):
     """Holds state information for an experimental session"""
@@ -24,6 +26,17 @@ class AbstractAcquisitionRunner(object):
 
         self.binsz = 0.005
 
+        # paces the acquisitions during a run
+        self.scheduler = None
+        # seconds at the end of each interval to poll the clock, rather than sleep
+        self.spin_wait = 0.
+        # trigger reps from a device counter, rather than from software
+        self.hardware_clock = False
+        # write data from a thread of its own during runs
+        self.async_write = False
+        # most writes waiting for the data file, before acquisition waits
+        self.write_queue_depth = 64
+
         self.update_reference_voltage()
         self.set_calibration(None, None, None, None)
 
@@ -90,6 +103,20 @@ class AbstractAcquisitionRunner(object):
         :type reject: bool
         :param rejectrate: the value to base artifact rejection on
         :type rejectrate: float
+        :param stream_stim: whether to render each stimulus trace as it is presented, rather than expanding the whole test before starting. Keeps memory use down for tests with many or long traces. The next trace is rendered in the background while the current one is acquired
+        :type stream_stim: bool
+        :param batch_reps: whether to present all the repetitions of a trace in a single generation/acquisition, spaced by the device clock. Requires the interval to be at least as long as the stimulus and recording window, which is checked before the run starts. See :meth:`FinitePlayer.run_batch<sparkle.acq.players.FinitePlayer.run_batch>`
+        :type batch_reps: bool
+        :param spin_wait: whether to poll the clock for the last millisecond before each acquisition, instead of sleeping, for more precise timing
+        :type spin_wait: bool
+        :param persistent_tasks: whether to keep the device tasks between repetitions, only rewriting the output when the stimulus changes. See :meth:`FinitePlayer.set_persistent<sparkle.acq.players.FinitePlayer.set_persistent>`. Not used for continuous acquisition
+        :type persistent_tasks: bool
+        :param hardware_clock: whether to trigger the repetitions of a trace from a device counter at the interval rate, so that they are not delayed by software. The first repetition of each trace is still started from software. See :meth:`FinitePlayer.set_rep_clock<sparkle.acq.players.FinitePlayer.set_rep_clock>`
+        :type hardware_clock: bool
+        :param async_write: whether to write data to file on a separate thread during a run, so disk stalls don't delay acquisition. Off by default. See :class:`AsyncDataWriter<sparkle.data.async_writer.AsyncDataWriter>`
+        :type async_write: bool
+        :param write_queue_depth: most writes that may be waiting for the data file, when writing asynchronously. Acquisition waits once the queue is full
+        :type write_queue_depth: int
         """
         self.player_lock.acquire()
         if 'acqtime' in kwargs:
@@ -103,6 +130,8 @@ class AbstractAcquisitionRunner(object):
             self.aitimes = np.linspace(0, t, npoints)
         if 'trigger' in kwargs:
             self.player.set_trigger(kwargs['trigger'])
+        if 'persistent_tasks' in kwargs and hasattr(self.player, 'set_persistent'):
+            self.player.set_persistent(kwargs['persistent_tasks'])
         self.player_lock.release()
 
         if 'aochan' in kwargs:
@@ -133,6 +162,39 @@ class AbstractAcquisitionRunner(object):
             self.reject = kwargs['reject']
         if 'rejectrate' in kwargs:
             self.rejectrate = kwargs['rejectrate']
+        if 'stream_stim' in kwargs:
+            self.stream_stim = kwargs['stream_stim']
+        if 'spin_wait' in kwargs:
+            self.spin_wait = 0.001 if kwargs['spin_wait'] else 0.
+        if 'batch_reps' in kwargs:
+            self.batch_reps = kwargs['batch_reps']
+        if 'hardware_clock' in kwargs:
+            self.hardware_clock = kwargs['hardware_clock']
+        if 'async_write' in kwargs:
+            self.async_write = kwargs['async_write']
+        if 'write_queue_depth' in kwargs:
+            self.write_queue_depth = kwargs['write_queue_depth']
+
+    def settings(self):
+        """The current values of the parameters of :meth:`set`, other 
+        than the data file, e.g. to set up a copy of this runner
+
+        :returns: dict -- keyword arguments for :meth:`set`
+        """
+        settings = {'acqtime': self.player.get_aidur(), 'aifs': self.player.get_aifs(),
+                    'trigger': self.player.trigger_dest, 'binsz': self.binsz,
+                    'save': self.save_data, 'caldb': self.caldb, 'calv': self.calv,
+                    'calf': self.calf, 'reprate': self.reprate, 'average': self.average,
+                    'reject': self.reject, 'rejectrate': self.rejectrate,
+                    'spin_wait': self.spin_wait > 0, 'hardware_clock': self.hardware_clock,
+                    'async_write': self.async_write,
+                    'write_queue_depth': self.write_queue_depth}
+        for name in ['aochan', 'aichan', 'stream_stim', 'batch_reps']:
+            if hasattr(self, name):
+                settings[name] = getattr(self, name)
+        if hasattr(self.player, 'persistent'):
+            settings['persistent_tasks'] = self.player.persistent
+        return settings
 
     def run(self, interval, **kwargs):
         """Runs the acquisiton
@@ -147,23 +209,67 @@ class AbstractAcquisitionRunner(object):
         """Stop the current on-going generation/acquisition"""
         self._halt = True
 
+    def start_schedule(self, interval):
+        """Starts pacing acquisitions. The schedule begins at the first call
+        to :meth:`interval_wait`, which returns immediately
+
+        :param interval: time between the start of each acquisition (ms)
+        :type interval: float
+        """
+        self.scheduler = IntervalScheduler(interval/1000., spin=self.spin_wait)
+
     def interval_wait(self):
-        """Pauses the correct amount of time according to this 
-        acquisition object's interval setting, and the last time this 
-        function was called"""
-        # calculate time since last interation and wait to acheive desired interval
-        now = time.time()
-        elapsed = (now - self.last_tick)*1000
-        # print("interval %d, time from start %d \n" % (elapsed, (now - self.start_time)*1000))
-        if elapsed < self.interval:
-            # print('sleep ', (self.interval-elapsed))
-            # self.signals.warning.emit('') # clear previous warning
-            time.sleep((self.interval-elapsed)/1000)
-            now = time.time()
-        elif elapsed > self.interval:
-            pass
-            # self.signals.warning.emit("WARNING: PROVIDED INTERVAL EXCEEDED, ELAPSED TIME %d" % (elapsed))
-        self.last_tick = now
+        """Pauses until the start time of the next acquisition, according
+        to this acquisition object's interval setting. See
+        :class:`IntervalScheduler<sparkle.run.interval_scheduler.IntervalScheduler>`
+
+        :returns: float -- how late (seconds) the acquisition is starting
+        """
+        return self.scheduler.wait()
+
+    def report_timing(self):
+        """Sends the acquisition timing statistics for the run so far to listeners
+
+        :returns: dict -- see :meth:`IntervalScheduler.stats<sparkle.run.interval_scheduler.IntervalScheduler.stats>`
+        """
+        timing = self.scheduler.stats()
+        self.putnotify('timing_stats', (timing,))
+        return timing
+
+    def start_writer(self):
+        """Hands the data file to a writer thread for the duration of a
+        run, if saving data asynchronously. Until :meth:`stop_writer`,
+        :attr:`datafile` is the :class:`AsyncDataWriter<sparkle.data.async_writer.AsyncDataWriter>`"""
+        if self.async_write and self.save_data and self.datafile is not None \
+                and not isinstance(self.datafile, AsyncDataWriter):
+            self.datafile = AsyncDataWriter(self.datafile, self.write_queue_depth)
+            self.datafile.start()
+
+    def stop_writer(self):
+        """Finishes writing the data from the run, and reports the writer
+        statistics to listeners
+
+        :returns: dict -- see :meth:`AsyncDataWriter.stats<sparkle.data.async_writer.AsyncDataWriter.stats>`, None if not writing asynchronously
+        """
+        if not isinstance(self.datafile, AsyncDataWriter):
+            return None
+        writer = self.datafile
+        try:
+            writer.stop()
+        except:
+            logger = logging.getLogger('main')
+            logger.exception("Data file writer failed:")
+        finally:
+            self.datafile = writer.datafile
+        stats = writer.stats()
+        logger = logging.getLogger('main')
+        if stats['dropped'] > 0:
+            logger.error('Data file writer dropped {} writes after its error'.format(stats['dropped']))
+        logger.debug('Data writer: {queued} writes in {writes}, max queue depth {max_depth}, '
+                     'mean latency {mean_latency:.4f}s, max {max_latency:.4f}s, '
+                     'blocked {blocked_time:.4f}s'.format(**stats))
+        self.putnotify('writer_stats', (stats,))
+        return stats
 
     def putnotify(self, name, *args):
         """Puts data into queue and alerts listeners"""
@@ -1,12 +1,14 @@
 import logging
-import Queue
-import threading
 
+from sparkle.data.hdf5data import JOURNAL_LIMIT
 from sparkle.data.open import open_acqdata
 from sparkle.run.calibration_runner import CalibrationCurveRunner, \
     CalibrationRunner
 from sparkle.run.chart_runner import ChartRunner
 from sparkle.run.microphone_calibration_runner import MphoneCalibrationRunner
+from sparkle.run.notification_bus import ALL, LATEST, NotificationBus
+from sparkle.run.process_runner import ChartProcess, ProtocolProcess, \
+    SearchProcess
 from sparkle.run.protocol_runner import ProtocolRunner
 from sparkle.run.search_runner import SearchRunner
 from sparkle.stim.stimulus_model import StimulusModel
@@ -39,17 +41,11 @@ class AcquisitionManager():
                 'calibration_file_changed',
                 'tuning_curve_started',
                 'tuning_curve_response',
-                'over_voltage',]
-        signals = {}
-        recieved_signals = {}
-        for qname in queue_names:
-            q = Queue.Queue()
-            waker = threading.Event()
-            signals[qname] = (q, waker)
-            recieved_signals[qname] = (q, waker)
-        self.signals = signals
-        self.recieved_signals = recieved_signals
-        self.acquisition_hooks = {}
+                'over_voltage',
+                'timing_stats',
+                'writer_stats',]
+        self.notifications = NotificationBus(queue_names)
+        self.signals = self.notifications.topics()
 
         self.explorer = SearchRunner(self.signals)
         self.protocoler =  ProtocolRunner(self.signals)
@@ -64,42 +60,33 @@ class AcquisitionManager():
         self.selected_calibration_index = 0
         self.current_cellid = 0
 
-    def _qlisten(self):
-        # create listener threads for all acquisition hooks
-        self.queue_threads = []
-        for name, queue_waker in self.recieved_signals.items():
-            q, wake_event = queue_waker
-            if name in self.acquisition_hooks:
-                # print '{} hook established'.format(name)
-                t = threading.Thread(target=self._listen, args=(q, self.acquisition_hooks[name], wake_event))
-                t.daemon = True
-                self.queue_threads.append(t)
-
-    def _listen(self, q, func_list, wake_event):
-        while not self._halt_threads:
-            if not q.empty():
-                data = q.get()
-                for func in func_list:
-                    func(*data)
-            wake_event.clear()
-            wake_event.wait()
+        # storage layout of data files, see HDF5Data.set_layout
+        self.data_layout = {}
+        # repack data files with deleted data without holding up closing,
+        # see HDF5Data.set_repack_policy
+        self.repack_policy = 'background'
+        self.repack_progress = None
+        # see HDF5Data.set_journal_limit
+        self.journal_limit = JOURNAL_LIMIT
+        # write data files so they can be read while written, see HDF5Data
+        self.swmr = False
+
+        # run acquisition in a child process
+        self.acquisition_process = False
+        self._protocol_process = None
+        self._search_process = None
+        self._chart_process = None
 
     def start_listening(self):
-        """Start listener threads for acquistion callback queues"""
-        self._qlisten()
-        self._halt_threads = False
-        for t in self.queue_threads:
-            t.start()
+        """Start the thread that calls the acquisition callbacks"""
+        self.notifications.start()
 
     def stop_listening(self):
-        """Stop listener threads for acquistion queues"""
-        self._halt_threads = True
-        # wake them up so that they can die
-        for name, queue_waker in self.recieved_signals.items():
-            q, wake_event = queue_waker
-            wake_event.set()
-
-    def set_queue_callback(self, name, func):
+        """Stop calling the acquisition callbacks, after the ones for the
+        data already queued"""
+        self.notifications.stop()
+
+    def set_queue_callback(self, name, func, latest=False):
         """Sets a function to execute when the named acquistion queue 
         has data placed in it.
 
@@ -107,11 +94,20 @@ class AcquisitionManager():
         :type name: str
         :param func: function reference to execute, expects queue contents as argument(s)
         :type func: callable
+        :param latest: If True, only call *func* with the latest data, at most once per display frame, dropping data it falls behind on. Otherwise call it for everything placed in the queue
+        :type latest: bool
         """
-        if name in self.acquisition_hooks:
-            self.acquisition_hooks[name].append(func)
+        if latest:
+            self.notifications.subscribe(name, func, LATEST)
         else:
-            self.acquisition_hooks[name] = [func]
+            self.notifications.subscribe(name, func, ALL)
+
+    def notification_stats(self):
+        """Queue depth and latency of the acquisition callbacks so far
+
+        :returns: dict -- see :meth:`NotificationBus.stats<sparkle.run.notification_bus.NotificationBus.stats>`
+        """
+        return self.notifications.stats()
 
     def increment_cellid(self):
         """Increments the current cellid number that is saved for each test run"""
@@ -193,7 +189,12 @@ class AcquisitionManager():
         :type fname: str
         """
         self.close_data()
-        self.datafile = open_acqdata(fname, filemode=filemode)
+        self.datafile = open_acqdata(fname, filemode=filemode, swmr=self.swmr and filemode != 'r')
+        if self.data_layout and filemode != 'r':
+            self.datafile.set_layout(**self.data_layout)
+        if filemode != 'r':
+            self.datafile.set_repack_policy(self.repack_policy, self.repack_progress)
+            self.datafile.set_journal_limit(self.journal_limit)
 
         self.explorer.set(datafile=self.datafile)
         self.protocoler.set(datafile=self.datafile)
@@ -204,6 +205,44 @@ class AcquisitionManager():
 
         self.current_cellid = dict(self.datafile.get_info('')).get('total cells', 0)
 
+    def set_data_layout(self, **layout):
+        """Sets how datasets are stored in the data file, from the next
+        one created on. Takes the keyword arguments of
+        :meth:`HDF5Data.set_layout<sparkle.data.hdf5data.HDF5Data.set_layout>`
+        """
+        if self.datafile is not None and self.datafile.filemode != 'r':
+            self.datafile.set_layout(**layout)
+        self.data_layout = layout
+
+    def set_swmr(self, swmr):
+        """Sets whether data files are written so that other processes can
+        read them while they are written, from the next one opened on. See
+        :class:`HDF5Data<sparkle.data.hdf5data.HDF5Data>`
+
+        :param swmr: Whether to use HDF5 single writer, multiple reader mode
+        :type swmr: bool
+        """
+        self.swmr = swmr
+
+    def set_repack_policy(self, policy, progress=None):
+        """Sets how the space of deleted data is reclaimed when data files
+        are closed. Takes the arguments of
+        :meth:`HDF5Data.set_repack_policy<sparkle.data.hdf5data.HDF5Data.set_repack_policy>`
+        """
+        if self.datafile is not None and self.datafile.filemode != 'r':
+            self.datafile.set_repack_policy(policy, progress)
+        self.repack_policy = policy
+        self.repack_progress = progress
+
+    def set_journal_limit(self, limit):
+        """Sets the largest backup journal kept when data files are closed.
+        Takes the argument of
+        :meth:`HDF5Data.set_journal_limit<sparkle.data.hdf5data.HDF5Data.set_journal_limit>`
+        """
+        if self.datafile is not None and self.datafile.filemode != 'r':
+            self.datafile.set_journal_limit(limit)
+        self.journal_limit = limit
+
     def current_data_file(self):
         """Name of the currently employed data file
 
@@ -219,6 +258,8 @@ class AcquisitionManager():
         """
         self.explorer.set_threshold(threshold)
         self.protocoler.set_threshold(threshold)
+        for process in self._child_processes():
+            process.call('set_threshold', threshold)
 
     def set(self, **kwargs):
         """Sets acquisition parameters for all acquisition types
@@ -231,9 +272,18 @@ class AcquisitionManager():
         self.charter.set(**kwargs)
         self.bs_calibrator.set(**kwargs)
         self.mphone_calibrator.set(**kwargs)
+        # the child process keeps its own handle on the data file
+        child_kwargs = dict([(key, value) for key, value in kwargs.items() if key != 'datafile'])
+        if child_kwargs:
+            for process in self._child_processes():
+                process.call('set', **child_kwargs)
     
     def reset_explore_stim(self):
-        self.explorer.reset_stim()
+        """Presents the search stimulus, as edited, from the next acquisition on"""
+        if self._search_process is not None and self._search_process.is_alive():
+            self._search_process.reset_stim()
+        else:
+            self.explorer.reset_stim()
 
     def current_stim(self):
         """The signal of the current search stimulus
@@ -247,8 +297,11 @@ class AcquisitionManager():
 
         :param interval: The repetition interval between stimuli presentations (seconds)
         :type interval: float
-        :returns: :py:class:`threading.Thread` -- the acquisition thread
+        :returns: :py:class:`threading.Thread` -- the acquisition thread, or the thread relaying the notifications of the child process
         """
+        if self.acquisition_process:
+            self._search_process = SearchProcess(self.explorer, self.signals)
+            return self._search_process.start(interval)
         return self.explorer.run(interval)
 
     def setup_protocol(self, interval):
@@ -266,11 +319,33 @@ class AcquisitionManager():
         """
         return self.protocoler.count()
 
+    def set_acquisition_process(self, enable):
+        """Sets whether to run protocols, search and chart in a child
+        process, so that acquisition is not slowed by the GUI. Queue 
+        callbacks are called the same either way, and settings and search
+        stimulus changes made while running are sent on to the child. The
+        data file must not be used while acquisition runs in a child process.
+        Calibrations still run in this process.
+        See :class:`RunnerProcess<sparkle.run.process_runner.RunnerProcess>`
+
+        :param enable: whether to use a child process
+        :type enable: bool
+        """
+        self.acquisition_process = enable
+
+    def _child_processes(self):
+        return [process for process in [self._protocol_process, self._search_process,
+                                        self._chart_process]
+                if process is not None and process.is_alive()]
+
     def run_protocol(self):
         """Runs the protocol operation with the current settings
 
-        :returns: :py:class:`threading.Thread` -- the acquisition thread
+        :returns: :py:class:`threading.Thread` -- the acquisition thread, or the thread relaying the notifications of the child process
         """
+        if self.acquisition_process:
+            self._protocol_process = ProtocolProcess(self.protocoler, self.signals)
+            return self._protocol_process.start()
         return self.protocoler.run()
 
     def set_mphone_calibration(self, sens, db):
@@ -323,19 +398,29 @@ class AcquisitionManager():
 
     def start_chart(self):
         """Starts the chart acquistion"""
-        self.charter.start_chart()
+        if self.acquisition_process:
+            self._chart_process = ChartProcess(self.charter, self.signals)
+            self._chart_process.start()
+        else:
+            self.charter.start_chart()
 
     def stop_chart(self):
         """Halts the chart acquisition"""
-        self.charter.stop_chart()
+        if self._chart_process is not None:
+            self._chart_process.stop()
+            self._chart_process = None
+        else:
+            self.charter.stop_chart()
 
     def run_chart_protocol(self, interval):
         """Runs the stimuli presentation during a chart acquisition
 
         :param interval: The repetition interval between stimuli presentations (seconds)
         :type interval: float
-        :returns: :py:class:`threading.Thread` -- the acquisition thread
+        :returns: :py:class:`threading.Thread` -- the acquisition thread, or one that finishes with it in the child process
         """
+        if self._chart_process is not None:
+            return self._chart_process.run_protocol(interval)
         self.charter.setup(interval)
         return self.charter.run()
 
@@ -365,6 +450,8 @@ class AcquisitionManager():
         self.tone_calibrator.halt()
         self.charter.halt()
         self.mphone_calibrator.halt()
+        for process in self._child_processes():
+            process.halt()
 
     def close_data(self):
         """Closes the current data file"""
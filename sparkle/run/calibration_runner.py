@@ -11,6 +11,7 @@ from sparkle.stim.stimulus_model import StimulusModel
 from sparkle.stim.types.stimuli_classes import FMSweep, PureTone, WhiteNoise
 from sparkle.tools.audiotools import attenuation_curve, calc_db, \
     calc_spectrum, signal_amplitude
+from sparkle.tools.precision import storage_dtype
 from sparkle.tools.systools import get_src_directory
 from sparkle.tools.util import next_str_num
 
@@ -127,7 +128,8 @@ class CalibrationRunner(AbstractCalibrationRunner):
             logger.debug('Calibrating with fs %s' %  self.stimulus.samplerate())
 
             self.datafile.init_data(self.current_dataset_name, mode='calibration', 
-                                    dims=(self.stimulus.repCount(), self.stimulus.duration()*self.stimulus.samplerate()))
+                                    dims=(self.stimulus.repCount(), self.stimulus.duration()*self.stimulus.samplerate()),
+                                    dtype=storage_dtype())
 
             info = {'samplerate_ad': self.player.aifs}
             self.datafile.set_metadata(self.current_dataset_name, info)
@@ -144,7 +146,8 @@ class CalibrationRunner(AbstractCalibrationRunner):
 
             self.datafile.init_data(self.current_dataset_name, mode='calibration',
                                     nested_name='reference_tone',
-                                    dims=(self.stimulus.repCount(), self.stimulus.duration()*self.stimulus.samplerate()))
+                                    dims=(self.stimulus.repCount(), self.stimulus.duration()*self.stimulus.samplerate()),
+                                    dtype=storage_dtype())
 
     def _initialize_test(self, test):
         assert test.samplerate() == self.player.aifs
@@ -265,7 +268,8 @@ class CalibrationCurveRunner(AbstractCalibrationRunner):
 
             self.datafile.init_group(self.current_dataset_name, mode='calibration')
             self.datafile.init_data(self.current_dataset_name, mode='calibration',
-                                    dims=(self.stimulus.traceCount(), self.stimulus.repCount(), self.aitimes.shape[0]))
+                                    dims=(self.stimulus.traceCount(), self.stimulus.repCount(), self.aitimes.shape[0]),
+                                    dtype=storage_dtype())
             self.datafile.init_data(self.current_dataset_name, mode='calibration',
                                     dims=(self.stimulus.traceCount(), self.stimulus.repCount()),
                                     nested_name='fft_peaks')
@@ -1,5 +1,8 @@
+import logging
+
 from sparkle.acq.players import ContinuousPlayer
 from sparkle.run.list_runner import ListAcquisitionRunner
+from sparkle.tools.precision import storage_dtype
 from sparkle.tools.util import increment_title
 
 
@@ -11,6 +14,8 @@ class ChartRunner(ListAcquisitionRunner):
         save_data = False
         self.player = ContinuousPlayer()
         self.player.set_read_function(self.emit_ncollected)
+        # position of the data file writer in the player's ring buffer
+        self.writer = None
 
     def _initialize_run(self):
         self.player.set_aochan(self.aochan)
@@ -18,23 +23,44 @@ class ChartRunner(ListAcquisitionRunner):
     def start_chart(self):
         """Begin on-going chart style acqusition"""
         self.current_dataset_name = self.chart_name
-        self.datafile.init_data(self.current_dataset_name, mode='continuous')
+        self.datafile.init_data(self.current_dataset_name, mode='continuous', dtype=storage_dtype())
         self.chart_name = increment_title(self.chart_name)
         
         # stimulus tracker channel hard-coded at least chan for now
         self.player.start_continuous([self.aichan, u"PCI-6259/ai31"])
+        self.writer = self.player.ring.reader(from_oldest=True)
 
     def stop_chart(self):
+        if self.writer is None:
+            # not started, or already stopped
+            return
         self.player.stop_all()
+        self.save_collected()
+        if self.writer.dropped > 0:
+            logger = logging.getLogger('main')
+            logger.warning('Chart data file writer dropped {} blocks of {} samples'.format(
+                           self.writer.dropped, self.player.ring.block_shape[1]))
+        self.player.ring.remove_reader(self.writer)
+        self.writer = None
         self.datafile.consolidate(self.current_dataset_name)
 
     def emit_ncollected(self, data):
-        # relay emit signal
+        # relay emit signal. data is a block of the ring buffer, which the
+        # next read from the device may overwrite before listeners get to it
+        data = data.copy()
         response = data[0,:]
         stim_recording = data[1,:]
-        self.signals.ncollected.emit(stim_recording, response)
+        self.putnotify('ncollected', (stim_recording, response))
         if self.save_data:
-            self.datafile.append(self.current_dataset_name, response)
+            self.save_collected()
+
+    def save_collected(self):
+        """Appends the response channel of any blocks in the ring buffer
+        not yet saved to the data file"""
+        if self.writer is None or not self.save_data:
+            return
+        for block in self.writer.read_blocks():
+            self.datafile.append(self.current_dataset_name, block[0,:])
 
     def _initialize_test(self, test):
         pass
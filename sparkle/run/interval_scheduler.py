@@ -0,0 +1,117 @@
+import time
+
+import numpy as np
+
+from sparkle.tools.systools import monotonic
+
+
+class IntervalScheduler(object):
+    """Paces repeated acquisitions at a fixed interval.
+
+    Each rep targets an absolute start time, *interval* after the previous
+    target rather than after the previous rep actually started, so timing
+    jitter does not accumulate. A rep that misses its deadline by more
+    than *tolerance* (e.g. held up by loading the next test) restarts the
+    schedule from itself, so the following rep still gets a whole interval,
+    instead of being hurried to catch up. How late each rep started is
+    counted in a histogram.
+
+    :param interval: time between the starts of consecutive reps (seconds)
+    :type interval: float
+    :param spin: the last part of each wait (seconds) is spent polling the clock instead of sleeping, for a more precise start at the cost of CPU time. 0 to only sleep
+    :type spin: float
+    :param bin_width: width (seconds) of the lateness histogram bins
+    :type bin_width: float
+    :param nbins: number of histogram bins; the last bin also counts everything later
+    :type nbins: int
+    :param tolerance: lateness (seconds) above which a rep counts as a missed deadline, and restarts the schedule
+    :type tolerance: float
+    """
+    def __init__(self, interval, spin=0., bin_width=0.0005, nbins=40, tolerance=0.01):
+        self.interval = interval
+        self.spin = spin
+        self.bin_width = bin_width
+        self.tolerance = tolerance
+        self.counts = np.zeros((nbins,), dtype=int)
+        self.nreps = 0
+        self.missed = 0
+        self.restarts = 0
+        self.total_lateness = 0.
+        self.max_lateness = 0.
+        self._deadline = None
+
+    def start(self):
+        """Sets the first deadline to now, so the first wait returns immediately"""
+        self._deadline = monotonic()
+
+    def wait(self):
+        """Blocks until the start time of the next rep
+
+        :returns: float -- how late (seconds) the rep started
+        """
+        if self._deadline is None:
+            self.start()
+        remaining = self._deadline - monotonic()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        now = monotonic()
+        while now < self._deadline:
+            now = monotonic()
+
+        lateness = now - self._deadline
+        self._record(lateness)
+        if lateness > self.tolerance:
+            self.restarts += 1
+            self._deadline = now + self.interval
+        else:
+            self._deadline += self.interval
+        return lateness
+
+    def skip(self, nreps):
+        """Advances the schedule past reps presented without waiting,
+        e.g. timed by the device clock"""
+        self._deadline += nreps*self.interval
+
+    def _record(self, lateness):
+        ibin = min(int(lateness/self.bin_width), len(self.counts) - 1)
+        self.counts[ibin] += 1
+        self.nreps += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if lateness > self.tolerance:
+            self.missed += 1
+
+    def bin_edges(self):
+        """Lower edges (seconds) of the histogram bins
+
+        :returns: numpy.ndarray
+        """
+        return np.arange(len(self.counts))*self.bin_width
+
+    def stats(self):
+        """Summary of the reps scheduled so far
+
+        :returns: dict -- reps, deadlines missed, schedule restarts, mean and max lateness (seconds), histogram counts and bin edges
+        """
+        if self.nreps > 0:
+            mean_lateness = self.total_lateness/self.nreps
+        else:
+            mean_lateness = 0.
+        return {'reps': self.nreps, 'missed': self.missed,
+                'restarts': self.restarts, 'mean_lateness': mean_lateness,
+                'max_lateness': self.max_lateness,
+                'histogram': self.counts.copy(), 'bin_edges': self.bin_edges()}
+
+    def metadata(self):
+        """:meth:`stats` as attributes to save with the data
+
+        :returns: dict
+        """
+        stats = self.stats()
+        return {'reps_scheduled': stats['reps'],
+                'deadlines_missed': stats['missed'],
+                'schedule_restarts': stats['restarts'],
+                'mean_lateness_s': stats['mean_lateness'],
+                'max_lateness_s': stats['max_lateness'],
+                'lateness_histogram': stats['histogram'],
+                'lateness_bin_edges_s': stats['bin_edges']}
@@ -1,4 +1,5 @@
 import logging
+import sys
 import threading
 import time
 
@@ -10,6 +11,62 @@ from sparkle.run.protocol_model import ProtocolTabelModel
 
 class Broken(Exception): pass
 
+class TracePrefetcher(object):
+    """Iterates over an expanded stimulus, rendering the next trace on a
+    background thread while the current one is presented.
+
+    :param expanded: traces to present, e.g. from :meth:`StimulusModel<sparkle.stim.stimulus_model.StimulusModel.iterExpandedStim>`
+    :type expanded: iterable
+    """
+    def __init__(self, expanded):
+        self._expanded = iter(expanded)
+        self.render_time = 0.
+        self.wait_time = 0.
+        self._prefetch()
+
+    def _prefetch(self):
+        self._result = None
+        self._thread = threading.Thread(target=self._render)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _render(self):
+        t0 = time.time()
+        try:
+            self._result = (self._expanded.next(), None)
+        except:
+            self._result = (None, sys.exc_info())
+        self.render_time += time.time() - t0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        t0 = time.time()
+        self._thread.join()
+        self.wait_time += time.time() - t0
+
+        item, error = self._result
+        if error is not None:
+            raise error[0], error[1], error[2]
+        self._prefetch()
+        return item
+
+    def close(self):
+        """Waits for the trace being rendered, and closes the expanded
+        stimulus, so that it restores its components. Use when stopping
+        before the last trace"""
+        self._thread.join()
+        if hasattr(self._expanded, 'close'):
+            self._expanded.close()
+
+    def hidden_time(self):
+        """Time spent rendering traces that did not hold up presentation
+
+        :returns: float -- seconds of rendering that overlapped with acquisition
+        """
+        return max(self.render_time - self.wait_time, 0.)
+
 class ListAcquisitionRunner(AbstractAcquisitionRunner):
     """Provides a common interface and some facilitatory functions for
     the presentation of data with a pre-determined order"""
@@ -19,6 +76,12 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
         super(ListAcquisitionRunner, self).__init__(*args)
         
         self.silence_window = False
+        # render each trace as it is needed, instead of all up front
+        self.stream_stim = False
+        # present all reps of a trace in a single hardware timed task
+        self.batch_reps = False
+        # rendering time for the last run, when streaming
+        self.prefetch_stats = None
 
     def set_calibration(self, attenuations, freqs, frange, calname):
         """See :meth:`AbstractAcquisitionRunner<sparkle.run.abstract_acquisition.AbstractAcquisitionRunner.set_calibration>`"""
@@ -56,6 +119,8 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
     def run(self):
         """Runs the acquisition"""
         self._initialize_run()
+        # tests may have been edited since they were put in the protocol
+        self.protocol_model.precomputeCalibration()
 
         stimuli = self.protocol_model.allTests()
 
@@ -66,10 +131,13 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
             info = {'calibration_used': self.calname, 'calibration_range': self.cal_frange}
             self.datafile.set_metadata(self.current_dataset_name, info)
 
-        # save the start time and set last tick to expired, so first
-        # acquisition loop iteration executes immediately
-        self.start_time = time.time()
-        self.last_tick = self.start_time - (self.interval/1000)
+        if hasattr(self.player, 'set_rep_clock'):
+            if self.hardware_clock:
+                self.player.set_rep_clock(1000./self.interval)
+            else:
+                self.player.set_rep_clock(None)
+        self.start_schedule(self.interval)
+        self.start_writer()
 
         self.acq_thread.start()
         return self.acq_thread
@@ -81,15 +149,17 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
         raise NotImplementedError
 
     def _worker(self, stimuli):
-        t0 = time.time()
-        starttime = t0
-        timecollection = []
+        render_time = 0.
+        hidden_time = 0.
+        logger = logging.getLogger('main')
         try:
-            logger = logging.getLogger('main')
             # incase of early abortion...
             itest = 0
             itrace = -1
             irep = 0
+            prefetcher = None
+            if self.batch_reps:
+                self._check_batch_interval(stimuli)
             try:
                 for itest, test in enumerate(stimuli):
                     # pull out signal from stim model
@@ -98,10 +168,17 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                     self._initialize_test(test)
                     if self.save_data:
                         self.datafile.set_metadata(self.current_dataset_name, test.testDoc(), signal=True)
-                    traces, docs, overs = test.expandedStim()
                     nreps = test.repCount()
                     self.nreps = test.repCount() # not sure I like this -- subclasses use this variable
                     fs = test.samplerate()
+                    if self.stream_stim:
+                        # the test components are modified on the prefetch
+                        # thread from here on, so don't touch them
+                        expanded = TracePrefetcher(test.iterExpandedStim())
+                        prefetcher = expanded
+                    else:
+                        traces, docs, overs = test.expandedStim()
+                        expanded = zip(traces, docs, overs)
                     
                     if self.silence_window:
                         # generate control period of silence
@@ -116,7 +193,7 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                         stamps = []
                         self.player.start()
                         for irep in range(nreps):
-                            self.interval_wait()  
+                            self._rep_wait(irep)
                             if self._halt:
                                 raise Broken
                             response = self.player.run()
@@ -130,6 +207,7 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
 
                             self.putnotify('current_rep', (irep,))
                             self.player.reset()
+                        self._reps_done(nreps)
 
                         trace_doc['time_stamps'] = stamps
                         if self.save_data:
@@ -137,7 +215,7 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                         self.player.stop()
 
                     # now present the "real" stimuli
-                    for itrace, (trace, trace_doc, over) in enumerate(zip(traces, docs, overs)):
+                    for itrace, (trace, trace_doc, over) in enumerate(expanded):
                         
                         signal, atten = trace
                         # t1 = time.time()
@@ -145,46 +223,44 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                         # print 'player start time {:.3f}'.format(time.time()-t1)
 
                         stamps = []
-                        self.player.start()
-                        for irep in range(nreps):
+                        if self.batch_reps:
                             self.interval_wait()
                             if self._halt:
                                 raise Broken
-                            elapsed = time.time()-t0
-                            # print 'down time {:.3f}'.format(elapsed),
-                            # timecollection.append(elapsed)
-                            response = self.player.run()
+                            period = self.interval/1000.
                             s = time.time()
-                            oldt = t0
-                            t0=time.time()
-                            looplen = t0 - oldt
-                            self.player.reset()
-                            # print 'reset time {:.3f}'.format(time.time()-s)
-                            # print 'loop duration {:.3f}'.format(looplen)
-                            timecollection.append(looplen)
-                            stamps.append(s)
-
-                            if test.stimType() == 'Tuning Curve':
-                                f = trace_doc['components'][0]['frequency']
-                                db = trace_doc['components'][0]['intensity']
-                                extra_info = {'f': f, 'db': db}
-                            else:
-                                extra_info = {'all traces': True}
-                            
-                            self.putnotify('response_collected', (self.aitimes, response, itest, itrace, irep, extra_info))
-                            self._process_response(response, trace_doc, irep)
-
-                            if irep == 0:
-                                self.putnotify('stim_generated', (signal, fs))
-                                self.putnotify('current_trace', (itest,itrace,trace_doc))
-                                self.putnotify('over_voltage', (over,))
-                            self.putnotify('current_rep', (irep,))
+                            responses = self.player.run_batch(nreps, period)
+                            # reps are spaced by the device sample clock
+                            stamps = [s + irep*period for irep in range(nreps)]
+                            for irep, response in enumerate(responses):
+                                self._rep_collected(test, itest, itrace, irep, response,
+                                                    trace_doc, signal, fs, over)
+                            # the next trace follows an interval after the last rep
+                            self.scheduler.skip(nreps - 1)
+                        else:
+                            self.player.start()
+                            for irep in range(nreps):
+                                self._rep_wait(irep)
+                                if self._halt:
+                                    raise Broken
+                                response = self.player.run()
+                                s = time.time()
+                                self.player.reset()
+                                stamps.append(s)
+
+                                self._rep_collected(test, itest, itrace, irep, response,
+                                                    trace_doc, signal, fs, over)
+                            self._reps_done(nreps)
+                            self.player.stop()
                             
                         # not getting saved:
                         trace_doc['time_stamps'] = stamps
                         if self.save_data:
                             self.datafile.append_trace_info(self.current_dataset_name, trace_doc)
-                        self.player.stop()
+
+                    if self.stream_stim:
+                        render_time += expanded.render_time
+                        hidden_time += expanded.hidden_time()
 
                     # log as well, test type and user tag will be the same across traces
                     # logger.info("Finished test type: {}, tag: {}".format(trace_doc['testtype'], trace_doc['user_tag']))
@@ -193,16 +269,66 @@ class ListAcquisitionRunner(AbstractAcquisitionRunner):
                 if self.save_data:
                     self.datafile.set_metadata(self.current_dataset_name, {'aborted': 'test {}, trace {}, rep {}'.format(itest+1, itrace+1, irep+1)})
                 self.player.stop()
+            finally:
+                # put the components of a test stopped part way back to
+                # their start values, before the run is reported done
+                if prefetcher is not None:
+                    prefetcher.close()
 
+            self.report_timing()
             if self.save_data:
+                self.datafile.set_metadata(self.current_dataset_name, self.scheduler.metadata())
                 self.datafile.backup(self.current_dataset_name)
+            self.stop_writer()
             self.putnotify('group_finished', (self._halt,))
         except:
             logger.exception("Uncaught Exception from Acq Thread: ")
-
-        # print 'all elapsed', timecollection
-        tc = np.array(timecollection[1:])
-        print 'deadlines missed {}/{}'.format(len(tc[tc > (1./self.reprate)+0.01]), len(tc))
+            self.stop_writer()
+            # so that listeners waiting for the run to end are not left waiting
+            self.putnotify('group_finished', (True,))
+
+        if self.stream_stim:
+            self.prefetch_stats = {'render_time': render_time, 'hidden_time': hidden_time}
+            logger.debug('stimulus rendering {:.3f}s, {:.3f}s hidden by prefetch'.format(render_time, hidden_time))
+
+    def _check_batch_interval(self, stimuli):
+        """Raises ValueError if the reps of any trace would overlap when
+        presented in a batch, before anything is presented"""
+        period = self.interval/1000.
+        for test in stimuli:
+            longest = max(test.expandFunction(test.duration) + [self.player.aitime])
+            if longest > period:
+                raise ValueError("Interval of {}s is shorter than the stimulus or recording window, "
+                                 "{}s, so reps cannot be batched".format(period, longest))
+
+    def _rep_wait(self, irep):
+        """Waits for the start of a rep. With the hardware clock, only the
+        first rep of a trace is started from software"""
+        if irep == 0 or not self.hardware_clock:
+            self.interval_wait()
+
+    def _reps_done(self, nreps):
+        """Catches the schedule up with reps timed by the hardware clock"""
+        if self.hardware_clock:
+            self.scheduler.skip(nreps - 1)
+
+    def _rep_collected(self, test, itest, itrace, irep, response, trace_doc, signal, fs, over):
+        """Reports and processes the response to one rep of a trace"""
+        if test.stimType() == 'Tuning Curve':
+            f = trace_doc['components'][0]['frequency']
+            db = trace_doc['components'][0]['intensity']
+            extra_info = {'f': f, 'db': db}
+        else:
+            extra_info = {'all traces': True}
+        
+        self.putnotify('response_collected', (self.aitimes, response, itest, itrace, irep, extra_info))
+        self._process_response(response, trace_doc, irep)
+
+        if irep == 0:
+            self.putnotify('stim_generated', (signal, fs))
+            self.putnotify('current_trace', (itest,itrace,trace_doc))
+            self.putnotify('over_voltage', (over,))
+        self.putnotify('current_rep', (irep,))
 
     def clear_child_process(self):
         del self.acq_thread
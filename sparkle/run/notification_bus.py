@@ -0,0 +1,183 @@
+"""Delivers the notifications of the acquisition runners to their
+listeners, from a single dispatcher thread.
+
+All topics share one queue, so notifications are delivered in the order
+they were put. Each listener either gets every notification of its topic,
+or, if it only shows the latest state (e.g. a plot), gets the latest one
+at most once per frame; the ones in between are dropped.
+"""
+import collections
+import logging
+import Queue
+import threading
+import time
+
+# the most often a coalesced listener is called (seconds)
+FRAME_INTERVAL = 1./30
+
+# delivery policies
+ALL = 'all'
+LATEST = 'latest'
+
+
+class TopicQueue(object):
+    """Stands in for the queue of a single topic, for the runners, which
+    put into it as they would a :py:class:`Queue.Queue`"""
+    def __init__(self, name, bus):
+        self.name = name
+        self.bus = bus
+
+    def put(self, args):
+        self.bus.publish(self.name, args)
+
+
+class _NoWaker(object):
+    """The bus wakes its own dispatcher"""
+    def set(self):
+        pass
+
+
+class NotificationBus(object):
+    """Multiplexes notifications for named topics onto one queue, and
+    calls the listeners of each from a dispatcher thread.
+
+    :param names: topic names
+    :type names: list<str>
+    :param frame_interval: least time between calls to a coalesced listener (seconds)
+    :type frame_interval: float
+    """
+    def __init__(self, names, frame_interval=FRAME_INTERVAL):
+        self.frame_interval = frame_interval
+        self._queue = Queue.Queue()
+        self._topics = dict([(name, (TopicQueue(name, self), _NoWaker())) for name in names])
+        self._listeners = collections.defaultdict(list)
+        # latest undelivered notification, and last call time, per coalesced
+        # listener, by topic and position in the topic's listeners
+        self._pending = {}
+        self._last_call = {}
+        self._thread = None
+        self._reset_stats()
+
+    def topics(self):
+        """Queue and waker pairs for each topic, as the runners expect them
+
+        :returns: dict -- topic name: (queue, waker)
+        """
+        return self._topics
+
+    def subscribe(self, name, func, policy=ALL):
+        """Adds a listener for topic *name*
+
+        :param name: topic to listen to
+        :type name: str
+        :param func: called with the contents of each notification as arguments
+        :type func: callable
+        :param policy: ``'all'`` to be called for every notification, or ``'latest'`` to be called for the latest one at most once per frame
+        :type policy: str
+        """
+        if name not in self._topics:
+            raise KeyError("Unknown notification topic: {}".format(name))
+        if policy not in [ALL, LATEST]:
+            raise ValueError("Unknown delivery policy: {}".format(policy))
+        self._listeners[name].append((func, policy))
+
+    def publish(self, name, args):
+        """Queues a notification. Does nothing if no one listens to *name*
+
+        :param name: topic of the notification
+        :type name: str
+        :param args: contents of the notification
+        :type args: tuple
+        """
+        if name not in self._listeners:
+            return
+        self._queue.put((name, args, time.time()))
+        depth = self._queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+
+    def start(self):
+        """Starts the dispatcher thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Delivers the notifications already queued, and ends the
+        dispatcher thread"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def stats(self):
+        """Summary of the notifications so far
+
+        :returns: dict -- the deepest the queue got, and for each topic, notifications delivered and dropped, and the mean and max seconds from publishing to delivered
+        """
+        topics = {}
+        for name, counts in self._topic_stats.items():
+            topic = dict(counts)
+            if counts['delivered'] > 0:
+                topic['mean_latency'] = counts['total_latency']/counts['delivered']
+            else:
+                topic['mean_latency'] = 0.
+            del topic['total_latency']
+            topics[name] = topic
+        return {'max_depth': self.max_depth, 'topics': topics}
+
+    def _reset_stats(self):
+        self.max_depth = 0
+        self._topic_stats = collections.defaultdict(lambda: {'delivered': 0, 'dropped': 0,
+                                                             'total_latency': 0., 'max_latency': 0.})
+
+    def _dispatch(self):
+        while True:
+            # wake up in time to deliver coalesced notifications
+            timeout = None
+            if self._pending:
+                timeout = self.frame_interval
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = ()
+            if item is None:
+                self._deliver_pending(force=True)
+                return
+            if item:
+                name, args, stamp = item
+                for index, (func, policy) in enumerate(self._listeners[name]):
+                    if policy == LATEST:
+                        if (name, index) in self._pending:
+                            self._topic_stats[name]['dropped'] += 1
+                        self._pending[(name, index)] = item
+                    else:
+                        self._call(func, item)
+            # a coalesced listener gets the latest once the queue is caught up,
+            # or once a frame has gone by, if it is not
+            self._deliver_pending(force=self._queue.empty())
+
+    def _deliver_pending(self, force):
+        now = time.time()
+        for key, item in self._pending.items():
+            if force or now - self._last_call.get(key, 0) >= self.frame_interval:
+                del self._pending[key]
+                self._last_call[key] = now
+                name, index = key
+                self._call(self._listeners[name][index][0], item)
+
+    def _call(self, func, item):
+        name, args, stamp = item
+        try:
+            func(*args)
+        except:
+            logger = logging.getLogger('main')
+            logger.exception("Error in listener for {}".format(name))
+        latency = time.time() - stamp
+        counts = self._topic_stats[name]
+        counts['delivered'] += 1
+        counts['total_latency'] += latency
+        counts['max_latency'] = max(counts['max_latency'], latency)
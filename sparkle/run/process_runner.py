@@ -0,0 +1,407 @@
+"""Runs acquisition in a child process, so that it does not share an
+interpreter (and its GIL) with the GUI.
+
+The child process has its own runner, set up as a copy of one in this
+process, and its own handle on the data file. Calls to the runner are sent
+to the child as messages. Notifications the child puts in its queues are
+sent back as small messages; the arrays in them travel through a pool of
+shared memory slots, rather than being pickled. In this process, the messages are put
+into the usual acquisition queues, so listeners are unaware of where the
+runner is.
+"""
+import collections
+import logging
+import multiprocessing
+import Queue
+import threading
+import traceback
+
+import numpy as np
+
+from sparkle.data.open import open_acqdata
+from sparkle.stim.stimulus_model import StimulusModel
+
+# arrays smaller than this (bytes) are pickled with their message
+MIN_SHARED_BYTES = 4096
+
+# reference to an array held in a shared memory slot
+SlotRef = collections.namedtuple('SlotRef', ['index', 'shape', 'dtype'])
+
+
+class SharedSlots(object):
+    """A pool of fixed size shared memory buffers, for passing arrays from
+    the child process. Must be created before the child process.
+
+    :param nslots: number of buffers
+    :type nslots: int
+    :param slot_bytes: size of each buffer
+    :type slot_bytes: int
+    """
+    def __init__(self, nslots, slot_bytes):
+        self.slot_bytes = slot_bytes
+        self.buffer = multiprocessing.RawArray('b', nslots*slot_bytes)
+        # 1 where a slot holds an array not yet copied out
+        self.in_use = multiprocessing.Array('b', nslots)
+
+    def _slot(self, index):
+        data = np.frombuffer(self.buffer, dtype=np.uint8)
+        return data[index*self.slot_bytes:(index+1)*self.slot_bytes]
+
+    def _take_free(self):
+        with self.in_use.get_lock():
+            for index in range(len(self.in_use)):
+                if not self.in_use[index]:
+                    self.in_use[index] = 1
+                    return index
+        return None
+
+    def pack(self, item):
+        """Moves *item* into a free slot, if it is a large enough array and
+        a slot is free. Does not wait for a slot, so that acquisition is not
+        held up if this process falls behind
+
+        :returns: :class:`SlotRef`, or *item* unchanged
+        """
+        if not isinstance(item, np.ndarray) or item.dtype.hasobject \
+                or not MIN_SHARED_BYTES <= item.nbytes <= self.slot_bytes:
+            return item
+        index = self._take_free()
+        if index is None:
+            return item
+        item = np.ascontiguousarray(item)
+        self._slot(index)[:item.nbytes] = item.view(np.uint8).reshape(-1)
+        return SlotRef(index, item.shape, item.dtype.str)
+
+    def unpack(self, item):
+        """Copies an array out of its slot, and frees the slot
+
+        :returns: numpy.ndarray, or *item* unchanged if it is not a :class:`SlotRef`
+        """
+        if not isinstance(item, SlotRef):
+            return item
+        dtype = np.dtype(item.dtype)
+        nbytes = int(np.prod(item.shape))*dtype.itemsize
+        data = self._slot(item.index)[:nbytes].view(dtype).reshape(item.shape).copy()
+        with self.in_use.get_lock():
+            self.in_use[item.index] = 0
+        return data
+
+
+class ForwardingQueue(object):
+    """Stands in for an acquisition queue in the child process, sending
+    what is put in it to the parent"""
+    def __init__(self, name, messages, slots):
+        self.name = name
+        self.messages = messages
+        self.slots = slots
+
+    def put(self, args):
+        self.messages.put((self.name, tuple([self.slots.pack(arg) for arg in args])))
+
+
+class _NoWaker(object):
+    """The parent wakes its own listeners"""
+    def set(self):
+        pass
+
+
+def run_runner_process(config, queue_names, messages, commands, slots):
+    """Entry point of the child process: sets up a runner as described by
+    *config*, made by :meth:`RunnerProcess.start`, then calls the methods
+    sent by :meth:`RunnerProcess.call`, until told to finish"""
+    datafile = None
+    runner = None
+    # calls that returned a thread, which are not done until it is
+    running = []
+    result = {}
+    try:
+        StimulusModel.voltage_limits[:] = config['voltage_limits']
+        queues = dict([(name, (ForwardingQueue(name, messages, slots), _NoWaker()))
+                       for name in queue_names])
+        runner = config['runner_class'](queues)
+        for name, value in config['state'].items():
+            setattr(runner, name, value)
+        runner.set(**config['settings'])
+        runner.set_threshold(config['threshold'])
+        if config['datafile'] is not None:
+            datafile = open_acqdata(config['datafile'], filemode='a', swmr=config['swmr'])
+            datafile.set_layout(**config['data_layout'])
+            # the file goes back to the parent, which repacks it, and limits
+            # its journal, when closed
+            datafile.set_repack_policy('defer')
+            datafile.set_journal_limit(None)
+            runner.set(datafile=datafile)
+
+        finishing = False
+        while not finishing or running:
+            for call_id, thread in running[:]:
+                if not thread.is_alive():
+                    running.remove((call_id, thread))
+                    messages.put(('_returned', (call_id,)))
+            try:
+                call_id, method, args, kwargs = commands.get(timeout=0.05)
+            except Queue.Empty:
+                continue
+            if method == '_finish':
+                finishing = True
+            elif method == '_set_state':
+                for name, value in kwargs.items():
+                    setattr(runner, name, value)
+            else:
+                returned = getattr(runner, method)(*args, **kwargs)
+                if isinstance(returned, threading.Thread):
+                    running.append((call_id, returned))
+                    continue
+            messages.put(('_returned', (call_id,)))
+        result['state'] = dict([(name, getattr(runner, name))
+                                for name in config['returned_names']])
+    except:
+        result['error'] = traceback.format_exc()
+        # don't leave acquisition going on a file about to be closed
+        if runner is not None and running:
+            runner.halt()
+            for call_id, thread in running:
+                thread.join()
+    finally:
+        if datafile is not None:
+            datafile.close()
+        messages.put(('_done', (result,)))
+
+
+class RunnerProcess(object):
+    """Runs an acquisition runner in a child process. The child has its
+    own copy of *runner*, set up with its settings, and the attributes
+    named in :attr:`state_names`; its methods are called with :meth:`call`.
+    *runner* itself does not acquire; it gets back its data file, and the
+    attributes named in :attr:`returned_names`, when the child is done.
+
+    :param runner: runner to copy
+    :type runner: :class:`AbstractAcquisitionRunner<sparkle.run.abstract_acquisition.AbstractAcquisitionRunner>`
+    :param queues: acquisition queues to relay the child's notifications to, name: (queue, waker event)
+    :type queues: dict
+    :param nslots: number of shared memory slots
+    :type nslots: int
+    """
+    # attributes of the runner, besides its settings, copied to the child
+    state_names = []
+    # attributes of the child's runner copied back when it is done
+    returned_names = ['current_dataset_name']
+    def __init__(self, runner, queues, nslots=16):
+        self.runner = runner
+        self.queues = queues
+        self.nslots = nslots
+        self.process = None
+        self._call_count = 0
+        # call id: event set when the call has returned in the child
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._done = False
+
+    def _slot_bytes(self):
+        # big enough for a response on every channel, at double precision
+        runner = self.runner
+        nchans = len(runner.aichan) if isinstance(runner.aichan, list) else 1
+        return max(len(runner.aitimes)*nchans*8, MIN_SHARED_BYTES)
+
+    def _uses_datafile(self):
+        return self.runner.save_data
+
+    def start(self):
+        """Starts the child process
+
+        :returns: :py:class:`threading.Thread` -- relays the child's notifications, and finishes with the child
+        """
+        runner = self.runner
+        self.slots = SharedSlots(self.nslots, self._slot_bytes())
+        self.messages = multiprocessing.Queue()
+        self.commands = multiprocessing.Queue()
+
+        datafile = runner.datafile if self._uses_datafile() else None
+        config = {'runner_class': runner.__class__, 'settings': runner.settings(),
+                  'threshold': runner.threshold,
+                  'state': dict([(name, getattr(runner, name)) for name in self.state_names]),
+                  'returned_names': self.returned_names,
+                  'voltage_limits': list(StimulusModel.voltage_limits),
+                  'datafile': None}
+        if datafile is not None:
+            config['datafile'] = datafile.filename
+            config['data_layout'] = datafile.layout()
+            config['swmr'] = datafile.swmr
+            # the child process writes the file until it is done
+            datafile.suspend()
+        self._datafile = datafile
+
+        self.process = multiprocessing.Process(target=run_runner_process,
+                                               args=(config, self.queues.keys(), self.messages,
+                                                     self.commands, self.slots))
+        self.process.daemon = True
+        self.process.start()
+        self.relay_thread = threading.Thread(target=self._relay)
+        self.relay_thread.start()
+        return self.relay_thread
+
+    def is_alive(self):
+        """Whether the child process has been started, and is not done
+
+        :returns: bool
+        """
+        return self.process is not None and not self._done
+
+    def call(self, method, *args, **kwargs):
+        """Calls a method of the runner in the child process. Does not wait
+        for it to return
+
+        :param method: name of the runner method
+        :type method: str
+        :returns: :py:class:`threading.Thread` -- finishes when the method has returned, or if it returned a thread, when that thread has finished. Also finishes if the child process ends first
+        """
+        returned = threading.Event()
+        with self._pending_lock:
+            if self.is_alive():
+                self._call_count += 1
+                self._pending[self._call_count] = returned
+                self.commands.put((self._call_count, method, args, kwargs))
+            else:
+                returned.set()
+        thread = threading.Thread(target=returned.wait)
+        thread.start()
+        return thread
+
+    def set_state(self, **state):
+        """Sets attributes of the runner in the child process, e.g. to
+        update it with edits made to this process's runner"""
+        return self.call('_set_state', **state)
+
+    def halt(self):
+        """Stops the acquisition going on in the child process"""
+        return self.call('halt')
+
+    def finish(self):
+        """Ends the child process, once the acquisitions it has going
+        are done. Further calls are ignored"""
+        return self.call('_finish')
+
+    def _relay(self):
+        logger = logging.getLogger('main')
+        result = {}
+        try:
+            while True:
+                try:
+                    name, args = self.messages.get(timeout=0.5)
+                except Queue.Empty:
+                    if not self.process.is_alive():
+                        result = {'error': 'Acquisition process ended unexpectedly'}
+                        break
+                    continue
+                if name == '_done':
+                    result = args[0]
+                    break
+                if name == '_returned':
+                    with self._pending_lock:
+                        self._pending.pop(args[0]).set()
+                    continue
+                args = tuple([self.slots.unpack(arg) for arg in args])
+                self.queues[name][0].put(args)
+                self.queues[name][1].set()
+        finally:
+            self.process.join()
+            if self._datafile is not None:
+                self._datafile.resume()
+            for name, value in result.get('state', {}).items():
+                setattr(self.runner, name, value)
+            with self._pending_lock:
+                self._done = True
+                for returned in self._pending.values():
+                    returned.set()
+                self._pending = {}
+        if 'error' in result:
+            logger.error("Error from acquisition process:\n{}".format(result['error']))
+
+
+class ProtocolProcess(RunnerProcess):
+    """Runs the protocol of a :class:`ProtocolRunner<sparkle.run.protocol_runner.ProtocolRunner>`
+    in a child process, at the interval it was set up with. See :class:`RunnerProcess`"""
+    state_names = ['protocol_model', 'calname', 'cal_frange']
+
+    def start(self):
+        """Starts the child process, running the protocol
+
+        :returns: :py:class:`threading.Thread` -- relays the child's notifications, and finishes with the run
+        """
+        thread = super(ProtocolProcess, self).start()
+        self.call('setup', self.runner.interval)
+        self.call('run')
+        self.finish()
+        return thread
+
+
+class SearchProcess(RunnerProcess):
+    """Runs the search operation of a :class:`SearchRunner<sparkle.run.search_runner.SearchRunner>`
+    in a child process. The stimulus is edited in this process, and sent
+    to the child with :meth:`reset_stim`. See :class:`RunnerProcess`"""
+    state_names = ['_stimulus', 'set_name']
+    returned_names = ['current_dataset_name', 'set_name']
+
+    def start(self, interval):
+        """Starts the child process, running the search until halted
+
+        :param interval: The repetition interval between stimuli presentations (ms)
+        :type interval: float
+        :returns: :py:class:`threading.Thread` -- relays the child's notifications, and finishes with the run
+        """
+        thread = super(SearchProcess, self).start()
+        self.call('run', interval)
+        self.finish()
+        return thread
+
+    def reset_stim(self):
+        """Sends the stimulus of the runner in this process to the child,
+        to present from the next acquisition on"""
+        self.set_state(_stimulus=self.runner.stimulus())
+        return self.call('reset_stim')
+
+
+class ChartProcess(RunnerProcess):
+    """Runs the chart acquisition of a :class:`ChartRunner<sparkle.run.chart_runner.ChartRunner>`
+    in a child process, from :meth:`start` until :meth:`stop`.
+    See :class:`RunnerProcess`"""
+    state_names = ['protocol_model', 'calname', 'cal_frange', 'chart_name']
+    returned_names = ['current_dataset_name', 'chart_name']
+
+    def _slot_bytes(self):
+        # a channel of a block read from the device, see
+        # ContinuousPlayer.start_continuous
+        npts = int(self.runner.player.get_aifs()/10)
+        return max(npts*8, MIN_SHARED_BYTES)
+
+    def _uses_datafile(self):
+        # the chart dataset is created whether it is saved to or not
+        return self.runner.datafile is not None
+
+    def start(self):
+        """Starts the child process, and the chart acquisition in it
+
+        :returns: :py:class:`threading.Thread` -- relays the child's notifications, and finishes with :meth:`stop`
+        """
+        thread = super(ChartProcess, self).start()
+        self.call('start_chart')
+        return thread
+
+    def run_protocol(self, interval):
+        """Presents the protocol of the runner in this process, as it is
+        now, during the chart acquisition
+
+        :param interval: The repetition interval between stimuli presentations (ms)
+        :type interval: float
+        :returns: :py:class:`threading.Thread` -- finishes with the protocol
+        """
+        self.set_state(protocol_model=self.runner.protocol_model)
+        self.call('setup', interval)
+        return self.call('run')
+
+    def stop(self):
+        """Stops the chart acquisition, and waits for the child process
+        to save its data and end"""
+        self.call('stop_chart')
+        self.finish()
+        self.relay_thread.join()
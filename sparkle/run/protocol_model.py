@@ -1,4 +1,7 @@
 import copy
+import threading
+
+from sparkle.stim.stimulus_model import StimulusModel
 
 
 class ProtocolTabelModel():
@@ -9,6 +12,14 @@ class ProtocolTabelModel():
         self.calibrationVector = None
         self.calibrationFrequencies = None
         self.calibrationFrange = None
+        # threads calculating calibration filters in the background
+        self._precomputing = []
+
+    def __getstate__(self):
+        # filters being calculated in this process are of no use to a copy
+        state = self.__dict__.copy()
+        state['_precomputing'] = []
+        return state
 
     def setReferenceVoltage(self, caldb, calv):
         """See :meth:`StimulusModel<sparkle.stim.stimulus_model.StimulusModel.setReferenceVoltage>`"""
@@ -24,8 +35,43 @@ class ProtocolTabelModel():
         self.calibrationVector = db_boost_array
         self.calibrationFrequencies = frequencies
         self.calibrationFrange = frange
+        self.precomputeCalibration(background=True)
         for test in self._tests:
             test.setCalibration(db_boost_array, frequencies, frange)
+
+    def precomputeCalibration(self, tests=None, background=False):
+        """Calculates, in parallel, the calibration filters for every samplerate
+        the tests in this protocol use, so that none are calculated while running.
+        Waits for filters being calculated in the background first, unless
+        *background* is True
+
+        See :meth:`StimulusModel<sparkle.stim.stimulus_model.StimulusModel.precomputeKernels>`
+
+        :param tests: the tests to calculate filters for, None for all of them
+        :type tests: list<:class:`StimulusModel<sparkle.stim.stimulus_model.StimulusModel>`>
+        :param background: whether to calculate the filters on a thread of their own, and return immediately
+        :type background: bool
+        """
+        if tests is None:
+            tests = self._tests
+        samplerates = []
+        for test in tests:
+            samplerates.extend(test.expandedSamplerates())
+        args = (samplerates, self.calibrationVector, self.calibrationFrequencies, self.calibrationFrange)
+        if background:
+            thread = threading.Thread(target=StimulusModel.precomputeKernels, args=args)
+            thread.daemon = True
+            thread.start()
+            self._precomputing = [t for t in self._precomputing if t.is_alive()] + [thread]
+        else:
+            self.waitForCalibration()
+            StimulusModel.precomputeKernels(*args)
+
+    def waitForCalibration(self):
+        """Blocks until the calibration filters being calculated in the
+        background are done"""
+        while self._precomputing:
+            self._precomputing.pop().join()
     
     def rowCount(self):
         """The number of tests in this protocol
@@ -70,6 +116,8 @@ class ProtocolTabelModel():
             position = self.rowCount()
         stim.setReferenceVoltage(self.caldb, self.calv)
         stim.setCalibration(self.calibrationVector, self.calibrationFrequencies, self.calibrationFrange)
+        # filters for the other samplerates the stimulus expands to
+        self.precomputeCalibration([stim], background=True)
         self._tests.insert(position, stim)
     
     def clear(self):
@@ -1,9 +1,9 @@
 import numpy as np
 
-from itertools import islice, count
-
 from sparkle.acq.players import FinitePlayer
 from sparkle.run.list_runner import ListAcquisitionRunner
+from sparkle.tools.averaging import RepAverage
+from sparkle.tools.precision import storage_dtype
 from sparkle.tools.util import next_str_num
 
 
@@ -24,6 +24,10 @@ class ProtocolRunner(ListAcquisitionRunner):
             self.current_dataset_name = next_str_num(self.group_name, data_items)
 
             self.datafile.init_group(self.current_dataset_name)
+            # tests are numbered here, so the data file does not have to be
+            # asked on the acquisition thread, where it may be written to
+            # from a queue that asking would have to wait for
+            self.test_number = self.datafile.test_count
 
             info = {'samplerate_ad': self.player.aifs, 'averaged': self.average,
                     'artifact_reject': self.reject, 'reject_rate': self.rejectrate}
@@ -37,17 +41,25 @@ class ProtocolRunner(ListAcquisitionRunner):
         self.trace_counter = -1
           
         if self.save_data:
+            self.test_number += 1
             recording_length = self.aitimes.shape[0]
             # +1 to trace count for silence window
             if self.average:
                 self.datafile.init_data(self.current_dataset_name, 
                                         dims=(test.traceCount()+1, 1, len(self.aichan), recording_length),
-                                        mode='finite')
-                self.avg_buffer = np.zeros((test.repCount(), len(self.aichan), recording_length))
+                                        mode='finite', dtype=storage_dtype())
+                # number of reps in the average of each sample, saved with
+                # the averages, as rejection leaves some samples short
+                self.counts_name = 'test_{}_counts'.format(self.test_number)
+                self.datafile.init_data(self.current_dataset_name,
+                                        dims=(test.traceCount()+1, len(self.aichan), recording_length),
+                                        mode='finite', nested_name=self.counts_name,
+                                        dtype=np.int32)
+                self.rep_average = RepAverage((len(self.aichan), recording_length))
             else:
                 self.datafile.init_data(self.current_dataset_name, 
                                     dims=(test.traceCount()+1, test.repCount(), len(self.aichan), recording_length),
-                                    mode='finite')
+                                    mode='finite', dtype=storage_dtype())
         # check for special condition -- replace this with a generic
         # if test.editor is not None and test.editor.name == "Tuning Curve":
         if test.stimType() == "Tuning Curve":
@@ -59,23 +71,18 @@ class ProtocolRunner(ListAcquisitionRunner):
     def _process_response(self, response, trace_info, irep):
         if self.save_data:
             if self.average:
-                self.avg_buffer[irep, :] = response
+                if irep == 0:
+                    self.rep_average.reset()
+                # samples at or above the artifact rejection value are
+                # left out of the average
+                if self.reject:
+                    self.rep_average.add(response, self.rejectrate)
+                else:
+                    self.rep_average.add(response)
                 if irep == self.nreps - 1:
-
-                    # Checks if any values are higher than the Artifact Rejection
-                    # value for each sample and if so converts to nan
-                    if self.reject:
-                        # print 'rejectrate:', self.rejectrate
-                        for i in islice(count(), self.avg_buffer.shape[0]):
-                            for j in islice(count(), self.avg_buffer.shape[2]):
-                                if self.avg_buffer[i][0][j] >= self.rejectrate:
-                                    self.avg_buffer[i][0][j] = np.nan
-                            # print '[', i, ']: ', self.avg_buffer[i][0]
-
-                    avg_response = np.nanmean(self.avg_buffer, axis=0)
-                    # print '\navg_response: ', avg_response
-                    self.datafile.append(self.current_dataset_name, avg_response)
-                    self.avg_buffer = np.zeros_like(self.avg_buffer)  # Zero's out the array
+                    self.datafile.append(self.current_dataset_name, self.rep_average.average())
+                    self.datafile.append(self.current_dataset_name, self.rep_average.counts,
+                                         nested_name=self.counts_name)
             else:
                 self.datafile.append(self.current_dataset_name, response)
 
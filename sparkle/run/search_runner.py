@@ -8,14 +8,19 @@ from sparkle.acq.players import FinitePlayer
 from sparkle.run.abstract_acquisition import AbstractAcquisitionRunner
 from sparkle.stim.stimulus_model import StimulusModel
 from sparkle.tools import spikestats
+from sparkle.tools.precision import storage_dtype
 from sparkle.tools.util import increment_title
 
 
 class SearchRunner(AbstractAcquisitionRunner):
     """Handles the presentation of data where changes are allowed to
     be made to the stimulus while running"""
+    # searching needs a fast turn around more than an exact calibration,
+    # so use a short minimum phase filter (see StimulusModel.setKernelDesign)
+    kernel_len = 2**12
     def __init__(self, *args):
         self._stimulus = StimulusModel()
+        self._stimulus.setKernelDesign(self.kernel_len, minimum_phase=True)
 
         super(SearchRunner, self).__init__(*args)
 
@@ -40,6 +45,10 @@ class SearchRunner(AbstractAcquisitionRunner):
     def set_calibration(self, attenuations, freqs, frange, calname):
         """See :meth:`AbstractAcquisitionRunner<sparkle.run.abstract_acquisition.AbstractAcquisitionRunner.set_calibration>`"""
         self._stimulus.setCalibration(attenuations, freqs, frange)
+        if self._stimulus.impulseResponse is not None:
+            logger = logging.getLogger('main')
+            logger.info('search calibration filter {} taps, error within {:.2f} dB of full filter'.format(
+                        len(self._stimulus.impulseResponse), self._stimulus.calibrationError()))
 
     def update_reference_voltage(self):
         """See :meth:`AbstractAcquisitionRunner<sparkle.run.abstract_acquisition.AbstractAcquisitionRunner.update_reference_voltage>`"""
@@ -106,13 +115,12 @@ class SearchRunner(AbstractAcquisitionRunner):
         if self.save_data:
             # initize data set
             self.current_dataset_name = self.set_name
-            self.datafile.init_data(self.current_dataset_name, self.aitimes.shape, mode='open')
+            self.datafile.init_data(self.current_dataset_name, self.aitimes.shape, mode='open',
+                                    dtype=storage_dtype())
             self.set_name = increment_title(self.set_name)
 
-        # save the start time and set last tick to expired, so first
-        # acquisition loop iteration executes immediately
-        self.start_time = time.time()
-        self.last_tick = self.start_time - (interval/1000)
+        self.start_schedule(interval)
+        self.start_writer()
         self.interval = interval
         self.acq_thread = threading.Thread(target=self._worker)
 
@@ -171,12 +179,15 @@ class SearchRunner(AbstractAcquisitionRunner):
 
             self.player.stop()
             # self.player.stop_timer()
+            self.report_timing()
             if self.save_data:
                 self.datafile.trim(self.current_dataset_name)
+            self.stop_writer()
 
         except:
             logger = logging.getLogger('main')
             logger.exception("Uncaught Exception from Explore Thread:")
+            self.stop_writer()
 
     def save_to_file(self, data, stamp):
         """Saves data to current dataset.
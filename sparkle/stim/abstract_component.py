@@ -1,16 +1,24 @@
 import cPickle
 import uuid
 
+from sparkle.stim.signal_cache import SignalCache
+from sparkle.tools.precision import as_signal, signal_dtype
+
 
 class AbstractStimulusComponent(object):
     """Represents a single component of a complete summed stimulus"""
     name = 'unknown'
     protocol = False
     explore = False
+    # whether the signal is proportional to 10^(intensity/20), and otherwise
+    # unaffected by intensity, so that changing intensity can be done by
+    # scaling a previous rendering
+    linear_intensity = False
     _start_time = None
     _duration = .01 # in seconds
     _intensity = 20 # in dB SPL
     _risefall = 0.003
+    signalCache = None # shared by all components, off unless enabled
     def __init__(self):
         self.idnum = uuid.uuid1()
 
@@ -65,6 +73,64 @@ class AbstractStimulusComponent(object):
         """
         raise NotImplementedError
 
+    def cachedSignal(self, fs, atten, caldb, calv):
+        """Same as `signal`, but re-uses a previous rendering of this
+        component, if the signal cache is enabled and a component with
+        identical state, and source file (see `sourceStamp`), was already
+        rendered with the same arguments.
+        The returned array must not be modified, and is of the signal dtype
+        (see :mod:`sparkle.tools.precision`).
+
+        :param fs: Generation samplerate (Hz) at which this signal will be output
+        :type fs: int
+        :param atten: actually just 0 for now?
+        :param caldb: calibration intensity in dbSPL
+        :type caldb: float
+        :param calv: calibration voltage that was used to record the intensity provided
+        :type calv: float
+        """
+        if self.signalCache is None:
+            return as_signal(self.signal(fs=fs, atten=atten, caldb=caldb, calv=calv))
+        # before the state, as finding the source file may update it
+        source = self.sourceStamp()
+        key = (self.__class__.__name__, repr(sorted(self.stateDict().items())), source,
+               fs, atten, caldb, calv, signal_dtype().str)
+        return self.signalCache.get(key, lambda: as_signal(self.signal(fs=fs, atten=atten,
+                                                                       caldb=caldb, calv=calv)))
+
+    def sourceStamp(self):
+        """Identifies the version of the file the signal is read from, if
+        any, so that renderings from before the file was modified are not
+        re-used by `cachedSignal`
+
+        :returns: (str, float, int) -- path, modification time and size of the file, or None if the signal is not read from a file
+        """
+        return None
+
+    @staticmethod
+    def enableSignalCache(budget):
+        """Turns on caching of rendered component signals, for all components
+
+        :param budget: maximum memory, in bytes, to hold signals in
+        :type budget: int
+        """
+        AbstractStimulusComponent.signalCache = SignalCache(budget)
+
+    @staticmethod
+    def disableSignalCache():
+        """Turns off, and empties, the component signal cache"""
+        AbstractStimulusComponent.signalCache = None
+
+    @staticmethod
+    def signalCacheStats():
+        """Hit/miss statistics of the component signal cache
+
+        :returns: dict -- see `SignalCache.stats`, None if caching is off
+        """
+        if AbstractStimulusComponent.signalCache is None:
+            return None
+        return AbstractStimulusComponent.signalCache.stats()
+
     def verify(self, **kwargs):
         """Checks this component for invalidating conditions
 
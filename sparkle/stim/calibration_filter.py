@@ -0,0 +1,137 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from scipy.signal import fftconvolve
+
+
+class CalibrationFilter():
+    """Applies a calibration filter kernel to output signals. Produces the
+    same result as :func:`sparkle.tools.audiotools.convolve_filter`, but
+    keeps the kernel's spectrum for each FFT length used, and filters long
+    signals by overlap-save in fixed size blocks, so the cost grows
+    linearly with signal length. Output has the same dtype as the input,
+    though the FFTs are done in double precision.
+
+    :param kernel: the filter impulse response
+    :type kernel: numpy.ndarray
+    :param block_len: FFT length used for overlap-save, rounded up to a power of 2 of at least twice the kernel length. Default is 8 times the kernel length
+    :type block_len: int
+    :param delay: samples the kernel delays the signal by, which are trimmed from the output. Defaults to half the kernel length, for linear phase kernels; use 0 for minimum phase kernels
+    :type delay: int
+    """
+    # limit on the number of (complex) spectrum values per batch,
+    # when filtering stacks of signals
+    max_batch_points = 2**18
+    def __init__(self, kernel, block_len=None, delay=None):
+        self.kernel = kernel
+        if delay is None:
+            delay = len(kernel)/2
+        self.delay = delay
+        # largest deviation (dB) from the full calibration kernel,
+        # for kernels that approximate it
+        self.errorBound = 0.
+        if block_len is None:
+            block_len = 8*len(kernel)
+        self._block_len = _nextpow2(max(block_len, 2*len(kernel)))
+        self._spectra = {}
+
+    def spectrum(self, nfft):
+        """The real FFT of the kernel zero-padded to *nfft*, computed once per length
+
+        :param nfft: FFT length
+        :type nfft: int
+        :returns: numpy.ndarray -- complex spectrum, nfft/2+1 points
+        """
+        spectrum = self._spectra.get(nfft)
+        if spectrum is None:
+            spectrum = np.fft.rfft(self.kernel, nfft)
+            self._spectra[nfft] = spectrum
+        return spectrum
+
+    def fftLength(self, npts):
+        """The FFT length that will be used to filter a signal of *npts* samples
+
+        :param npts: signal length
+        :type npts: int
+        :returns: int -- the whole signal in one FFT if that is shorter than the overlap-save block length, otherwise the block length
+        """
+        return min(_nextpow2(npts + len(self.kernel) - 1), self._block_len)
+
+    def apply(self, signal):
+        """Filters a single signal
+
+        :param signal: signal to filter
+        :type signal: numpy.ndarray
+        :returns: numpy.ndarray -- filtered signal, the same length as *signal*
+        """
+        if np.iscomplexobj(signal) or np.iscomplexobj(self.kernel):
+            return self._convolve(signal)
+        return self._filterRows(np.atleast_2d(signal), len(signal))[0]
+
+    def applyStack(self, signals):
+        """Filters a group of signals together, sharing the kernel spectrum
+        and the FFT calls between them
+
+        :param signals: 2D array, one signal per row, or a list of 1D signals which may differ in length
+        :type signals: numpy.ndarray or list<numpy.ndarray>
+        :returns: list<numpy.ndarray> -- filtered signals, the same lengths as the inputs
+        """
+        if len(signals) == 0:
+            return []
+        lengths = [len(sig) for sig in signals]
+        if any([np.iscomplexobj(sig) for sig in signals]) or np.iscomplexobj(self.kernel):
+            return [self._convolve(sig) for sig in signals]
+        npts = max(lengths)
+        nfft = self.fftLength(npts)
+        nblocks = _ceildiv(npts, nfft - len(self.kernel) + 1)
+        rows_per_batch = max(self.max_batch_points / (nblocks*(nfft/2 + 1)), 1)
+        filtered = []
+        for start in range(0, len(signals), rows_per_batch):
+            batch = signals[start:start+rows_per_batch]
+            stack = np.zeros((len(batch), npts), dtype=_floatType(batch))
+            for row, sig in enumerate(batch):
+                # zero padding does not change the outputs inside the
+                # original length
+                stack[row, :len(sig)] = sig
+            out = self._filterRows(stack, npts)
+            filtered.extend([out[row, :lengths[start+row]] for row in range(len(batch))])
+        return filtered
+
+    def _convolve(self, signal):
+        """Direct convolution, for signals the real FFT path can't handle"""
+        return fftconvolve(signal, self.kernel)[self.delay:self.delay+len(signal)]
+
+    def _filterRows(self, stack, npts):
+        """Overlap-save convolution of each row of *stack*, trimmed the
+        same as :func:`convolve_filter` (for the default delay)
+        """
+        klen = len(self.kernel)
+        nfft = self.fftLength(npts)
+        step = nfft - klen + 1
+        nblocks = _ceildiv(npts, step)
+        # offset the signal so that the first kept output sample is the
+        # one *delay* samples into the full convolution
+        lead = klen - 1 - self.delay
+        dtype = _floatType([stack])
+        padded = np.zeros((stack.shape[0], nblocks*step + klen - 1), dtype=dtype)
+        padded[:, lead:lead+npts] = stack
+        blocks = as_strided(padded, shape=(stack.shape[0], nblocks, nfft),
+                            strides=(padded.strides[0], step*padded.strides[1], padded.strides[1]))
+        spectra = np.fft.rfft(blocks, nfft, axis=-1)
+        spectra *= self.spectrum(nfft)
+        out = np.fft.irfft(spectra, nfft, axis=-1)[:, :, klen-1:]
+        out = out.reshape(stack.shape[0], nblocks*step)[:, :npts]
+        return out.astype(dtype, copy=False)
+
+
+def _nextpow2(n):
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def _ceildiv(a, b):
+    return -(-a // b)
+
+
+def _floatType(signals):
+    """Smallest float dtype that holds all of *signals*, at least float32"""
+    return np.result_type(np.float32, *set([np.asarray(sig).dtype for sig in signals]))
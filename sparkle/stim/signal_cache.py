@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SignalCache(object):
+    """Least-recently-used store of rendered arrays, bounded by the total
+    number of bytes held rather than the number of entries.
+
+    Stored arrays are made read-only, so that callers sharing a cached
+    signal cannot alter it for everyone else.
+
+    :param budget: maximum total size, in bytes, of the cached arrays
+    :type budget: int
+    :param sizeof: function giving the size of a value, counted against *budget*. Defaults to the array size in bytes; e.g. ``lambda value: 1`` makes *budget* an entry count
+    :type sizeof: callable
+    """
+    def __init__(self, budget, sizeof=None):
+        self.budget = budget
+        if sizeof is None:
+            sizeof = _nbytes
+        self._sizeof = sizeof
+        self._store = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, render):
+        """Returns the value stored under *key*, calling *render* to create
+        (and store) it if it is not present
+
+        :param key: hashable identity of the value
+        :param render: callable with no arguments that produces the value
+        :returns: the cached or newly rendered value
+        """
+        with self._lock:
+            if key in self._store:
+                value = self._store.pop(key)
+                self._store[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = render()
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """Stores *value* under *key*, evicting the least recently used
+        entries until the cache is within its budget. Values larger than
+        the whole budget are not stored."""
+        size = self._sizeof(value)
+        if size > self.budget:
+            return
+        with self._lock:
+            if key in self._store:
+                self._nbytes -= self._sizeof(self._store.pop(key))
+            self._store[key] = value
+            self._nbytes += size
+            while self._nbytes > self.budget:
+                old_key, old_value = self._store.popitem(last=False)
+                self._nbytes -= self._sizeof(old_value)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes all entries, statistics are kept"""
+        with self._lock:
+            self._store.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Usage counts for this cache
+
+        :returns: dict -- hits, misses, evictions, entries, nbytes, budget
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._store),
+                    'nbytes': self._nbytes, 'budget': self.budget}
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum([_nbytes(v) for v in value])
+    return getattr(value, 'nbytes', 0)
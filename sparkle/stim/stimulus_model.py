@@ -1,15 +1,22 @@
 import copy
+import hashlib
 import logging
 import os
 import uuid
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import yaml
 
+from sparkle.stim.abstract_component import AbstractStimulusComponent
 from sparkle.stim.auto_parameter_model import AutoParameterModel
+from sparkle.stim.calibration_filter import CalibrationFilter
 from sparkle.stim.reorder import order_function
+from sparkle.stim.signal_cache import SignalCache
 from sparkle.stim.types import get_stimuli_models
-from sparkle.tools.audiotools import convolve_filter, impulse_response
+from sparkle.tools.audiotools import impulse_response, kernel_error
+from sparkle.tools.precision import signal_dtype
 from sparkle.tools.systools import get_src_directory
 
 src_dir = get_src_directory()
@@ -17,13 +24,19 @@ src_dir = get_src_directory()
 with open(os.path.join(src_dir,'settings.conf'), 'r') as yf:
     config = yaml.load(yf)
 DEFAULT_SAMPLERATE = config['default_genrate']
+# memory (MB) for re-using rendered component signals, 0 to disable
+if config.get('signal_cache_mb', 0) > 0:
+    AbstractStimulusComponent.enableSignalCache(int(config['signal_cache_mb']*2**20))
 
 class StimulusModel():
     """
     Model to represent any stimulus the system will present. 
     Holds all relevant parameters
     """
-    kernelCache = {} # persistent across all existing StimulusModels
+    # calibration filters persistent across all existing StimulusModels,
+    # keyed by calibration and samplerate, least recently used are dropped
+    kernelCache = SignalCache(16, sizeof=lambda calfilter: 1)
+    filterLength = 2**14 # calibration filter kernel length (samples)
     # these should always be the same application wide, so
     # use class variables
     voltage_limits = [None, None, 0.0] # speaker max, device max, device min
@@ -40,6 +53,7 @@ class StimulusModel():
         self.calv = None
         self.caldb = None
         self.impulseResponse = None
+        self._calFilter = None
 
         self._attenuationVector = None
         self._calFrequencies = None
@@ -53,6 +67,9 @@ class StimulusModel():
         self._stimType = None
 
         self._calibration_fs = None
+        # calibration kernel design, see setKernelDesign
+        self._filterLen = None
+        self._minimumPhase = False
 
     def setUserTag(self, tag):
         """Sets a string, significant to the user"""
@@ -105,25 +122,14 @@ class StimulusModel():
 
             logger.debug('setting calibration with samplerate {}'.format(self.samplerate()))
             fs = self.samplerate()
-            if fs in StimulusModel.kernelCache:
-                logger.debug('---->using cached filter')
-                # makes the assumption that the cache will be cleared if the frequency reponse
-                # changes
-                self.impulseResponse = StimulusModel.kernelCache[fs]
-            else:
-                logger.debug('---->calculating new filter for fs {}'.format(fs))
-                self.impulseResponse = impulse_response(fs, dbBoostArray, frequencies, frange)
-                # mutable type so will affect data structure persistently
-                StimulusModel.kernelCache[fs] = self.impulseResponse
+            # filter object is shared, so the kernel spectra it computes
+            # are available to all models
+            self._calFilter = StimulusModel.calibrationKernel(fs, dbBoostArray, frequencies, frange,
+                                                              self._filterLen, self._minimumPhase)
+            self.impulseResponse = self._calFilter.kernel
 
             # store this so we can quickly check if a calibration needs to be re-done    
             self._calibration_fs = fs
-            
-            # calculate for the default samplerate, if not already, since
-            # we are very likely to need it, and it's better to have this done
-            # up front, than cause lag in the UI later
-            if DEFAULT_SAMPLERATE not in StimulusModel.kernelCache:
-                StimulusModel.kernelCache[DEFAULT_SAMPLERATE] = impulse_response(DEFAULT_SAMPLERATE, dbBoostArray, frequencies, frange)
 
             # hang on to these for re-calculating impulse response on samplerate change
             self._attenuationVector = dbBoostArray
@@ -132,6 +138,46 @@ class StimulusModel():
 
         else:
             self.impulseResponse = None
+            self._calFilter = None
+
+    def setKernelDesign(self, filter_len=None, minimum_phase=False):
+        """Sets the kind of calibration filter kernel this stimulus uses. A short,
+        minimum phase kernel is faster to apply and adds less delay than the 
+        default full length linear phase kernel, at the cost of some accuracy,
+        see :meth:`calibrationError`
+
+        :param filter_len: kernel length (samples), None for the default :attr:`filterLength`
+        :type filter_len: int
+        :param minimum_phase: whether to use a minimum phase kernel, rather than linear phase
+        :type minimum_phase: bool
+        """
+        self._filterLen = filter_len
+        self._minimumPhase = minimum_phase
+        if self.impulseResponse is not None and self._attenuationVector is not None:
+            self.setCalibration(self._attenuationVector, self._calFrequencies, self._calFrange)
+
+    def calibrationError(self):
+        """How far the current calibration kernel departs from the full 
+        length linear phase kernel, i.e. the error bound of the kernel design
+
+        :returns: float -- maximum difference in magnitude response over the calibration range (dB), None if no calibration is set
+        """
+        calfilter = self.calibrationFilter()
+        if calfilter is None:
+            return None
+        return calfilter.errorBound
+
+    def calibrationFilter(self):
+        """The filter that applies the current calibration to output signals
+
+        :returns: :class:`CalibrationFilter<sparkle.stim.calibration_filter.CalibrationFilter>` -- None if no calibration is set
+        """
+        if self.impulseResponse is None:
+            return None
+        if self._calFilter is None or self._calFilter.kernel is not self.impulseResponse:
+            # impulse response was assigned directly
+            self._calFilter = CalibrationFilter(self.impulseResponse)
+        return self._calFilter
 
     def updateCalibration(self):
         """Updates the current calibration according to intenal values. For example, if the stimulus samplerate changes
@@ -139,10 +185,108 @@ class StimulusModel():
         if self.samplerate() != self._calibration_fs:
             self.setCalibration(self._attenuationVector, self._calFrequencies, self._calFrange)
 
+    @staticmethod
+    def calibrationKernel(fs, dbBoostArray, frequencies, frange, filter_len=None, minimum_phase=False):
+        """Gets the calibration filter for the given calibration at samplerate *fs*,
+        from the cache if it has been calculated before. Kernels other than the 
+        default design have their error bound measured against the default kernel.
+
+        :param fs: generation samplerate the filter is for
+        :type fs: int
+        :param dbBoostArray: frequency response of the system (in dB)
+        :type dbBoostArray: numpy.ndarray
+        :param frequencies: corresponding frequencies for the dbBoostArray
+        :type frequencies: numpy.ndarray
+        :param frange: The desired frequency range for which to apply the calibration, in Hz
+        :type frange: (int, int)
+        :param filter_len: kernel length, None for the default :attr:`filterLength`
+        :type filter_len: int
+        :param minimum_phase: whether to make a minimum phase kernel
+        :type minimum_phase: bool
+        :returns: :class:`CalibrationFilter<sparkle.stim.calibration_filter.CalibrationFilter>`
+        """
+        if filter_len is None:
+            filter_len = StimulusModel.filterLength
+        key = StimulusModel._kernelKey(fs, dbBoostArray, frequencies, frange, filter_len, minimum_phase)
+        def calculate():
+            logger = logging.getLogger('main')
+            logger.debug('---->calculating new filter for fs {}'.format(fs))
+            kernel = impulse_response(fs, dbBoostArray, frequencies, frange,
+                                      filter_len=filter_len, minimum_phase=minimum_phase)
+            if minimum_phase:
+                calfilter = CalibrationFilter(kernel, delay=0)
+            else:
+                calfilter = CalibrationFilter(kernel)
+            if minimum_phase or filter_len != StimulusModel.filterLength:
+                reference = StimulusModel.calibrationKernel(fs, dbBoostArray, frequencies, frange)
+                calfilter.errorBound = kernel_error(kernel, reference.kernel, fs, frange)
+                logger.debug('---->filter error bound {:.3f} dB'.format(calfilter.errorBound))
+            return calfilter
+        return StimulusModel.kernelCache.get(key, calculate)
+
+    @staticmethod
+    def _kernelKey(fs, dbBoostArray, frequencies, frange, filter_len, minimum_phase):
+        """Identity of a calibration filter: the samplerate, a hash of the
+        calibration data, the frequency range and the kernel design"""
+        digest = hashlib.sha1(np.ascontiguousarray(dbBoostArray).tostring())
+        digest.update(np.ascontiguousarray(frequencies).tostring())
+        return (fs, digest.hexdigest(), tuple(frange), filter_len, minimum_phase)
+
+    @staticmethod
+    def precomputeKernels(samplerates, dbBoostArray, frequencies, frange, nthreads=None,
+                          filter_len=None, minimum_phase=False):
+        """Calculates the calibration filters for all of the given samplerates,
+        in parallel, so that they are ready in the cache when a stimulus needs them
+
+        :param samplerates: generation samplerates to calculate filters for
+        :type samplerates: list<int>
+        :param dbBoostArray: frequency response of the system (in dB), None to do nothing
+        :type dbBoostArray: numpy.ndarray
+        :param frequencies: corresponding frequencies for the dbBoostArray
+        :type frequencies: numpy.ndarray
+        :param frange: The desired frequency range for which to apply the calibration, in Hz. None for the full range of *frequencies*
+        :type frange: (int, int)
+        :param nthreads: number of worker threads, defaults to the number of CPUs
+        :type nthreads: int
+        :param filter_len: kernel design, see :meth:`calibrationKernel`
+        :param minimum_phase: kernel design, see :meth:`calibrationKernel`
+        :returns: dict -- {samplerate: CalibrationFilter}
+        """
+        if dbBoostArray is None or frequencies is None:
+            return {}
+        if frange is None:
+            frange = (frequencies[0], frequencies[-1])
+        samplerates = sorted(set([fs for fs in samplerates if fs is not None]))
+        if len(samplerates) > StimulusModel.kernelCache.budget:
+            logger = logging.getLogger('main')
+            logger.warning('Protocol uses {} samplerates, more than the {} calibration filters kept in cache'.format(len(samplerates), StimulusModel.kernelCache.budget))
+        if len(samplerates) < 2:
+            filters = [StimulusModel.calibrationKernel(fs, dbBoostArray, frequencies, frange, 
+                                                       filter_len, minimum_phase) for fs in samplerates]
+        else:
+            pool = ThreadPool(min(nthreads or cpu_count(), len(samplerates)))
+            try:
+                filters = pool.map(lambda fs: StimulusModel.calibrationKernel(fs, dbBoostArray, frequencies, frange,
+                                                                              filter_len, minimum_phase), samplerates)
+            finally:
+                pool.close()
+        return dict(zip(samplerates, filters))
+
+    def expandedSamplerates(self):
+        """The generation samplerates needed by all the traces of this stimulus
+
+        :returns: list<int> -- unique samplerates
+        """
+        rates = set([self.samplerate()])
+        # only a change of wav file can change the samplerate
+        if 'filename' in [p['parameter'] for p in self._autoParams.allData()]:
+            rates.update(self.expandFunction(self.samplerate))
+        return list(rates)
+
     @staticmethod
     def clearCache():
         """clears the calibration filters stored in the cache"""
-        StimulusModel.kernelCache = {}
+        StimulusModel.kernelCache.clear()
 
     def samplerate(self):
         """Returns the generation rate for this stimulus
@@ -389,6 +533,67 @@ class StimulusModel():
         """
         return self._autoParams.ranges()
         
+    def traceParameters(self):
+        """The value each auto-parameter takes for every trace of the expanded
+        stimulus. The first parameter varies the fastest.
+
+        :returns: list<list> -- outer list is for each trace, inner list holds the value for each auto-parameter
+        """
+        steps = self.autoParamRanges()
+        ntraces = 1
+        for p in steps:
+            ntraces = ntraces*len(p)
+        return [self._traceValues(itrace, steps) for itrace in range(ntraces)]
+
+    def _traceValues(self, itrace, steps):
+        """The value of each auto-parameter for a single trace, without 
+        expanding the whole grid
+
+        :param itrace: index of the trace, in expanded (un-reordered) order
+        :type itrace: int
+        :param steps: output of :meth:`autoParamRanges`
+        :type steps: list<list>
+        :returns: list -- one value for each auto-parameter
+        """
+        values = []
+        x = 1
+        for step_set in steps:
+            idx = (itrace / x) % len(step_set)
+            values.append(step_set[idx])
+            x = x*len(step_set)
+        return values
+
+    def _autoParamTargets(self):
+        """Pairs each auto-parameter name with the components of this model it
+        applies to
+
+        :returns: list<(str, list)> -- parameter name and selected components, for each auto-parameter
+        """
+        targets = []
+        for param in self._autoParams.allData():
+            components = []
+            for component in param['selection']:
+                # so I encountered a bug when the parameters were dragged the
+                # pickling/unpickling seems to either make a copy or somehow
+                # otherwise loose connection to the original components
+                # make sure to be setting the components that are in this model.
+                index = self.indexByComponent(component)
+                components.append(self.component(*index))
+            targets.append((param['parameter'], components))
+        return targets
+
+    def _applyTraceParameters(self, targets, values):
+        """Sets the selected components of each auto-parameter to the given values
+
+        :param targets: output of :meth:`_autoParamTargets`
+        :type targets: list
+        :param values: one value for each auto-parameter, i.e. a member of :meth:`traceParameters`
+        :type values: list
+        """
+        for (parameter, components), value in zip(targets, values):
+            for component in components:
+                component.set(parameter, value)
+
     def expandFunction(self, func, args=[]):
         """applies the given function to each of this stimulus's memerships when autoparamters are applied
 
@@ -398,45 +603,20 @@ class StimulusModel():
         :type args: list
         :returns: list<results of *func*>, one for each trace
         """
-        # initilize array to hold all varied parameters
-        params = self._autoParams.allData()
+        # the grid of varied parameters and the components they apply to
+        # are worked out once, up front
+        varylist = self.traceParameters()
+        targets = self._autoParamTargets()
 
-        steps = self.autoParamRanges()
-        ntraces = 1
-        for p in steps:
-            ntraces = ntraces*len(p)
-        varylist = [[None for x in range(len(params))] for y in range(ntraces)]
-        x = 1
-        for iset, step_set in enumerate(steps):
-            for itrace in range(ntraces):
-                idx = (itrace / x) % len(step_set)
-                varylist[itrace][iset] = step_set[idx]
-            x = x*len(step_set)
-        # now create the stimuli according to steps
         # go through list of modifing parameters, update this stimulus,
         # and then save current state to list
         stim_list = []
-        for itrace in range(ntraces):
-            for ip, param in enumerate(params):
-                for component in param['selection']:
-                    # print 'setting component {} parameter {} to {}'.format(component.name, param['parameter'], varylist[itrace][ip])
-                    
-                    # so I encountered a bug when the parameters were dragged the
-                    # pickling/unpickling seems to either make a copy or somehow
-                    # otherwise loose connection to the original components
-                    # make sure to be setting the components that are in this model.
-                    index = self.indexByComponent(component)
-                    component = self.component(*index)
-
-                    component.set(param['parameter'], varylist[itrace][ip])
-            # copy of current stim state, or go ahead and turn it into a signal?
-            # so then would I want to formulate some doc here as well?
+        for values in varylist:
+            self._applyTraceParameters(targets, values)
             stim_list.append(func(*args))
 
         # now reset the components to start value
-        for ip, param in enumerate(params):
-            for component in param['selection']:
-                component.set(param['parameter'], varylist[0][ip])
+        self._applyTraceParameters(targets, varylist[0])
 
         return stim_list
 
@@ -462,24 +642,162 @@ class StimulusModel():
         logger = logging.getLogger('main')
         logger.debug("Generating Expanded Stimulus")
 
-        # 3 loops now -- could be done in one...
-        signals = self.expandFunction(self.signal)
-        docs = self.expandFunction(self.componentDoc)
-        overloads = []
-        for s, d in zip(signals, docs):
-            d['overloaded_attenuation'] = s[2]
-            overloads.append(s[2])
+        # signal and doc are generated together, in a single pass through the traces.
+        # If intensity only scales the whole signal, each combination of the
+        # other parameters is rendered once, and the other intensities are
+        # derived from it
+        varylist = self.traceParameters()
+        targets = self._autoParamTargets()
+        axis = self._amplitudeAxis()
+        renders = [] # (mixed signal, to speaker, intensity rendered at)
+        render_index = {}
+        trace_renders = [] # (index into renders, intensity of trace)
+        docs = []
+        for itrace, values in enumerate(varylist):
+            self._applyTraceParameters(targets, values)
+            key = self._renderKey(itrace, values, axis)
+            if key not in render_index:
+                render_index[key] = len(renders)
+                signal, to_speaker = self._mixedSignal()
+                renders.append((signal, to_speaker, self._axisValue(values, axis)))
+            trace_renders.append((render_index[key], self._axisValue(values, axis)))
+            docs.append(self.componentDoc())
+        # now reset the components to start value
+        self._applyTraceParameters(targets, varylist[0])
+
+        # calibrate all the renders that go to the speaker together
+        to_calibrate = [i for i, render in enumerate(renders) if render[1]]
+        calfilter = self.calibrationFilter()
+        if calfilter is not None and len(to_calibrate) > 0:
+            filtered = calfilter.applyStack([renders[i][0] for i in to_calibrate])
+            for i, sig in zip(to_calibrate, filtered):
+                renders[i] = (sig,) + renders[i][1:]
 
-        # remove the undesired attenuation argument
-        signals = [sig[0:2] for sig in signals]
+        signals = []
+        overloads = []
+        for (irender, level), doc in zip(trace_renders, docs):
+            signal, to_speaker, render_level = renders[irender]
+            # the filter is linear, so scaling after calibration is the same as before.
+            # Always a new array, as renders may be shared between traces
+            signal = signal * (10 ** (float(level - render_level)/20))
+            signal, atten, overload = self._limitSignal(signal, to_speaker)
+            doc['overloaded_attenuation'] = overload
+            signals.append((signal, atten))
+            overloads.append(overload)
 
         if self.reorder:
-            order = self.reorder(docs)
+            order = self.expandedOrder(docs)
             signals = [signals[i] for i in order]
             docs = [docs[i] for i in order]
 
         return signals, docs, overloads
 
+    def _amplitudeAxis(self):
+        """Finds an auto-parameter that only changes the amplitude of the 
+        whole summed signal: an intensity parameter that selects every 
+        component, where all the components scale linearly with intensity
+        (see :attr:`AbstractStimulusComponent.linear_intensity<sparkle.stim.abstract_component.AbstractStimulusComponent.linear_intensity>`)
+
+        :returns: int -- index of the auto-parameter, None if there is not one
+        """
+        params = self._autoParams.allData()
+        intensity_params = [i for i, p in enumerate(params) if p['parameter'] == 'intensity']
+        if len(intensity_params) != 1:
+            return None
+        axis = intensity_params[0]
+        selection = params[axis]['selection']
+        for track in self._segments:
+            for component in track:
+                if not component.linear_intensity:
+                    return None
+                # silence is all zeros, at any intensity
+                if component.name != 'silence' and component not in selection:
+                    return None
+        return axis
+
+    def _renderKey(self, itrace, values, axis):
+        """Traces with the same key differ only by amplitude"""
+        if axis is None:
+            return itrace
+        return tuple(values[:axis] + values[axis+1:])
+
+    def _axisValue(self, values, axis):
+        """The intensity of a trace on the amplitude axis, 0 if there isn't one"""
+        if axis is None:
+            return 0
+        return values[axis]
+
+    def _signalAndDoc(self):
+        """The signal and the component doc for the current state of this stimulus
+
+        :returns: (numpy.ndarray, float, float), dict -- see :meth:`signal` and :meth:`componentDoc`
+        """
+        return self.signal(), self.componentDoc()
+
+    def expandedOrder(self, docs):
+        """The order the expanded traces are to be presented in
+
+        :param docs: component docs for each trace, in expanded order
+        :type docs: list<dict>
+        :returns: list<int> -- trace indexes, in presentation order
+        """
+        if self.reorder:
+            return self.reorder(docs)
+        return range(len(docs))
+
+    def expandedTrace(self, itrace):
+        """Renders a single trace of the expanded stimulus, leaving the 
+        components as they were found
+
+        :param itrace: index of the trace, in expanded (un-reordered) order
+        :type itrace: int
+        :returns: (numpy.ndarray, float), dict, float -- the signal and attenuation, its doc, undesired attenuation (dB)
+        """
+        steps = self.autoParamRanges()
+        targets = self._autoParamTargets()
+        self._applyTraceParameters(targets, self._traceValues(itrace, steps))
+        try:
+            (signal, atten, overload), doc = self._signalAndDoc()
+        finally:
+            self._applyTraceParameters(targets, self._traceValues(0, steps))
+        doc['overloaded_attenuation'] = overload
+        return (signal, atten), doc, overload
+
+    def iterExpandedStim(self):
+        """Streaming version of :meth:`expandedStim`. Only the docs are 
+        expanded up front, signals are rendered one at a time as the 
+        generator is advanced, so memory use does not grow with the 
+        number of traces.
+
+        :returns: generator of ((numpy.ndarray, float), dict, float) -- the signal and attenuation, its doc, undesired attenuation (dB), in presentation order
+        """
+        docs = self.expandFunction(self.componentDoc)
+        order = self.expandedOrder(docs)
+        steps = self.autoParamRanges()
+        targets = self._autoParamTargets()
+        # re-use the previous trace's rendering, if it differs only in intensity
+        axis = self._amplitudeAxis()
+        last_key = None
+        try:
+            for itrace in order:
+                values = self._traceValues(itrace, steps)
+                self._applyTraceParameters(targets, values)
+                key = self._renderKey(itrace, values, axis)
+                if key != last_key:
+                    render, to_speaker = self._mixedSignal()
+                    if to_speaker:
+                        render = self._calibrate(render)
+                    render_level = self._axisValue(values, axis)
+                    last_key = key
+                scale = 10 ** (float(self._axisValue(values, axis) - render_level)/20)
+                signal, atten, overload = self._limitSignal(render * scale, to_speaker)
+                doc = docs[itrace]
+                doc['overloaded_attenuation'] = overload
+                yield (signal, atten), doc, overload
+        finally:
+            # now reset the components to start value
+            self._applyTraceParameters(targets, self._traceValues(0, steps))
+
     def templateDoc(self):
         """JSON serializable template to will all necessary details to recreate this 
         stimulus in another session.
@@ -573,6 +891,17 @@ class StimulusModel():
         :type force_fs: int
         :returns: numpy.ndarray -- voltage signal for this stimulus
         """
+        total_signal, to_speaker = self._mixedSignal(force_fs)
+        if to_speaker:
+            total_signal = self._calibrate(total_signal)
+        return self._limitSignal(total_signal, to_speaker)
+
+    def _mixedSignal(self, force_fs=False):
+        """The sum of the components, before calibration
+
+        :param force_fs: see :meth:`signal`
+        :returns: numpy.ndarray, bool -- the summed signal, and whether it is output to the speaker (and so needs calibration)
+        """
         assert None not in self.voltage_limits, 'Max voltage level not set'
         if force_fs:
             samplerate = force_fs
@@ -581,23 +910,22 @@ class StimulusModel():
         track_signals = []
         max_db = max([comp.intensity() for t in self._segments for comp in t])
         # atten = self.caldb - max_db
-        atten = 0
         # if max_db > self.caldb:
         #     raise Exception("Stimulus intensity over maxium")
         # print 'caldb:', self.caldb, 'max db:', max_db, 'atten:', atten, 'calv', self.calv
         for track in self._segments:
             track_list = []
             for component in track:
-                track_list.append(component.signal(fs=samplerate, 
-                                                   atten=0, 
-                                                   caldb=self.caldb, 
-                                                   calv=self.calv))
+                track_list.append(component.cachedSignal(fs=samplerate, 
+                                                         atten=0, 
+                                                         caldb=self.caldb, 
+                                                         calv=self.calv))
             if len(track_list) > 0:   
                 track_signals.append(np.hstack(track_list))
 
         # track_signals = sorted(track_signals, key=len, reverse=True)
         full_len = len(max(track_signals, key=len))
-        total_signal = np.zeros((full_len,))
+        total_signal = np.zeros((full_len,), dtype=signal_dtype())
         for track in track_signals:
             total_signal[0:len(track)] += track
 
@@ -606,13 +934,30 @@ class StimulusModel():
         component_names = list(set([comp.name for track in self._segments for comp in track]))
         if 'silence' in component_names:
             component_names.remove('silence')
-        if len(component_names) > 1 or (len(component_names) == 1 and component_names[0] != "Square Wave"):
-            total_signal = convolve_filter(total_signal, self.impulseResponse)
+        to_speaker = len(component_names) > 1 or (len(component_names) == 1 and component_names[0] != "Square Wave")
+        return total_signal, to_speaker
+
+    def _calibrate(self, total_signal):
+        """Applies the calibration filter, if there is one, to a summed signal"""
+        calfilter = self.calibrationFilter()
+        if calfilter is None:
+            return total_signal
+        return calfilter.apply(total_signal)
+
+    def _limitSignal(self, total_signal, to_speaker):
+        """Scales a (calibrated) signal into the allowed output voltage range
+
+        :param total_signal: summed signal, see :meth:`_mixedSignal`
+        :type total_signal: numpy.ndarray
+        :param to_speaker: whether the signal is output to the speaker
+        :type to_speaker: bool
+        :returns: numpy.ndarray, float, float -- see :meth:`signal`
+        """
+        atten = 0
+        if to_speaker:
             maxv = self.voltage_limits[0]
-            to_speaker = True
         else:
             maxv = self.voltage_limits[1]
-            to_speaker = False
 
         # last sample should always go to 0, so output isn't stuck on some
         # other value when stim ends
@@ -717,7 +1062,8 @@ class StimulusModel():
 
         :returns: str -- warning message, if any, 0 otherwise
         """
-        signals, docs, overs = self.expandedStim()
+        # only the overloads are needed, so don't hold on to the signals
+        overs = [over for trace, doc, over in self.iterExpandedStim()]
         if np.any(np.array(overs) > 0):
             msg = 'Stimuli in this test are over the maximum allowable \
                 voltage output. They will be rescaled with a maximum \
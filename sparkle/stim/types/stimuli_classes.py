@@ -7,12 +7,13 @@ import yaml
 from scipy.signal import chirp, hann, square, butter, lfilter, buttord
 
 from sparkle.stim.abstract_component import AbstractStimulusComponent
-from sparkle.tools.audiotools import audiorate, audioread, make_tone, make_carrier_tone, signal_amplitude
+from sparkle.tools.audiotools import audiolength, audiorate, audioread, make_tone, make_carrier_tone, signal_amplitude
 from sparkle.tools.exceptions import FileDoesNotExistError
 
 
 class PureTone(AbstractStimulusComponent):
     name = "Pure Tone"
+    linear_intensity = True
     explore = True
     protocol = True
     _frequency = 5000
@@ -53,6 +54,7 @@ class PureTone(AbstractStimulusComponent):
 
 class SquareWave(PureTone):
     name = "Square Wave"
+    linear_intensity = False
     _frequency = 50
     _amplitude = 1
     _risefall = 0
@@ -126,6 +128,7 @@ class SquareWave(PureTone):
 
 class FMSweep(AbstractStimulusComponent):
     name = "FM Sweep"
+    linear_intensity = True
     _start_f = 5000
     _stop_f = 1e5
     explore = True
@@ -178,6 +181,7 @@ class FMSweep(AbstractStimulusComponent):
 
 class Vocalization(AbstractStimulusComponent):
     name = "Vocalization"
+    linear_intensity = True
     explore = True
     protocol = True
     _filename = None
@@ -231,13 +235,21 @@ class Vocalization(AbstractStimulusComponent):
         if fname is not None:
             self._filename = fname
 
-            fs, wavdata = audioread(self._filename)
+            fs = audiorate(self._filename)
+            npts = audiolength(self._filename)
 
             # round to the nearest ms
-            duration = np.trunc((float(len(wavdata)) / fs) * 1000) / 1000
+            duration = np.trunc((float(npts) / fs) * 1000) / 1000
 
             self._duration = duration
 
+    def sourceStamp(self):
+        if self._filename is None or not self._findFile():
+            return None
+        path = os.path.abspath(self._filename)
+        stat = os.stat(path)
+        return (path, stat.st_mtime, stat.st_size)
+
     def _findFile(self):
         if os.path.isfile(self._filename):
             return True
@@ -309,6 +321,7 @@ class Vocalization(AbstractStimulusComponent):
 
 class WhiteNoise(AbstractStimulusComponent):
     name = "White Noise"
+    linear_intensity = True
     explore = True
     protocol = True
     # keeps signal same to subsequent signal() calls
@@ -336,6 +349,7 @@ class WhiteNoise(AbstractStimulusComponent):
 
 class Silence(AbstractStimulusComponent):
     name = "silence"
+    linear_intensity = True
     protocol = True
     _risefall = 0
     _intensity = 0
@@ -1,7 +1,6 @@
 from __future__ import division
 
 import os
-import wave
 
 import numpy as np
 import scipy.io.wavfile as wv
@@ -10,11 +9,16 @@ from matplotlib import mlab
 from scipy.interpolate import interp1d
 from scipy.signal import fftconvolve, hann
 
+from sparkle.stim.signal_cache import SignalCache
+
 VERBOSE = False
 
 with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.conf'), 'r') as yf:
     config = yaml.load(yf)
 USE_RMS = config['use_rms']
+# most decoded audio kept by audioread (bytes); memory-mapped files count
+# their mapped size, so the number of files held open is bounded too
+AUDIO_CACHE_BYTES = config.get('audio_cache_mb', 256)*2**20
 
 
 def calc_db(peak, refval, mphonecaldb=0):
@@ -291,10 +295,17 @@ def convolve_filter(signal, impulse_response):
         return signal
 
 
-def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14, db=True):
+def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14, db=True, minimum_phase=False):
     """
     Calculate filter kernel from attenuation vector.
-    Attenuation vector should represent magnitude frequency response of system
+    Attenuation vector should represent magnitude frequency response of system.
+
+    By default the kernel is linear phase, which delays the signal by half
+    the kernel length. A minimum phase kernel has (close to) the same
+    magnitude response, but its energy is at the start, so it can be made
+    much shorter with little error and adds almost no delay. Use 
+    :func:`kernel_error` to measure how far a short kernel departs from the
+    full length one.
     
     :param genrate: The generation samplerate at which the test signal was played
     :type genrate: int
@@ -308,6 +319,8 @@ def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14
     :type filter_len: int
     :param db: whether the fresponse given is the a vector of multiplication or decibel factors
     :type db: bool
+    :param minimum_phase: whether to design a minimum phase kernel, rather than linear phase. Output filtered by a minimum phase kernel should not be shifted back by half the kernel length
+    :type minimum_phase: bool
     :returns: numpy.ndarray -- the impulse response
     """
 
@@ -331,6 +344,9 @@ def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14
 
     freq_response = freq_response[:fmax]
 
+    if minimum_phase:
+        return _minimum_phase_kernel(freq_response, filter_len)
+
     impulse_response = np.fft.irfft(freq_response)
 
     # rotate to create causal filter, and truncate
@@ -348,6 +364,53 @@ def impulse_response(genrate, fresponse, frequencies, frange, filter_len=2 ** 14
     return impulse_response
 
 
+def _minimum_phase_kernel(freq_response, filter_len):
+    """Minimum phase impulse response with the given magnitude response,
+    by folding the real cepstrum, truncated to *filter_len* with a
+    tapered tail"""
+    nfft = 2 * (len(freq_response) - 1)
+    log_magnitude = np.log(np.maximum(np.abs(freq_response), 1e-10))
+    cepstrum = np.fft.irfft(log_magnitude, nfft)
+    folded = np.zeros_like(cepstrum)
+    folded[0] = cepstrum[0]
+    folded[1:nfft // 2] = 2 * cepstrum[1:nfft // 2]
+    folded[nfft // 2] = cepstrum[nfft // 2]
+    impulse_response = np.fft.irfft(np.exp(np.fft.rfft(folded)), nfft)
+    impulse_response = impulse_response[:filter_len]
+
+    # taper the end only, the start is where the energy is
+    taper_len = max(len(impulse_response) // 20, 1)
+    impulse_response[-taper_len:] *= hann(2 * taper_len)[taper_len:]
+    return impulse_response
+
+
+def kernel_error(kernel, reference, genrate, frange):
+    """
+    The largest difference in magnitude response, within a frequency range,
+    between a filter kernel and a reference kernel, e.g. a shortened kernel
+    against the full length kernel made from the same calibration
+
+    :param kernel: filter kernel to evaluate
+    :type kernel: numpy.ndarray
+    :param reference: kernel it is meant to approximate
+    :type reference: numpy.ndarray
+    :param genrate: samplerate the kernels are for
+    :type genrate: int
+    :param frange: the min and max frequencies to compare over
+    :type frange: (int, int)
+    :returns: float -- maximum absolute difference (dB)
+    """
+    nfft = 2 ** int(np.ceil(np.log2(max(len(kernel), len(reference)))) + 1)
+    freqs = np.arange(nfft // 2 + 1) * genrate / nfft
+    band = (freqs >= frange[0]) & (freqs <= frange[1])
+    if not np.any(band):
+        return 0.
+    floor = 1e-10
+    kernel_db = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(kernel, nfft)[band]), floor))
+    reference_db = 20 * np.log10(np.maximum(np.abs(np.fft.rfft(reference, nfft)[band]), floor))
+    return float(np.max(np.abs(kernel_db - reference_db)))
+
+
 def attenuation_curve(signal, resp, fs, calf, smooth_pts=99):
     """
     Calculate an attenuation roll-off curve, from a signal and its recording
@@ -482,8 +545,49 @@ def tukey(winlen, alpha):
     return win
 
 
+# decoded audio shared by all readers, least recently used dropped first,
+# {(path, mtime, size): (samplerate, data)}. Audio from before a file was
+# modified is no longer asked for, so it is the first to go
+_audio_cache = SignalCache(AUDIO_CACHE_BYTES)
+
+
+def _read_audio_file(filename):
+    """Decodes an audio file, memory-mapping the samples when the format allows"""
+    if '.wav' in filename.lower():
+        try:
+            fs, signal = wv.read(filename, mmap=True)
+        except ValueError:
+            # formats scipy cannot map (e.g. 24 bit) are read into memory
+            fs, signal = wv.read(filename)
+    elif '.call' in filename.lower():
+        signal = np.memmap(filename, dtype=np.int16, mode='r')
+        fs = 333333
+    else:
+        raise IOError("Unsupported audio format for file: {}".format(filename))
+    return fs, signal
+
+
+def _cached_audio(filename):
+    """Gets the samplerate and (raw, read-only) samples of an audio file from
+    the shared store, decoding the file only if it is new or was modified
+    since it was last read
+    """
+    if '.wav' not in filename.lower() and '.call' not in filename.lower():
+        raise IOError("Unsupported audio format for file: {}".format(filename))
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    return _audio_cache.get((path, stat.st_mtime, stat.st_size),
+                            lambda: _read_audio_file(path))
+
+
+def clear_audio_cache():
+    """Drops all decoded audio held by :func:`audioread`"""
+    _audio_cache.clear()
+
+
 def audioread(filename):
-    """Reads an audio signal from file.
+    """Reads an audio signal from file. Decoded files are kept (memory-mapped
+    where possible) and re-used until the file is modified
 
     Supported formats : wav
 
@@ -492,14 +596,7 @@ def audioread(filename):
     :returns: int, numpy.ndarray -- samplerate, array containing the audio signal
     """
     try:
-        if '.wav' in filename.lower():
-            fs, signal = wv.read(filename)
-        elif '.call' in filename.lower():
-            with open(filename, 'rb') as f:
-                signal = np.fromfile(f, dtype=np.int16)
-            fs = 333333
-        else:
-            raise IOError("Unsupported audio format for file: {}".format(filename))
+        fs, signal = _cached_audio(filename)
     except:
         print u"Problem reading wav file"
         raise
@@ -514,16 +611,18 @@ def audiorate(filename):
     :type filename: str
     :returns: int -- samplerate of the recording
     """
-    if '.wav' in filename.lower():
-        wf = wave.open(filename)
-        fs = wf.getframerate()
-        wf.close()
-    elif '.call' in filename.lower():
-        fs = 333333
-    else:
-        raise IOError("Unsupported audio format for file: {}".format(filename))
+    return _cached_audio(filename)[0]
+
 
-    return fs
+def audiolength(filename):
+    """Determines the number of samples in the given audio recording file,
+    without copying its contents
+
+    :param filename: filename of the audiofile
+    :type filename: str
+    :returns: int -- number of samples in the recording
+    """
+    return len(_cached_audio(filename)[1])
 
 
 def rms(signal, fs):
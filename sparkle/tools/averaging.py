@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class RepAverage(object):
+    """Running average of repeated responses, which holds only a sum and
+    a count for each sample, rather than every rep.
+
+    :param shape: shape of a single response, e.g. (channels, samples)
+    :type shape: tuple
+    """
+    def __init__(self, shape):
+        self.total = np.zeros(shape)
+        self.counts = np.zeros(shape, dtype=np.int32)
+
+    def add(self, response, rejectrate=None):
+        """Adds a rep to the average
+
+        :param response: recorded response, of the shape given on creation
+        :type response: numpy.ndarray
+        :param rejectrate: If not None, samples at or above this value, on any channel, are left out of the average
+        :type rejectrate: float
+        """
+        if rejectrate is None:
+            self.total += response
+            self.counts += 1
+        else:
+            accepted = response < rejectrate
+            self.total += np.where(accepted, response, 0)
+            self.counts += accepted
+
+    def average(self):
+        """Mean of the samples added so far
+
+        :returns: numpy.ndarray -- the mean, NaN where every rep was rejected
+        """
+        average = np.empty_like(self.total)
+        average.fill(np.nan)
+        np.divide(self.total, self.counts, out=average, where=self.counts > 0)
+        return average
+
+    def reset(self):
+        """Clears the average, for the next set of reps"""
+        self.total.fill(0)
+        self.counts.fill(0)
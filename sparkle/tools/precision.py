@@ -0,0 +1,88 @@
+"""Floating point precision policy for signals held in memory.
+
+Stimulus synthesis, calibration filtering and recorded responses use the
+policy dtype, set by ``signal_dtype`` in settings.conf (float64 by default).
+float32 halves memory and bandwidth, and keeps about 7 significant digits,
+which is far finer than the 16 bit resolution of the DAQ converters. The
+DAQmx driver reads and writes float64, so data is converted at that
+boundary only, by :func:`as_daq`.
+
+Recordings are stored in data files at a dtype of their own, set by
+``storage_dtype`` in settings.conf (float32 by default), so that computing
+at float64 does not double the size of data files.
+"""
+import os
+
+import numpy as np
+import yaml
+
+with open(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings.conf'), 'r') as yf:
+    config = yaml.load(yf)
+
+ALLOWED_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+
+_signal_dtype = np.dtype(config.get('signal_dtype', 'float64'))
+_storage_dtype = np.dtype(config.get('storage_dtype', 'float32'))
+
+
+def signal_dtype():
+    """The dtype for in-memory signals
+
+    :returns: numpy.dtype -- float32 or float64
+    """
+    return _signal_dtype
+
+
+def set_signal_dtype(dtype):
+    """Changes the dtype for in-memory signals, for the whole application
+
+    :param dtype: float32 or float64
+    :type dtype: numpy.dtype or str
+    """
+    global _signal_dtype
+    dtype = np.dtype(dtype)
+    if dtype not in ALLOWED_DTYPES:
+        raise ValueError("Signal dtype must be float32 or float64, not {}".format(dtype))
+    _signal_dtype = dtype
+
+
+def storage_dtype():
+    """The dtype the acquisition runners store recordings at
+
+    :returns: numpy.dtype -- float32 or float64
+    """
+    return _storage_dtype
+
+
+def set_storage_dtype(dtype):
+    """Changes the dtype recordings are stored at, for the whole application
+
+    :param dtype: float32 or float64
+    :type dtype: numpy.dtype or str
+    """
+    global _storage_dtype
+    dtype = np.dtype(dtype)
+    if dtype not in ALLOWED_DTYPES:
+        raise ValueError("Storage dtype must be float32 or float64, not {}".format(dtype))
+    _storage_dtype = dtype
+
+
+def as_signal(data):
+    """Converts data to the policy dtype, without copying if it already is
+
+    :param data: signal
+    :type data: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    return np.asarray(data, dtype=_signal_dtype)
+
+
+def as_daq(data):
+    """Converts data to the contiguous float64 the DAQmx driver requires,
+    without copying if it already is
+
+    :param data: signal to output
+    :type data: numpy.ndarray
+    :returns: numpy.ndarray
+    """
+    return np.ascontiguousarray(data, dtype=np.float64)
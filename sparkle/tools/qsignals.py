@@ -21,6 +21,8 @@ class ProtocolSignals(QtCore.QObject):
     tuning_curve_started = QtCore.Signal(list, list, str)
     tuning_curve_response = QtCore.Signal(int, object, float)
     over_voltage = QtCore.Signal(float)
+    timing_stats = QtCore.Signal(dict)
+    writer_stats = QtCore.Signal(dict)
 
     def iteritems(self):
         return {
@@ -41,6 +43,8 @@ class ProtocolSignals(QtCore.QObject):
         'tuning_curve_started' : self.tuning_curve_started,
         'tuning_curve_response' : self.tuning_curve_response,
         'over_voltage' : self.over_voltage,
+        'timing_stats' : self.timing_stats,
+        'writer_stats' : self.writer_stats,
         }.iteritems()
 
 class TestSignals(QtCore.QObject):
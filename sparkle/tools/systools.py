@@ -1,9 +1,11 @@
 import ctypes
+import ctypes.util
 import os
 import platform
 import random
 import string
 import sys
+import time
 
 APPNAME = 'audiolab'
 
@@ -41,3 +43,46 @@ def get_drives():
 def rand_id():
     chars = string.ascii_uppercase + string.digits
     return ''.join(random.choice(chars) for x in range(4))
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonic_clock():
+    """Finds a clock that is not affected by changes to the system time,
+    falling back to time.time if there isn't one"""
+    if platform.system() == 'Windows':
+        frequency = ctypes.c_int64()
+        ctypes.windll.kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        def qpc():
+            # one per call, so that threads reading the clock at the same
+            # time do not fill in each other's result
+            counter = ctypes.c_int64()
+            ctypes.windll.kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value/float(frequency.value)
+        return qpc
+    # CLOCK_MONOTONIC
+    clock_id = {'Linux': 1, 'Darwin': 6}.get(platform.system())
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        clock_id = None
+    if clock_id is None:
+        return time.time
+    def gettime():
+        # one per call, as for the Windows counter
+        timespec = _Timespec()
+        clock_gettime(clock_id, ctypes.byref(timespec))
+        return timespec.tv_sec + timespec.tv_nsec*1e-9
+    return gettime
+
+_clock = _monotonic_clock()
+
+def monotonic():
+    """Seconds from an arbitrary start, that only ever increase at a steady
+    rate, for measuring intervals. Unlike time.time, it does not jump when
+    the system clock is adjusted
+
+    :returns: float -- seconds
+    """
+    return _clock()
@@ -0,0 +1,62 @@
+"""Measures the software overhead of finite acquisition for each of the
+player's task modes, on the simulated device, so it can be run without
+hardware. The simulation loops the output back with noise and spikes, so
+the data is as costly to handle as a real recording.
+"""
+
+import time
+
+import numpy as np
+
+from sparkle.acq import daq_tasks, daqmx_stub
+from sparkle.acq.daqmx_stub import simulation
+from sparkle.acq.players import FinitePlayer
+
+############################################################
+# Edit these values as desired
+
+fs = 5e5 # input and output samplerate
+dur = 0.2 # duration of signal and window (seconds)
+interval = 0.25 # time between reps, for the hardware rep clock (seconds)
+nreps = 20
+time_scale = 0.1 # run the simulated device this much faster than real time
+
+############################################################
+
+def run_reps(player):
+    player.set_stim(np.sin(2*np.pi*5000*np.arange(int(fs*dur))/fs), fs)
+    player.set_aidur(dur)
+    player.set_aifs(fs)
+    player.set_aichan("PCI-6259/ai16")
+    player.set_aochan("PCI-6259/ao2")
+    player.start()
+    t0 = time.time()
+    for irep in range(nreps):
+        player.run()
+        player.reset()
+    elapsed = time.time() - t0
+    player.stop()
+    return elapsed
+
+if __name__ == '__main__':
+    if daq_tasks.Task is not daqmx_stub.Task:
+        raise SystemExit("Device drivers are installed, benchmark runs on the simulated device only")
+
+    simulation.configure(time_scale=time_scale, loopback=True, delay=0.001,
+                         noise=0.005, spike_rate=20, seed=0)
+    modes = [('new tasks each rep', FinitePlayer()),
+             ('persistent tasks', FinitePlayer(persistent=True))]
+    clocked = FinitePlayer()
+    clocked.set_rep_clock(1./interval)
+    modes.append(('hardware rep clock', clocked))
+
+    print 'window {}s, {} reps, time scale {}'.format(dur, nreps, time_scale)
+    for name, player in modes:
+        elapsed = run_reps(player)
+        if player is clocked:
+            device_time = (interval*(nreps-1) + dur)*time_scale
+        else:
+            device_time = dur*nreps*time_scale
+        print '{:>20}: {:.3f}s, {:.2f}ms overhead per rep'.format(name, elapsed,
+                                                                (elapsed - device_time)*1000/nreps)
+    print 'spikes injected', simulation.spikes_injected
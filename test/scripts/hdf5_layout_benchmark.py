@@ -0,0 +1,87 @@
+"""Compares the storage layouts of protocol data: write throughput, file
+size, and the time to read back a single rep at random, as in data review.
+The data is the simulated device's recording of a tone, with noise and
+spikes, so it compresses as a real recording would.
+"""
+
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from sparkle.acq.daqmx_stub import DeviceSimulation
+from sparkle.data.hdf5data import HDF5Data, remove_backup
+
+############################################################
+# Edit these values as desired
+
+fs = 5e5 # input samplerate
+dur = 0.2 # duration of window (seconds)
+ntraces = 10
+nreps = 10
+nchans = 1
+nreads = 50 # number of random reps to read back
+
+layouts = [('contiguous', {}),
+           ('chunked', {'chunks': 'write'}),
+           ('shuffle + lzf', {'compression': 'lzf', 'shuffle': True}),
+           ('shuffle + gzip 4', {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}),
+           ]
+
+############################################################
+
+def recorded_reps():
+    """One trace's worth of reps, which are written again for every trace"""
+    npts = int(fs*dur)
+    simulation = DeviceSimulation()
+    simulation.configure(loopback=True, noise=0.005, spike_rate=20, seed=0)
+    simulation.outputs['Dev'] = (0.1*np.sin(2*np.pi*5000*np.arange(npts)/fs), fs)
+    return [simulation.acquire('Dev', nchans, npts, fs, 0).astype(np.float32)
+            for irep in range(nreps)]
+
+def write_file(fname, layout, reps):
+    datafile = HDF5Data(fname)
+    datafile.set_layout(**layout)
+    npts = reps[0].shape[-1]
+    datafile.init_data('segment_1', dims=(ntraces, nreps, nchans, npts), mode='finite')
+    t0 = time.time()
+    for itrace in range(ntraces):
+        for rep in reps:
+            datafile.append('segment_1', rep)
+    # include the time to get the data to disk
+    datafile.hdf5.flush()
+    elapsed = time.time() - t0
+    datafile.close()
+    return elapsed
+
+def read_reps(fname):
+    datafile = HDF5Data(fname, filemode='r')
+    rng = np.random.RandomState(0)
+    latencies = []
+    for iread in range(nreads):
+        index = (rng.randint(ntraces), rng.randint(nreps))
+        t0 = time.time()
+        datafile.get_data('segment_1/test_1', index)
+        latencies.append(time.time() - t0)
+    datafile.close()
+    return np.median(latencies), np.max(latencies)
+
+if __name__ == '__main__':
+    reps = recorded_reps()
+    nbytes = ntraces*nreps*reps[0].nbytes
+    tempdir = tempfile.mkdtemp()
+    print '{} traces x {} reps x {} chans x {} samples, {:.1f}MB'.format(ntraces, nreps, nchans,
+                                                                          reps[0].shape[-1], nbytes/1e6)
+    print '{:>18} {:>10} {:>10} {:>16} {:>13}'.format('layout', 'write MB/s', 'size MB',
+                                                    'read median ms', 'read max ms')
+    for name, layout in layouts:
+        fname = os.path.join(tempdir, 'layout_benchmark.hdf5')
+        elapsed = write_file(fname, layout, reps)
+        size = os.path.getsize(fname)
+        median, longest = read_reps(fname)
+        print '{:>18} {:>10.1f} {:>10.2f} {:>16.3f} {:>13.3f}'.format(name, nbytes/elapsed/1e6, size/1e6,
+                                                                  median*1000, longest*1000)
+        os.remove(fname)
+        remove_backup(fname)
+    os.rmdir(tempdir)
@@ -0,0 +1,110 @@
+import time
+import unittest
+
+import numpy as np
+
+from sparkle.acq import daq_tasks, daqmx_stub
+from sparkle.acq.daqmx_stub import simulation
+from sparkle.acq.players import FinitePlayer
+from sparkle.tools.spikestats import spike_times
+
+DEVNAME = "PCI-6259"
+
+class TestDeviceSimulation():
+    def setUp(self):
+        if daq_tasks.Task is not daqmx_stub.Task:
+            raise unittest.SkipTest("Device drivers are installed, not simulating")
+
+    def tearDown(self):
+        simulation.reset()
+
+    def test_finite_timing(self):
+        fs = 100000
+        dur = 0.1
+        for scale in [1., 0.1]:
+            simulation.configure(time_scale=scale)
+            player = self.create_player(np.zeros((int(fs*dur),)), fs, dur)
+            player.start()
+            t0 = time.time()
+            player.run()
+            elapsed = time.time() - t0
+            player.stop()
+            assert dur*scale <= elapsed < dur*scale + 0.05, elapsed
+
+    def test_loopback_delay(self):
+        fs = 100000
+        dur = 0.02
+        delay = 0.001
+        simulation.configure(loopback=True, delay=delay, time_scale=0)
+        stim = np.sin(2*np.pi*1000*np.arange(int(fs*dur))/fs)
+        player = self.create_player(stim, fs, dur)
+        player.start()
+        response = player.run().squeeze()
+        player.stop()
+
+        shift = int(delay*fs)
+        np.testing.assert_array_almost_equal(response[:shift], 0)
+        np.testing.assert_array_almost_equal(response[shift:], stim[:-shift])
+
+    def test_noise_repeatable(self):
+        fs = 100000
+        dur = 0.02
+        responses = []
+        for irun in range(2):
+            simulation.configure(loopback=True, noise=0.01, seed=7, time_scale=0)
+            player = self.create_player(np.zeros((int(fs*dur),)), fs, dur)
+            player.start()
+            responses.append(player.run().squeeze())
+            player.stop()
+
+        np.testing.assert_array_equal(responses[0], responses[1])
+        assert 0.008 < np.std(responses[0]) < 0.012
+
+    def test_spikes_detected(self):
+        fs = 100000
+        dur = 0.5
+        threshold = 0.5
+        simulation.configure(loopback=True, spike_rate=40, spike_amplitude=1.,
+                             seed=3, time_scale=0)
+        player = self.create_player(np.zeros((int(fs*dur),)), fs, dur)
+        player.start()
+        response = player.run().squeeze()
+        player.stop()
+
+        starts = simulation.last_spikes[0]
+        assert len(starts) > 0
+        assert simulation.spikes_injected == len(starts)
+        # spikes may overlap, and then count as one
+        detected = spike_times(response, threshold, fs)
+        assert 0 < len(detected) <= len(starts)
+
+    def test_read_timeout(self):
+        fs = 10000
+        simulation.configure(time_scale=0)
+        task = daq_tasks.AITaskFinite(DEVNAME+"/ai16", fs, 20*fs)
+        task.StartTask()
+        try:
+            task.read(timeout=10.0)
+        except daqmx_stub.DAQError:
+            pass
+        else:
+            assert False, "no error reading past the timeout"
+        task.StopTask()
+
+    def test_long_batch(self):
+        # 20 reps at 1s, longer than a single read's default timeout
+        fs = 10000
+        dur = 0.01
+        simulation.configure(time_scale=0)
+        player = self.create_player(np.zeros((int(fs*dur),)), fs, dur)
+        responses = player.run_batch(20, 1.)
+        assert responses.shape == (20, 1, int(fs*dur))
+
+    def create_player(self, stim, fs, dur):
+        player = FinitePlayer()
+        player.set_stim(stim, fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs)
+        player.set_aichan(DEVNAME+"/ai16")
+        player.set_aochan(DEVNAME+"/ao2")
+        return player
@@ -1,8 +1,10 @@
+import time
 import unittest
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from sparkle.acq import daq_tasks, daqmx_stub
 from sparkle.acq.players import ContinuousPlayer, FinitePlayer
 
 DEVNAME = "PCI-6259"
@@ -137,8 +139,174 @@ class TestDAQPlayers():
         assert nstims == 1
         assert len(self.data) > 1
 
-    def run_finite(self, infs, indur, outfs, outdur, amp=2.0, nchans=1):
+    def test_persistent_matches_finite(self):
+        fs = 500000
+        dur = 0.01
+        stim, response = self.run_finite(fs, dur, fs, dur)
+        stim, persistent_response = self.run_finite(fs, dur, fs, dur, persistent=True)
+        np.testing.assert_array_equal(response, persistent_response)
+
+    def test_persistent_task_reuse(self):
+        if daq_tasks.Task is not daqmx_stub.Task:
+            raise unittest.SkipTest("Driver calls counted by stub backend only")
+        fs = 500000
+        dur = 0.01
+        nreps = 5
+        tone = data_func(fs*dur, 5, 2.0)
+
+        counts = {}
+        reset_times = {}
+        for persistent in [False, True]:
+            daqmx_stub.call_counts.clear()
+            player = FinitePlayer(persistent)
+            player.set_stim(tone, fs)
+            player.set_aidur(dur)
+            player.set_aifs(fs)
+            player.set_aichan(DEVNAME+"/ai16")
+            player.set_aochan(DEVNAME+"/ao2")
+            new_stim = player.start()
+            assert new_stim is tone
+            reset_times[persistent] = []
+            for irep in range(nreps):
+                player.run()
+                t0 = time.time()
+                new_stim = player.reset()
+                reset_times[persistent].append(time.time() - t0)
+                assert new_stim is None
+            counts[persistent] = dict(daqmx_stub.call_counts)
+
+            # a new stimulus is written, without re-creating the tasks
+            player.run()
+            player.set_stim(tone*0.5, fs)
+            new_stim = player.reset()
+            player.run()
+            player.stop()
+            assert new_stim is not None
+            if persistent:
+                assert daqmx_stub.call_counts['CreateAOVoltageChan'] == 1
+                assert daqmx_stub.call_counts['WriteAnalogF64'] == 2
+        print 'mean reset time {:.6f}s persistent {:.6f}s'.format(np.mean(reset_times[False]),
+                                                                 np.mean(reset_times[True]))
+
+        assert counts[False]['CreateAOVoltageChan'] == nreps + 1
+        assert counts[False]['CreateAIVoltageChan'] == nreps + 1
+        assert counts[False]['WriteAnalogF64'] == nreps + 1
+        assert counts[True]['CreateAOVoltageChan'] == 1
+        assert counts[True]['CreateAIVoltageChan'] == 1
+        assert counts[True]['WriteAnalogF64'] == 1
+
+    def test_persistent_settings_change(self):
+        fs = 500000
+        dur = 0.01
+        player = FinitePlayer(persistent=True)
+        player.set_stim(data_func(fs*dur, 5, 2.0), fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs)
+        player.set_aichan(DEVNAME+"/ai16")
+        player.set_aochan(DEVNAME+"/ao2")
+        player.start()
+        response = player.run()
+        assert response.shape[-1] == fs*dur
+
+        # a longer window and stimulus need new tasks
+        player.set_aidur(dur*2)
+        player.set_stim(data_func(fs*dur*2, 5, 2.0), fs)
+        player.reset()
+        response = player.run()
+        player.stop()
+        assert response.shape[-1] == fs*dur*2
+
+    def test_batch_reps(self):
+        fs = 500000
+        dur = 0.01
+        nreps = 4
+        player = FinitePlayer()
+        tone = data_func(fs*dur, 5, 2.0)
+        player.set_stim(tone, fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs/2)
+        player.set_aichan([DEVNAME+"/ai0", DEVNAME+"/ai1"])
+        player.set_aochan(DEVNAME+"/ao2")
+        responses = player.run_batch(nreps, dur*1.5)
+
+        assert responses.shape == (nreps, 2, fs*dur/2)
+        # split from the one acquisition buffer, without copying
+        assert responses.base is not None
+        assert player.aitask is None
+        assert player.ngenerated == nreps
+
+    def test_batch_reps_interval_too_short(self):
+        fs = 500000
+        dur = 0.01
         player = FinitePlayer()
+        player.set_stim(data_func(fs*dur, 5, 2.0), fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs)
+        player.set_aichan(DEVNAME+"/ai16")
+        player.set_aochan(DEVNAME+"/ao2")
+        try:
+            player.run_batch(3, dur/2)
+        except ValueError:
+            pass
+        else:
+            assert False, "no error for overlapping reps"
+
+    def test_rep_clock(self):
+        fs = 500000
+        dur = 0.01
+        nreps = 5
+        period = 0.05
+        player = FinitePlayer()
+        player.set_stim(data_func(fs*dur, 5, 2.0), fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs)
+        player.set_aichan(DEVNAME+"/ai16")
+        player.set_aochan(DEVNAME+"/ao2")
+        player.set_rep_clock(1./period)
+        player.start()
+        stamps = []
+        for irep in range(nreps):
+            response = player.run()
+            stamps.append(time.time())
+            assert response.shape[-1] == fs*dur
+            player.reset()
+        clock = player.clock
+        player.stop()
+
+        assert clock is not None
+        assert player.clock is None
+        assert player.nacquired == nreps
+        if daq_tasks.Task is daqmx_stub.Task:
+            # reps are spaced by the counter, not by the loop
+            spacing = np.diff(stamps)
+            assert np.all(abs(spacing - period) < period/4), spacing
+
+    def test_rep_clock_stim_change(self):
+        if daq_tasks.Task is not daqmx_stub.Task:
+            raise unittest.SkipTest("Driver calls counted by stub backend only")
+        fs = 500000
+        dur = 0.01
+        player = FinitePlayer()
+        player.set_stim(data_func(fs*dur, 5, 2.0), fs)
+        player.set_aidur(dur)
+        player.set_aifs(fs)
+        player.set_aichan(DEVNAME+"/ai16")
+        player.set_aochan(DEVNAME+"/ao2")
+        player.set_rep_clock(50)
+        player.start()
+        player.run()
+        player.reset()
+        assert player.clock is not None
+        # the clock is stopped while the output is rewritten
+        player.set_stim(data_func(fs*dur, 5, 1.0), fs)
+        player.reset()
+        assert player.clock is None
+        player.run()
+        assert player.clock is not None
+        player.stop()
+
+    def run_finite(self, infs, indur, outfs, outdur, amp=2.0, nchans=1, persistent=False):
+        player = FinitePlayer(persistent)
 
         tone = data_func(outfs*outdur, 5, amp)
         player.set_stim(tone, outfs)
@@ -0,0 +1,86 @@
+import numpy as np
+from nose.tools import assert_equal, raises
+
+from sparkle.acq.daq_tasks import AITask
+from sparkle.acq.ring_buffer import RingBuffer
+
+
+def fill(ring, value):
+    ring.write_slot()[:] = value
+    ring.commit()
+
+class TestRingBuffer():
+    def test_read_views(self):
+        ring = RingBuffer(4, 2, 10)
+        reader = ring.reader()
+        fill(ring, 1)
+        fill(ring, 2)
+        assert_equal(reader.available(), 2)
+
+        chunks = reader.read()
+        assert_equal(len(chunks), 1)
+        assert_equal(chunks[0].shape, (2, 2, 10))
+        # no copy
+        assert chunks[0].base is ring._data
+        assert np.all(chunks[0][1] == 2)
+        assert_equal(reader.read(), [])
+
+    def test_wrap_around(self):
+        ring = RingBuffer(4, 1, 5)
+        reader = ring.reader()
+        for value in range(3):
+            fill(ring, value)
+        reader.read()
+        for value in range(3, 6):
+            fill(ring, value)
+        blocks = reader.read_blocks()
+        assert_equal([block[0,0] for block in blocks], [3, 4, 5])
+        assert_equal(reader.dropped, 0)
+        assert_equal(ring.overruns, 0)
+
+    def test_overrun_counted(self):
+        ring = RingBuffer(3, 1, 5)
+        slow = ring.reader()
+        fast = ring.reader()
+        for value in range(6):
+            fill(ring, value)
+            fast.read()
+        blocks = slow.read_blocks()
+        # only nblocks - 1 are kept, the rest dropped
+        assert_equal([block[0,0] for block in blocks], [4, 5])
+        assert_equal(slow.dropped, 4)
+        assert_equal(fast.dropped, 0)
+        assert ring.overruns > 0
+
+    def test_max_blocks(self):
+        ring = RingBuffer(5, 1, 5)
+        reader = ring.reader()
+        for value in range(3):
+            fill(ring, value)
+        assert_equal(len(reader.read_blocks(max_blocks=2)), 2)
+        assert_equal(reader.read_blocks()[0][0,0], 2)
+
+    def test_reader_from_oldest(self):
+        ring = RingBuffer(3, 1, 5)
+        fill(ring, 1)
+        assert_equal(ring.reader().available(), 0)
+        assert_equal(ring.reader(from_oldest=True).available(), 1)
+
+    def test_ai_reads_into_ring(self):
+        npts = 100
+        ring = RingBuffer(4, 2, npts)
+        reader = ring.reader()
+        task = AITask(["PCI-6259/ai0", "PCI-6259/ai1"], 10000, npts*5)
+        task.ring = ring
+        task.n = npts
+        data = task._read()
+        assert_equal(ring.written, 1)
+        assert data.base is ring._data
+        blocks = reader.read_blocks()
+        assert_equal(len(blocks), 1)
+        assert np.any(blocks[0] != 0)
+
+    @raises(ValueError)
+    def test_ai_ring_shape_checked(self):
+        task = AITask(["PCI-6259/ai0", "PCI-6259/ai1"], 10000, 500)
+        task.register_callback(lambda x: x, 100, ring=RingBuffer(4, 1, 100))
@@ -0,0 +1,179 @@
+import glob
+import os
+import random
+import string
+import threading
+import time
+
+import numpy as np
+from nose.tools import assert_equal, raises
+
+from sparkle.data.async_writer import AsyncDataWriter
+from sparkle.data.hdf5data import HDF5Data
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+def rand_id():
+    chars = string.ascii_uppercase + string.digits
+    return ''.join(random.choice(chars) for x in range(4))
+
+class SlowData(object):
+    """Data file that holds each append until released"""
+    def __init__(self, fname):
+        self.data = HDF5Data(fname)
+        self.release = threading.Event()
+
+    def append(self, key, data, nested_name=None):
+        self.release.wait()
+        self.data.append(key, data, nested_name)
+
+    def append_rows(self, key, rows, nested_name=None):
+        self.release.wait()
+        self.data.append_rows(key, rows, nested_name)
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+class TestAsyncDataWriter():
+    def setUp(self):
+        self.fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+
+    def tearDown(self):
+        files = glob.glob(tempfolder + os.sep + '[a-zA-Z0-9_]*.hdf5')
+        for f in files:
+            try:
+                os.remove(f)
+            except:
+                pass
+
+    def test_writes_in_order(self):
+        nreps, npoints = 5, 20
+        acq_data = HDF5Data(self.fname)
+        acq_data.init_data('fake', (2, nreps, npoints))
+        writer = AsyncDataWriter(acq_data)
+        writer.start()
+        row = np.zeros((npoints,))
+        for irep in range(2*nreps):
+            # the caller reuses its array
+            row[:] = irep
+            writer.append('fake', row)
+            if irep == nreps - 1:
+                writer.append_trace_info('fake', {'trace': 0})
+        writer.append_trace_info('fake', {'trace': 1})
+        assert writer.stop() is acq_data
+
+        data = acq_data.get_data('fake/test_1')
+        expected = np.repeat(np.arange(2*nreps), npoints).reshape(2, nreps, npoints)
+        np.testing.assert_array_equal(data, expected)
+        assert_equal(acq_data.get_trace_stim('fake/test_1'), [{'trace': 0}, {'trace': 1}])
+        assert_equal(writer.stats()['queued'], 2*nreps + 2)
+        acq_data.close()
+
+    def test_batches_appends(self):
+        nreps, npoints = 10, 20
+        acq_data = SlowData(self.fname)
+        acq_data.init_data('fake', (nreps, npoints))
+        writer = AsyncDataWriter(acq_data)
+        writer.start()
+        for irep in range(nreps):
+            writer.append('fake', np.ones((npoints,))*irep)
+        # queued while the first write is held up
+        time.sleep(0.05)
+        acq_data.release.set()
+        writer.stop()
+
+        stats = writer.stats()
+        assert_equal(stats['queued'], nreps)
+        assert stats['writes'] < nreps
+        assert stats['max_latency'] >= 0.05
+        np.testing.assert_array_equal(acq_data.get_data('fake/test_1')[:, 0], np.arange(nreps))
+        acq_data.close()
+
+    def test_backpressure(self):
+        npoints = 20
+        acq_data = SlowData(self.fname)
+        acq_data.init_data('fake', (4, npoints))
+        writer = AsyncDataWriter(acq_data, maxsize=2)
+        writer.start()
+        # released while the writer is blocked on a full queue
+        threading.Timer(0.05, acq_data.release.set).start()
+        for irep in range(4):
+            writer.append('fake', np.ones((npoints,)))
+        writer.stop()
+
+        stats = writer.stats()
+        assert stats['max_depth'] <= 2
+        assert stats['blocked_time'] > 0.02
+        acq_data.close()
+
+    def test_reads_wait_for_writes(self):
+        acq_data = HDF5Data(self.fname)
+        acq_data.init_data('fake', (3, 10))
+        writer = AsyncDataWriter(acq_data)
+        writer.start()
+        writer.append('fake', np.ones((10,)))
+        writer.set_metadata('fake', {'note': 'written'})
+        np.testing.assert_array_equal(writer.get_data('fake/test_1')[0], np.ones((10,)))
+        assert_equal(writer.get_info('fake')['note'], 'written')
+        writer.stop()
+        acq_data.close()
+
+    @raises(KeyError)
+    def test_error_raised_on_next_call(self):
+        acq_data = HDF5Data(self.fname)
+        acq_data.init_data('fake', (1, 10))
+        writer = AsyncDataWriter(acq_data)
+        writer.start()
+        try:
+            # not an initialized data set
+            writer.append('notfake', np.ones((10,)))
+            writer.flush()
+        finally:
+            try:
+                writer.stop()
+            finally:
+                acq_data.close()
+
+    def test_error_raised_on_every_call(self):
+        acq_data = HDF5Data(self.fname)
+        acq_data.init_data('fake', (3, 10))
+        writer = AsyncDataWriter(acq_data)
+        # writes queued before the writer thread gets to the bad one
+        writer.append('notfake', np.ones((10,)))
+        writer.append('fake', np.ones((10,)))
+        writer.set_metadata('fake', {'note': 'written'})
+        writer.start()
+        for call in [writer.flush, lambda: writer.append('fake', np.ones((10,))), writer.stop]:
+            try:
+                call()
+            except KeyError:
+                pass
+            else:
+                assert False, "no error after the writer failed"
+        assert_equal(writer.stats()['dropped'], 2)
+        assert 'note' not in acq_data.get_info('fake')
+        acq_data.close()
+
+    def test_read_file_while_written(self):
+        acq_data = HDF5Data(self.fname)
+        acq_data.init_data('fake', (200, 100))
+        writer = AsyncDataWriter(acq_data)
+        writer.start()
+        errors = []
+        def review():
+            # as data review does, on the GUI thread
+            try:
+                for i in range(200):
+                    acq_data.get_data('fake/test_1', (i % 10,))
+                    acq_data.keys()
+            except Exception as error:
+                errors.append(error)
+        reader = threading.Thread(target=review)
+        reader.start()
+        for irep in range(200):
+            writer.append('fake', np.ones((100,))*irep)
+        writer.stop()
+        reader.join()
+        assert_equal(errors, [])
+        np.testing.assert_array_equal(acq_data.get_data('fake/test_1', (199,)), np.ones((100,))*199)
+        acq_data.close()
@@ -5,11 +5,18 @@ import random
 import re
 import string
 
+import multiprocessing
+import threading
+import time
+
 import h5py
 import numpy as np
 from nose.tools import assert_equal, assert_in, raises
 
-from sparkle.data.hdf5data import HDF5Data, recover_data_from_backup, autosave_filenames
+import sparkle.data.hdf5data as hdf5data
+from sparkle.data.hdf5data import REPACK_ATTR, HDF5Data, autosave_filenames, \
+    journal_filenames, journal_is_valid, journal_size, recover_data_from_backup, \
+    repack_file, wait_for_repack
 from sparkle.tools.exceptions import DataIndexError, DisallowedFilemodeError, \
     OverwriteFileError, ReadOnlyError
 
@@ -27,12 +34,29 @@ class TestHDF5Data():
         # delete all data files in temp folder -- this will also clear out past
         # test runs that produced errors and did not delete their files
         files = glob.glob(tempfolder + os.sep + '[a-zA-Z0-9_]*.hdf5')
+        # closed files leave their backup journals behind
+        files += glob.glob(os.path.join(tempfolder, '.backup', '*'))
         for f in files:
             try:
                 os.remove(f)
             except:
                 pass
 
+    def test_init_data_dtype(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+
+        acq_data.init_data('default', (2,), mode='finite')
+        acq_data.init_data('double', (2,), mode='finite', dtype=np.float64)
+        acq_data.init_data('continuous', mode='continuous', dtype=np.float64)
+        acq_data.append('double', np.array([1./3, 2./3]))
+
+        assert_equal(acq_data.hdf5['default/test_1'].dtype, np.float32)
+        assert_equal(acq_data.hdf5['double/test_2'].dtype, np.float64)
+        assert_equal(acq_data.hdf5['continuous_set1'].dtype, np.float64)
+        assert_equal(acq_data.get_data('double/test_2')[0], 1./3)
+        acq_data.close()
+
     def test_open_without_ext(self):
         """
         Test that file is created with the exact name specified
@@ -134,6 +158,31 @@ class TestHDF5Data():
 
         acq_data.close()
 
+    def test_finite_append_rows(self):
+        # rows run across the end of a trace, and part way into the next
+        ntraces, nreps, npoints = 3, 4, 10
+        data = np.arange(ntraces*nreps*npoints).reshape(ntraces*nreps, npoints)
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (ntraces, nreps, npoints))
+        acq_data.append('fake', data[0])
+        acq_data.append_rows('fake', data[1:6])
+        acq_data.append_rows('fake', data[6:])
+
+        np.testing.assert_array_equal(acq_data.get_data('fake/test_1'),
+                                      data.reshape(ntraces, nreps, npoints))
+        acq_data.close()
+
+    @raises(DataIndexError)
+    def test_finite_append_rows_overflow_error(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (2, 10))
+        try:
+            acq_data.append_rows('fake', np.ones((3, 10)))
+        finally:
+            acq_data.close()
+
     def test_finite_dataset_single_point(self):
 
         fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
@@ -255,6 +304,139 @@ class TestHDF5Data():
         assert_equal(stim[0]['duration'], 0.1)
         hfile.close()
 
+    def test_layout_contiguous_default(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (3, 4, 2, 100), mode='finite')
+        assert acq_data.hdf5['fake/test_1'].chunks is None
+        assert acq_data.hdf5['fake/test_1'].compression is None
+        acq_data.close()
+
+    def test_layout_chunked_compressed(self):
+        dims = (3, 4, 2, 1000)
+        data = np.random.normal(0, 0.01, dims[1:]).astype(np.float32)
+        for compression in ['lzf', 'gzip']:
+            fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+            acq_data = HDF5Data(fname)
+            acq_data.set_layout(compression=compression, shuffle=True)
+            acq_data.init_data('fake', dims, mode='finite')
+            for itrace in range(dims[0]):
+                for irep in range(dims[1]):
+                    acq_data.append('fake', data[irep])
+            dset = acq_data.hdf5['fake/test_1']
+            # chunked by the write unit
+            assert_equal(dset.chunks, (1, 1, 2, 1000))
+            assert_equal(dset.compression, compression)
+            assert dset.shuffle
+            np.testing.assert_array_equal(acq_data.get_data('fake/test_1', (2, 3)), data[3])
+            acq_data.close()
+
+            acq_data = HDF5Data(fname, filemode='r')
+            np.testing.assert_array_equal(acq_data.get_data('fake/test_1', (1, 0)), data[0])
+            acq_data.close()
+
+    def test_layout_chunk_shape(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.set_layout(chunks=(1, 2, 1, 50))
+        acq_data.init_data('fake', (3, 4, 2, 100), mode='finite')
+        acq_data.init_data('fake_open', (100,), mode='open')
+        assert_equal(acq_data.hdf5['fake/test_1'].chunks, (1, 2, 1, 50))
+        acq_data.close()
+
+        acq_data = HDF5Data(fname.replace('.hdf5', 'b.hdf5'))
+        acq_data.set_layout(chunks='write')
+        acq_data.init_data('fake_open', (100,), mode='open')
+        assert_equal(acq_data.hdf5['fake_open'].chunks, (1, 100))
+        acq_data.close()
+
+    @raises(ValueError)
+    def test_layout_bad_compression(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        try:
+            acq_data.set_layout(compression='zip')
+        finally:
+            acq_data.close()
+
+    def test_trace_info_table_not_a_dataset(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('segment_1', (1, 10))
+        acq_data.append_trace_info('segment_1', {'trace': 1})
+        assert_equal(acq_data.dataset_names(), ['segment_1/test_1'])
+        assert_equal(len(acq_data.all_datasets()), 1)
+        acq_data.close()
+
+    def test_test_data_not_a_dataset(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_group('segment_1')
+        acq_data.init_data('segment_1', (2, 10))
+        acq_data.init_data('segment_1', (2, 10), nested_name='test_1_counts', dtype=np.int32)
+        acq_data.append('segment_1', np.ones((10,), dtype=np.int32), nested_name='test_1_counts')
+        assert_equal(acq_data.dataset_names(), ['segment_1/test_1'])
+        assert_equal(len(acq_data.all_datasets()), 1)
+        assert_equal(acq_data.hdf5['segment_1/test_1_counts'].attrs['data_of'], 'segment_1/test_1')
+        np.testing.assert_array_equal(acq_data.get_data('segment_1/test_1_counts', (0,)), np.ones((10,)))
+        acq_data.close()
+
+    def test_trace_info_table(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (10,), mode='finite')
+        for itrace in range(5):
+            acq_data.append_trace_info('fake', {'trace': itrace})
+
+        # stored as a table, without touching the attribute
+        assert_equal(acq_data.hdf5['fake/test_1_stim'].shape, (5,))
+        assert_equal(acq_data.hdf5['fake/test_1'].attrs['stim'], '[]')
+        assert_equal(acq_data.get_trace_stim('fake/test_1'), [{'trace': itrace} for itrace in range(5)])
+        acq_data.close()
+
+        # written to the attribute for older readers on close
+        hfile = h5py.File(fname, 'r')
+        stim = json.loads(hfile['fake']['test_1'].attrs['stim'])
+        assert_equal(stim, [{'trace': itrace} for itrace in range(5)])
+        hfile.close()
+
+    def test_trace_info_larger_than_attribute(self):
+        ntraces = 2000
+        doc = {'stim_type': 'tone', 'components': ['x'*50]}
+
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('fake', (10,), mode='open')
+        for itrace in range(ntraces):
+            acq_data.append_trace_info('fake', doc)
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        stim = acq_data.get_trace_stim('fake')
+        assert_equal(len(stim), ntraces)
+        assert_equal(stim[-1], doc)
+        acq_data.close()
+
+    def test_trace_info_from_attribute(self):
+        # files written before trace info tables
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        hfile = h5py.File(fname, 'w')
+        hfile.create_group('segment_1')
+        hfile['segment_1'].create_dataset('test_1', (2, 10))
+        hfile['segment_1']['test_1'].attrs['stim'] = json.dumps([{'trace': 0}])
+        hfile.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        assert_equal(acq_data.get_trace_stim('segment_1/test_1'), [{'trace': 0}])
+        acq_data.close()
+
+        # adding to it keeps what was there
+        acq_data = HDF5Data(fname, filemode='a')
+        acq_data.meta['segment_1'] = {'mode': 'finite'}
+        acq_data.append_trace_info('segment_1', {'trace': 1})
+        assert_equal(acq_data.get_trace_stim('segment_1/test_1'), [{'trace': 0}, {'trace': 1}])
+        acq_data.close()
+
     def test_continuous(self):
         nsets = 32
         npoints = 10000
@@ -580,6 +762,306 @@ class TestHDF5Data():
 
         acq_data.close()
 
+    def test_journal_kept_when_closed(self):
+        nsets = 3
+        npoints = 10
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_finite(fakedata, nsets)
+        fname = acq_data.filename
+        acq_data.close()
+
+        state_file, checkpoints = journal_filenames(fname)
+        assert len(checkpoints) > 0
+
+        # the journal still holds everything, so nothing is copied on reopening
+        acq_data = HDF5Data(fname, filemode='a')
+        assert_equal(journal_filenames(fname)[1], checkpoints)
+
+        # only what changed goes in the next checkpoint
+        acq_data.init_data('segment0', (nsets, npoints))
+        for iset in range(nsets):
+            acq_data.append('segment0', fakedata)
+        acq_data.backup('segment0')
+        latest = journal_filenames(fname)[1][-1]
+        assert latest not in checkpoints
+        hfile = h5py.File(latest, 'r')
+        assert 'segment0/test_1' in hfile
+        assert 'fake/test_1' not in hfile
+        hfile.close()
+        acq_data.close()
+
+    def test_journal_over_limit_removed(self):
+        nsets = 3
+        npoints = 10
+        fakedata = np.ones((npoints,))
+        acq_data = self.setup_finite(fakedata, nsets)
+        fname = acq_data.filename
+        acq_data.set_journal_limit(journal_size(fname) - 1)
+        acq_data.close()
+
+        assert_equal(journal_filenames(fname)[1], [])
+        assert not journal_is_valid(fname)
+
+        # started over with a copy of everything
+        acq_data = HDF5Data(fname, filemode='a')
+        assert_equal(len(journal_filenames(fname)[1]), 1)
+        acq_data.set_journal_limit(None)
+        acq_data.close()
+        assert journal_is_valid(fname)
+
+    @raises(ValueError)
+    def test_journal_limit_negative(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        try:
+            acq_data.set_journal_limit(-1)
+        finally:
+            acq_data.close()
+
+    def test_recover_after_crash(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        crashing = multiprocessing.Process(target=write_and_crash, args=(fname,))
+        crashing.start()
+        crashing.join()
+        assert_equal(crashing.exitcode, 1)
+
+        # the file is cut short, as if the crash happened while writing
+        size = os.path.getsize(fname)
+        with open(fname, 'r+b') as datafile:
+            datafile.truncate(size/2)
+
+        recovered = HDF5Data(fname, filemode='r')
+        assert_equal(recovered.dataset_names(), ['segment0/test_1', 'segment1/test_2'])
+        np.testing.assert_array_equal(recovered.get_data('segment1/test_2'), np.ones((3, 10))*2)
+        assert_equal(recovered.get_info('segment0')['raindrops'], 'roses')
+        recovered.close()
+
+        # the recovered file is closed safely, so is not recovered again
+        acq_data = HDF5Data(fname, filemode='a')
+        assert_equal(acq_data.dataset_names(), ['segment0/test_1', 'segment1/test_2'])
+        acq_data.close()
+
+    def test_repack_blocking(self):
+        fname, expected = self.setup_deleted('blocking')
+        self.check_repacked(fname, expected)
+
+    def test_repack_background(self):
+        fname, expected = self.setup_deleted('background')
+        wait_for_repack(fname)
+        self.check_repacked(fname, expected)
+
+    def test_repack_inplace(self):
+        fname, expected = self.setup_deleted('inplace')
+        self.check_repacked(fname, expected)
+
+    def test_repack_defer(self):
+        fname, expected = self.setup_deleted('defer')
+        hfile = h5py.File(fname, 'r')
+        assert hfile.attrs[REPACK_ATTR]
+        hfile.close()
+        assert os.path.getsize(fname) > 8e6
+
+        # marked until repacked, even if opened and closed in between
+        acq_data = HDF5Data(fname, filemode='a')
+        assert acq_data.needs_repack
+        acq_data.close()
+
+        assert repack_file(fname)
+        self.check_repacked(fname, expected)
+
+    def test_repack_resumes(self):
+        fname, expected = self.setup_deleted('defer')
+        stop = threading.Event()
+        progress = []
+        def stop_after_first(copied, total):
+            progress.append((copied, total))
+            stop.set()
+        assert not repack_file(fname, stop_after_first, stop)
+        assert os.path.isfile(fname + '_repack_tmp')
+        assert_equal(len(progress), 1)
+
+        # carries on where it stopped
+        assert repack_file(fname, lambda copied, total: progress.append((copied, total)))
+        copied, total = progress[-1]
+        assert_equal(copied, total)
+        # a group and a dataset for each, copied once
+        assert_equal(len(progress), len(expected)*2)
+        assert not os.path.isfile(fname + '_repack_tmp')
+        self.check_repacked(fname, expected)
+
+    def test_repack_resumed_copy_checked(self):
+        # copies that lost what they recorded as copied: part of it, and all
+        for nclaimed in [5, 6]:
+            fname, expected = self.setup_deleted('defer')
+            stop = threading.Event()
+            assert not repack_file(fname, lambda copied, total: stop.set(), stop)
+
+            copy = h5py.File(fname + '_repack_tmp', 'a')
+            copy.attrs['repack_copied'] = nclaimed
+            copy.close()
+
+            progress = []
+            assert repack_file(fname, lambda copied, total: progress.append((copied, total)))
+            # copied again from the start, rather than carried on
+            assert_equal(len(progress), len(expected)*2)
+            assert not os.path.isfile(fname + '_repack_tmp')
+            self.check_repacked(fname, expected)
+
+    @raises(ValueError)
+    def test_unknown_repack_policy(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        try:
+            acq_data.set_repack_policy('sometime')
+        finally:
+            acq_data.close()
+
+    def test_swmr_reader_follows_writer(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        # the reader must not share this process's handle on the file
+        conn, reader_conn = multiprocessing.Pipe()
+        reader = multiprocessing.Process(target=follow_file, args=(fname, reader_conn))
+        reader.start()
+        try:
+            acq_data = HDF5Data(fname, swmr=True)
+            acq_data.init_data('segment_1', (2, 3, 10))
+            acq_data.append('segment_1', np.ones((10,)))
+            acq_data.append_trace_info('segment_1', {'trace': 1})
+
+            assert_equal(ask_reader(conn, 'open'), ['segment_1/test_1'])
+            data = ask_reader(conn, 'get_data', 'segment_1/test_1', (0, 0))
+            np.testing.assert_array_equal(data, np.ones((10,)))
+            assert_equal(ask_reader(conn, 'get_trace_stim', 'segment_1/test_1'), [{'trace': 1}])
+
+            acq_data.append('segment_1', np.ones((10,))*2)
+            acq_data.append_trace_info('segment_1', {'trace': 2})
+            ask_reader(conn, 'refresh', 'segment_1/test_1')
+            data = ask_reader(conn, 'get_data', 'segment_1/test_1', (0, 1))
+            np.testing.assert_array_equal(data, np.ones((10,))*2)
+            ask_reader(conn, 'refresh', 'segment_1/test_1_stim')
+            assert_equal(ask_reader(conn, 'get_trace_stim', 'segment_1/test_1'),
+                         [{'trace': 1}, {'trace': 2}])
+
+            # attributes cannot be set in SWMR mode, so are held until it is left
+            acq_data.set_metadata('segment_1', {'comment': 'held'})
+            assert_equal(acq_data.get_info('segment_1')['comment'], 'held')
+            assert 'comment' not in ask_reader(conn, 'get_info', 'segment_1')
+
+            # the writer leaves SWMR mode to create a new test, while the
+            # reader keeps following, which lets go of the file meanwhile
+            conn.send(('wait_for', 'segment_1/test_2'))
+            acq_data.init_data('segment_1', (1, 1, 10))
+            acq_data.append('segment_1', np.ones((10,))*3)
+            answer = conn.recv()
+            if isinstance(answer, Exception):
+                raise answer
+            assert_equal(answer, ['segment_1/test_1', 'segment_1/test_2'])
+            assert_equal(ask_reader(conn, 'get_info', 'segment_1')['comment'], 'held')
+            ask_reader(conn, 'refresh', 'segment_1/test_2')
+            data = ask_reader(conn, 'get_data', 'segment_1/test_2', (0, 0))
+            np.testing.assert_array_equal(data, np.ones((10,))*3)
+        finally:
+            conn.send(('close',))
+            reader.join()
+        # closing leaves SWMR mode too, which the reader must let it do
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='r')
+        assert_equal(acq_data.get_trace_stim('segment_1/test_1'), [{'trace': 1}, {'trace': 2}])
+        acq_data.close()
+
+    def test_swmr_reader_not_letting_go(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        conn, reader_conn = multiprocessing.Pipe()
+        reader = multiprocessing.Process(target=follow_file, args=(fname, reader_conn))
+        reader.start()
+        release_timeout = hdf5data.SWMR_RELEASE_TIMEOUT
+        hdf5data.SWMR_RELEASE_TIMEOUT = 0.2
+        try:
+            acq_data = HDF5Data(fname, swmr=True)
+            acq_data.init_data('segment_1', (2, 10))
+            acq_data.append('segment_1', np.ones((10,)))
+            ask_reader(conn, 'open')
+
+            # the reader does not look at the file, so does not let go of it
+            try:
+                acq_data.init_data('segment_1', (1, 10))
+            except IOError:
+                pass
+            else:
+                assert False, "left SWMR mode with the file held by a reader"
+            assert 'HDF5_USE_FILE_LOCKING' not in os.environ
+
+            # still in SWMR mode, and followed
+            acq_data.append('segment_1', np.ones((10,))*2)
+            ask_reader(conn, 'refresh', 'segment_1/test_1')
+            data = ask_reader(conn, 'get_data', 'segment_1/test_1', (1,))
+            np.testing.assert_array_equal(data, np.ones((10,))*2)
+        finally:
+            conn.send(('close',))
+            reader.join()
+            hdf5data.SWMR_RELEASE_TIMEOUT = release_timeout
+
+        acq_data.init_data('segment_1', (1, 10))
+        assert_equal(acq_data.dataset_names(), ['segment_1/test_1', 'segment_1/test_2'])
+        acq_data.close()
+
+    def test_swmr_older_format(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.init_data('segment_1', (1, 10))
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='a', swmr=True)
+        assert not acq_data.swmr
+        acq_data.init_data('segment_2', (1, 10))
+        acq_data.append('segment_2', np.ones((10,)))
+        acq_data.close()
+
+    def test_swmr_repack_keeps_format(self):
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname, swmr=True)
+        for igroup in range(2):
+            acq_data.init_data('segment_{}'.format(igroup+1), (1, 10))
+            acq_data.append('segment_{}'.format(igroup+1), np.ones((10,)))
+        acq_data.delete_group('segment_1')
+        acq_data.close()
+
+        acq_data = HDF5Data(fname, filemode='a', swmr=True)
+        assert acq_data.swmr
+        acq_data.close()
+
+    def setup_deleted(self, policy):
+        """Data file with the first of its groups deleted, closed under
+        repack *policy*"""
+        fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
+        acq_data = HDF5Data(fname)
+        acq_data.set_repack_policy(policy)
+        expected = {}
+        for igroup in range(4):
+            key = 'segment_{}'.format(igroup+1)
+            acq_data.init_data(key, (2, 250000))
+            for iset in range(2):
+                acq_data.append(key, np.ones((250000,))*igroup)
+            expected[key] = acq_data.get_data(key + '/test_{}'.format(igroup+1))
+        acq_data.set_metadata('', {'total cells': 4})
+        acq_data.delete_group('segment_1')
+        del expected['segment_1']
+        acq_data.close()
+        return fname, expected
+
+    def check_repacked(self, fname, expected):
+        # each group has 4MB of data
+        assert os.path.getsize(fname) < 13e6
+        acq_data = HDF5Data(fname, filemode='r')
+        assert not acq_data.needs_repack
+        assert_equal(acq_data.get_info('')['total cells'], 4)
+        assert_equal(sorted(acq_data.keys()), sorted(expected.keys()))
+        for key, data in expected.items():
+            itest = key.split('_')[-1]
+            np.testing.assert_array_equal(acq_data.get_data(key + '/test_' + itest), data)
+        acq_data.close()
+
     def setup_calibration(self, calname, caldata):
 
         fname = os.path.join(tempfolder, 'savetemp'+rand_id()+'.hdf5')
@@ -618,6 +1100,57 @@ class TestHDF5Data():
         acq_data.backup(groupname)
         return acq_data
 
+def write_and_crash(fname):
+    acq_data = HDF5Data(fname)
+    acq_data.init_data('segment0', (3, 10))
+    acq_data.set_metadata('segment0', {'raindrops': 'roses'})
+    for iset in range(3):
+        acq_data.append('segment0', np.ones((10,)))
+    acq_data.backup('segment0')
+    acq_data.init_data('segment1', (3, 10))
+    for iset in range(3):
+        acq_data.append('segment1', np.ones((10,))*2)
+    acq_data.backup('segment1')
+    # not backed up, so lost
+    acq_data.init_data('segment2', (3, 10))
+    acq_data.hdf5.flush()
+    os._exit(1)
+
+def ask_reader(conn, *command):
+    """Sends *command* to :func:`follow_file`, and returns its answer"""
+    conn.send(command)
+    answer = conn.recv()
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
+
+def follow_file(fname, conn):
+    """Reads *fname* while it is written, as told through *conn*"""
+    acq_data = None
+    while True:
+        command = conn.recv()
+        if command[0] == 'close':
+            break
+        try:
+            if command[0] == 'open':
+                acq_data = HDF5Data(fname, filemode='r', swmr=True)
+                conn.send(acq_data.dataset_names())
+            elif command[0] == 'wait_for':
+                # follows the file, as data review would, until a dataset appears
+                deadline = time.time() + 10
+                while command[1] not in acq_data.dataset_names():
+                    if time.time() > deadline:
+                        raise Exception("{} did not appear".format(command[1]))
+                    time.sleep(0.02)
+                conn.send(acq_data.dataset_names())
+            else:
+                conn.send(getattr(acq_data, command[0])(*command[1:]))
+        except Exception as error:
+            # so the test fails, rather than waiting for an answer
+            conn.send(error)
+    if acq_data is not None:
+        acq_data.close()
+
 # def assert_attrs_equal(original_acqdata, recovered_acqdata):
 #     recovered_attrs = recovered_acqdata.get_info('')
 #     for attr, val in original_acqdata.get_info('').items():
@@ -636,7 +1169,7 @@ def assert_attrs_equal(ref_group, compare_group):
     for attr in ref_group.attrs:
         # print 'attr0:', ref_group.attrs[attr]
         # print 'attr1', compare_group.attrs[attr]
-        assert ref_group.attrs[attr] == compare_group.attrs[attr]
+        assert np.all(ref_group.attrs[attr] == compare_group.attrs[attr])
     if hasattr(ref_group, 'keys'):
         for key in ref_group.keys():
             assert_attrs_equal(ref_group[key], compare_group[key])
@@ -0,0 +1,68 @@
+import glob
+import os
+import shutil
+
+import h5py
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.data.hdf5data import REPACK_ATTR, HDF5Data
+from sparkle.data.repack import main, needs_repacking
+from sparkle.tools.systools import rand_id
+
+tempfolder = os.path.join(os.path.abspath(os.path.dirname(__file__)), u"tmp")
+
+class TestRepackCommand():
+    def setUp(self):
+        self.folder = os.path.join(tempfolder, 'repack'+rand_id())
+        os.mkdir(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write_file(self, name, delete):
+        fname = os.path.join(self.folder, name)
+        acq_data = HDF5Data(fname)
+        acq_data.set_repack_policy('defer')
+        for key in ['segment_1', 'segment_2']:
+            acq_data.init_data(key, (1, 100000))
+            acq_data.append(key, np.ones((100000,)))
+        if delete:
+            acq_data.delete_group('segment_1')
+        acq_data.close()
+        return fname
+
+    def test_repack_marked_files(self):
+        deleted = self.write_file('deleted.hdf5', True)
+        kept = self.write_file('kept.hdf5', False)
+        assert needs_repacking(deleted)
+        assert not needs_repacking(kept)
+        deleted_size = os.path.getsize(deleted)
+        kept_mtime = os.path.getmtime(kept)
+
+        assert_equal(main([self.folder]), 0)
+
+        assert not needs_repacking(deleted)
+        assert os.path.getsize(deleted) < deleted_size - 3e5
+        assert_equal(os.path.getmtime(kept), kept_mtime)
+        hfile = h5py.File(deleted, 'r')
+        assert_equal(hfile.keys(), ['segment_2'])
+        np.testing.assert_array_equal(hfile['segment_2/test_2'][:], np.ones((1, 100000)))
+        hfile.close()
+        # backups of what was deleted are gone too
+        assert_equal(glob.glob(os.path.join(self.folder, '.backup', 'deleted_*')), [])
+
+    def test_repack_all(self):
+        kept = self.write_file('kept.hdf5', False)
+        kept_mtime = os.path.getmtime(kept)
+        assert_equal(main(['--all', kept]), 0)
+        assert os.path.getmtime(kept) != kept_mtime
+        assert not needs_repacking(kept)
+
+    def test_skips_open_file(self):
+        fname = self.write_file('deleted.hdf5', True)
+        size = os.path.getsize(fname)
+        acq_data = HDF5Data(fname, filemode='a')
+        main([fname])
+        assert_equal(os.path.getsize(fname), size)
+        acq_data.close()
@@ -15,6 +15,7 @@ from nose.tools import assert_equal, assert_in, nottest
 
 import test.sample as sample
 from test.tests.unit.data.test_hdf5_data import assert_attrs_equal
+from sparkle.data.hdf5data import HDF5Data, wait_for_repack
 from sparkle.data.open import open_acqdata
 from sparkle.gui.stim.factory import TCFactory
 from sparkle.run.acquisition_manager import AcquisitionManager
@@ -22,6 +23,7 @@ from sparkle.stim.auto_parameter_model import AutoParameterModel
 from sparkle.stim.reorder import random_order
 from sparkle.stim.stimulus_model import StimulusModel
 from sparkle.stim.types.stimuli_classes import PureTone, Silence, Vocalization
+from sparkle.tools.precision import set_storage_dtype, storage_dtype
 from sparkle.tools.systools import rand_id
 
 
@@ -47,6 +49,8 @@ class TestAcquisitionManager():
         # test runs that produced errors and did not delete their files
         files = glob.glob(self.tempfolder + os.sep + '[a-zA-Z0-9_]*.hdf5')
         for f in files:
+            # closed files may still be being repacked
+            wait_for_repack(f)
             os.remove(f)
 
         assert "Error:" not in self.stream.getvalue()
@@ -98,6 +102,36 @@ class TestAcquisitionManager():
 
         hfile.close()
 
+    def test_tone_protocol_data_dtype_default(self):
+        """Recordings are stored as float32 with the shipped settings,
+        whatever the signal precision"""
+        assert_equal(storage_dtype(), np.float32)
+        manager, fname = self.create_acqmodel(0.2, 50000)
+        self.fake_calibration(manager)
+        self.tone_protocol(manager)
+        manager.close_data()
+
+        hfile = h5py.File(os.path.join(self.tempfolder, fname), 'r')
+        assert_equal(hfile['segment_1']['test_1'].dtype, np.float32)
+        hfile.close()
+
+    def test_tone_protocol_data_dtype(self):
+        """Recordings are stored at the storage precision"""
+        original = storage_dtype()
+        for dtype in [np.float32, np.float64]:
+            set_storage_dtype(dtype)
+            try:
+                manager, fname = self.create_acqmodel(0.2, 50000)
+                self.fake_calibration(manager)
+                self.tone_protocol(manager)
+                manager.close_data()
+            finally:
+                set_storage_dtype(original)
+
+            hfile = h5py.File(os.path.join(self.tempfolder, fname), 'r')
+            assert_equal(hfile['segment_1']['test_1'].dtype, dtype)
+            hfile.close()
+
     def test_tone_protocol_data_backup(self):
         """functional test for data backup"""
         winsz = 0.2 #seconds
@@ -327,6 +361,181 @@ class TestAcquisitionManager():
 
         hfile.close()
 
+    def test_auto_parameter_protocol_streamed(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        nreps = 2
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set(stream_stim=True)
+
+        stim_model = create_tone_stim(nreps)
+        stim_model.setReorderFunc(random_order, name='random')
+
+        manager.protocol_model().insert(stim_model,0)
+        manager.setup_protocol(0.1)
+        t = manager.run_protocol()
+        t.join()
+
+        stats = manager.protocoler.prefetch_stats
+        assert stats['render_time'] > 0
+        assert 0 <= stats['hidden_time'] <= stats['render_time']
+
+        manager.close_data()
+        # now check saved data
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        test = hfile['segment_1']['test_1']
+
+        check_result(test, stim_model, winsz, acq_rate)
+
+        hfile.close()
+
+    def test_abort_protocol_streamed(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set(stream_stim=True)
+
+        stim_model = create_tone_stim(2)
+        manager.protocol_model().insert(stim_model,0)
+        tone = stim_model.component(0,0)
+        # hold on to the traces, so that they are not closed by being collected
+        expanded = []
+        iter_expanded = stim_model.iterExpandedStim
+        def hold_expanded():
+            expanded.append(iter_expanded())
+            return expanded[-1]
+        stim_model.iterExpandedStim = hold_expanded
+
+        collected = threading.Event()
+        manager.set_queue_callback('response_collected', lambda *args: collected.set())
+        manager.start_listening()
+        manager.setup_protocol(0.1)
+        t = manager.run_protocol()
+        collected.wait(5)
+        manager.halt()
+        t.join()
+        manager.stop_listening()
+        manager.close_data()
+
+        assert_equal(len(expanded), 1)
+        # stopped part way through the traces, the component is put back
+        # to the first trace's values, as after a full run, by the time
+        # the run is done
+        np.testing.assert_almost_equal(tone.duration(), 0.065)
+
+    def test_auto_parameter_protocol_batched(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        nreps = 3
+        interval = 250 # ms
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set(batch_reps=True)
+
+        stim_model = create_tone_stim(nreps)
+        manager.protocol_model().insert(stim_model,0)
+        manager.setup_protocol(interval)
+        t = manager.run_protocol()
+        t.join()
+
+        manager.close_data()
+        # now check saved data
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        test = hfile['segment_1']['test_1']
+
+        check_result(test, stim_model, winsz, acq_rate)
+        group = hfile['segment_1']
+        assert_equal(group.attrs['reps_scheduled'], stim_model.traceCount() + nreps)
+        assert_equal(sum(group.attrs['lateness_histogram']), group.attrs['reps_scheduled'])
+        # the silence window is still presented a rep at a time
+        stim_doc = json.loads(test.attrs['stim'])
+        for stim_info in stim_doc[1:]:
+            np.testing.assert_almost_equal(np.diff(stim_info['time_stamps']), interval/1000.)
+
+        hfile.close()
+
+    def test_batched_interval_too_short(self):
+        """Reps that would overlap in a batch are reported before the run"""
+        manager, fname = self.create_acqmodel(0.2, 50000)
+        manager.set(batch_reps=True)
+        finished = []
+        manager.set_queue_callback('group_finished', finished.append)
+        manager.start_listening()
+
+        manager.protocol_model().insert(create_tone_stim(3), 0)
+        manager.setup_protocol(100)
+        t = manager.run_protocol()
+        t.join()
+        manager.stop_listening()
+        manager.close_data()
+
+        assert_equal(finished, [True])
+        assert 'so reps cannot be batched' in self.stream.getvalue()
+        # the error is expected
+        self.stream.truncate(0)
+
+    def test_auto_parameter_protocol_hardware_clock(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        nreps = 3
+        interval = 250 # ms
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set(hardware_clock=True)
+
+        stim_model = create_tone_stim(nreps)
+        manager.protocol_model().insert(stim_model,0)
+        manager.setup_protocol(interval)
+        t = manager.run_protocol()
+        t.join()
+
+        manager.close_data()
+        # now check saved data
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        test = hfile['segment_1']['test_1']
+
+        check_result(test, stim_model, winsz, acq_rate)
+        group = hfile['segment_1']
+        # only the first rep of each trace waits on the software schedule
+        assert_equal(group.attrs['reps_scheduled'], stim_model.traceCount() + 1)
+        stim_doc = json.loads(test.attrs['stim'])
+        for stim_info in stim_doc:
+            spacing = np.diff(stim_info['time_stamps'])
+            assert np.all(abs(spacing - interval/1000.) < 0.05), spacing
+
+        hfile.close()
+
+    def test_auto_parameter_protocol_async_write(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        nreps = 3
+        saved = {}
+        writer_stats = []
+        for async_write in [False, True]:
+            manager, fname = self.create_acqmodel(winsz, acq_rate)
+            manager.set(async_write=async_write)
+            manager.set_queue_callback('writer_stats', writer_stats.append)
+            manager.start_listening()
+            stim_model = create_tone_stim(nreps)
+            manager.protocol_model().insert(stim_model,0)
+            manager.setup_protocol(0.1)
+            t = manager.run_protocol()
+            t.join()
+            # the writer hands back the data file at the end of the run
+            assert isinstance(manager.protocoler.datafile, HDF5Data)
+            manager.close_data()
+            manager.stop_listening()
+
+            hfile = h5py.File(os.path.join(self.tempfolder, fname))
+            test = hfile['segment_1']['test_1']
+            check_result(test, stim_model, winsz, acq_rate)
+            saved[async_write] = test[:]
+            hfile.close()
+
+        np.testing.assert_array_equal(saved[False], saved[True])
+        assert_equal(len(writer_stats), 1)
+        stats = writer_stats[0]
+        assert stats['queued'] > 0
+        assert stats['writes'] <= stats['queued']
+
     def test_auto_vocal_parameter_protocol(self):
         winsz = 0.2 #seconds
         acq_rate = 50000
@@ -376,6 +585,43 @@ class TestAcquisitionManager():
 
         hfile.close()
 
+    def test_auto_parameter_protocol_process(self):
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        nreps = 3
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set_acquisition_process(True)
+        self.data = []
+        manager.set_queue_callback('response_collected', self.collect_response)
+        manager.start_listening()
+
+        stim_model = create_tone_stim(nreps)
+        manager.protocol_model().insert(stim_model,0)
+        manager.setup_protocol(0.1)
+        t = manager.run_protocol()
+        t.join()
+        # the file is handed back when the run is done
+        manager.protocoler.set_comment(1, 'after the run')
+        manager.close_data()
+        # listeners may still be catching up with the last responses
+        total = manager.protocol_total_count()
+        wait_start = time.time()
+        while len(self.data) < total and time.time() - wait_start < 5:
+            time.sleep(0.1)
+        manager.stop_listening()
+
+        assert "Error from acquisition process" not in self.stream.getvalue()
+        assert_equal(len(self.data), total)
+        times, response = self.data[0]
+        assert times.shape == (int(acq_rate*winsz),)
+        assert response.shape == (1, int(acq_rate*winsz))
+
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        test = hfile['segment_1']['test_1']
+        check_result(test, stim_model, winsz, acq_rate)
+        assert_equal(hfile['segment_1'].attrs['comment'], 'after the run')
+        hfile.close()
+
     def test_abort_protocol(self):
         winsz = 0.2 #seconds
         acq_rate = 50000
@@ -588,6 +834,51 @@ class TestAcquisitionManager():
 
         hfile.close()
 
+    def test_tone_vocal_explore_process(self):
+        """Run search operation in a child process, changing the stimulus while it runs"""
+        winsz = 0.2 #seconds
+        acq_rate = 50000
+        manager, fname = self.create_acqmodel(winsz, acq_rate)
+        manager.set_acquisition_process(True)
+        self.data = []
+        manager.set_queue_callback('response_collected', self.collect_response)
+        manager.start_listening()
+
+        manager.set(nreps=2, save=True)
+        stim = manager.explore_stimulus()
+        stim.insertComponent(PureTone())
+        t = manager.run_explore(0.25)
+
+        time.sleep(1)
+
+        stim.removeComponent(0,0)
+        vocal = Vocalization()
+        vocal.setFile(sample.samplewav())
+        stim.insertComponent(vocal)
+        manager.reset_explore_stim()
+
+        time.sleep(1)
+
+        manager.halt()
+        t.join()
+        manager.close_data()
+        manager.stop_listening()
+
+        assert "Error from acquisition process" not in self.stream.getvalue()
+        assert len(self.data) > 1
+        times, response = self.data[0]
+        assert response.shape == (1, int(acq_rate*winsz))
+        # the next search saves to a new dataset
+        assert_equal(manager.explorer.set_name, 'explore_2')
+
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        test = hfile['explore_1']
+        stims = json.loads(test.attrs['stim'])
+        assert_equal(stims[0]['components'][0]['stim_type'], 'Pure Tone')
+        assert_equal(stims[-1]['components'][0]['stim_type'], 'Vocalization')
+        assert_equal(test.shape[1], winsz*acq_rate)
+        hfile.close()
+
     def run_check_explore(self, winsz, acq_rate, manager, fname, nchans=1):
         self.data = []
         # set a callback to gather and assert for data
@@ -630,6 +921,8 @@ class TestAcquisitionManager():
     def stopchart(self, manager, fname):
         manager.stop_chart()
         manager.close_data()
+        # consolidating the chart leaves the file to be repacked
+        wait_for_repack(os.path.join(self.tempfolder, fname))
 
         # now check saved data
         hfile = h5py.File(os.path.join(self.tempfolder, fname))
@@ -642,6 +935,56 @@ class TestAcquisitionManager():
         hfile.close()
         self.done = True
 
+    def test_stop_chart(self):
+        manager, fname = self.create_acqmodel(1.0, 100000)
+        # the chart records a single channel
+        manager.set(aichan=u"PCI-6259/ai0")
+        # stopping a chart that was never started does nothing
+        manager.stop_chart()
+
+        collected = []
+        manager.set_queue_callback('ncollected', lambda stim, response: collected.append(response))
+        manager.start_listening()
+        manager.start_chart()
+        time.sleep(0.5)
+        manager.stop_chart()
+        manager.stop_chart()
+        manager.stop_listening()
+        manager.close_data()
+
+        assert len(collected) > 0
+        # listeners get copies, which later reads from the device cannot overwrite
+        ring = manager.charter.player.ring
+        for response in collected:
+            assert not np.may_share_memory(response, ring._data)
+
+    def test_chart_process(self):
+        acq_rate = 100000
+        manager, fname = self.create_acqmodel(1.0, acq_rate)
+        manager.set_acquisition_process(True)
+        manager.set(aichan=u"PCI-6259/ai0")
+
+        collected = []
+        manager.set_queue_callback('ncollected', lambda stim, response: collected.append(response))
+        manager.start_listening()
+        manager.start_chart()
+        time.sleep(0.5)
+        manager.stop_chart()
+        manager.stop_chart()
+        manager.stop_listening()
+        manager.close_data()
+
+        assert "Error from acquisition process" not in self.stream.getvalue()
+        assert len(collected) > 0
+        # blocks are read from the device at 10Hz
+        assert_equal(collected[0].shape, (acq_rate/10,))
+        assert_equal(manager.charter.chart_name, 'chart_2')
+
+        wait_for_repack(os.path.join(self.tempfolder, fname))
+        hfile = h5py.File(os.path.join(self.tempfolder, fname))
+        assert_in('chart_1', hfile.keys())
+        hfile.close()
+
     @nottest
     def test_chart_tone_protocol(self):
         winsz = 0.1 #seconds
@@ -864,6 +1207,10 @@ class TestAcquisitionManager():
 
         check_result(test, stim, winsz, acq_rate, nchans=2, averaged=True)
 
+        counts = hfile['segment_1']['test_1_counts']
+        assert_equal(counts.shape, (stim.traceCount()+1, 2, winsz*acq_rate))
+        assert np.all(counts.value == stim.repCount())
+
         hfile.close()
 
     def test_protocol_with_averaging_artifact_rejection(self):
@@ -893,6 +1240,11 @@ class TestAcquisitionManager():
 
         check_result(test, stim, winsz, acq_rate, averaged=True)
 
+        # rejected samples are not counted
+        counts = hfile['segment_1']['test_1_counts'].value
+        assert np.all(counts <= stim.repCount())
+        assert np.all(np.isnan(test.value[:,0][counts == 0]))
+
         hfile.close()
 
     #==============================
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.run.interval_scheduler import IntervalScheduler
+from sparkle.tools.systools import monotonic
+
+
+def test_monotonic_clock():
+    t0 = monotonic()
+    time.sleep(0.02)
+    elapsed = monotonic() - t0
+    assert 0.015 < elapsed < 0.5
+
+def test_monotonic_clock_threads():
+    # each thread must see its own readings only ever increase, however
+    # the threads' calls interleave
+    backwards = []
+    def read_clock():
+        last = monotonic()
+        for i in range(20000):
+            now = monotonic()
+            if now < last:
+                backwards.append((last, now))
+            last = now
+    threads = [threading.Thread(target=read_clock) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(backwards, [])
+
+def test_first_wait_immediate():
+    scheduler = IntervalScheduler(1.)
+    scheduler.start()
+    t0 = monotonic()
+    scheduler.wait()
+    assert monotonic() - t0 < 0.1
+
+def test_no_drift():
+    interval = 0.02
+    nreps = 10
+    scheduler = IntervalScheduler(interval, spin=0.001)
+    scheduler.start()
+    t0 = monotonic()
+    for irep in range(nreps):
+        scheduler.wait()
+        # work that takes a varying part of the interval
+        time.sleep(interval*0.5*(irep % 2))
+    # absolute deadlines: the last rep starts (nreps-1) intervals after the first
+    elapsed = monotonic() - t0
+    assert (nreps-1)*interval <= elapsed < (nreps-1)*interval + interval
+    assert_equal(scheduler.nreps, nreps)
+    assert_equal(scheduler.counts.sum(), nreps)
+
+def test_first_wait_starts_schedule():
+    scheduler = IntervalScheduler(0.05)
+    time.sleep(0.1)
+    assert scheduler.wait() < 0.005
+    assert_equal(scheduler.missed, 0)
+
+def test_late_rep_recorded():
+    interval = 0.01
+    scheduler = IntervalScheduler(interval, bin_width=0.001, nbins=10, tolerance=0.005)
+    scheduler.start()
+    scheduler.wait()
+    time.sleep(interval*3)
+    lateness = scheduler.wait()
+    assert lateness > interval
+    assert_equal(scheduler.restarts, 1)
+    assert_equal(scheduler.missed, 1)
+    # lands in the overflow bin
+    assert_equal(scheduler.counts[-1], 1)
+
+    stats = scheduler.stats()
+    assert_equal(stats['reps'], 2)
+    assert_equal(stats['max_lateness'], lateness)
+    assert_equal(len(stats['bin_edges']), 10)
+
+    # the schedule restarts from the late rep, rather than catching up
+    t0 = monotonic()
+    scheduler.wait()
+    assert monotonic() - t0 > interval*0.5
+
+def test_skip():
+    interval = 0.01
+    scheduler = IntervalScheduler(interval)
+    scheduler.start()
+    scheduler.wait()
+    scheduler.skip(3)
+    t0 = monotonic()
+    scheduler.wait()
+    assert monotonic() - t0 > interval*3
@@ -0,0 +1,51 @@
+import time
+
+from nose.tools import assert_equal, raises
+
+from sparkle.run.list_runner import TracePrefetcher
+
+
+def slow_traces(n, delay):
+    for i in range(n):
+        time.sleep(delay)
+        yield i
+
+def closed_traces(closed):
+    try:
+        for i in range(5):
+            yield i
+    finally:
+        closed.append(True)
+
+def broken_traces():
+    yield 0
+    raise ValueError("bad trace")
+
+def test_prefetch_order():
+    prefetcher = TracePrefetcher(slow_traces(5, 0.01))
+    assert_equal(list(prefetcher), range(5))
+
+def test_prefetch_hides_render_time():
+    prefetcher = TracePrefetcher(slow_traces(3, 0.05))
+    for trace in prefetcher:
+        # stand in for acquisition taking longer than rendering
+        time.sleep(0.1)
+    # the first trace can't be hidden, the later ones should be
+    # (loose margins, for timer resolution on busy machines)
+    assert prefetcher.render_time >= 0.14
+    assert prefetcher.hidden_time() >= 0.05
+
+@raises(ValueError)
+def test_prefetch_render_error():
+    prefetcher = TracePrefetcher(broken_traces())
+    for trace in prefetcher:
+        pass
+
+def test_prefetch_close():
+    closed = []
+    prefetcher = TracePrefetcher(closed_traces(closed))
+    assert_equal(prefetcher.next(), 0)
+    # the next trace is being rendered
+    prefetcher.close()
+    assert_equal(closed, [True])
+    assert not prefetcher._thread.is_alive()
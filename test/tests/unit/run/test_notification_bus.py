@@ -0,0 +1,93 @@
+import threading
+import time
+
+from nose.tools import assert_equal, raises
+
+from sparkle.run.notification_bus import ALL, LATEST, NotificationBus
+
+
+class TestNotificationBus():
+    def setUp(self):
+        self.bus = NotificationBus(['response_collected', 'group_finished'],
+                                   frame_interval=0.05)
+        self.queues = self.bus.topics()
+
+    def tearDown(self):
+        self.bus.stop()
+
+    def putnotify(self, name, *args):
+        self.queues[name][0].put(*args)
+        self.queues[name][1].set()
+
+    def test_all_in_order(self):
+        received = []
+        self.bus.subscribe('response_collected', lambda irep: received.append(('rep', irep)))
+        self.bus.subscribe('group_finished', lambda halted: received.append(('done', halted)))
+        self.bus.start()
+        for irep in range(20):
+            self.putnotify('response_collected', (irep,))
+        self.putnotify('group_finished', (False,))
+        self.bus.stop()
+
+        assert_equal(received, [('rep', irep) for irep in range(20)] + [('done', False)])
+        stats = self.bus.stats()
+        assert_equal(stats['topics']['response_collected']['delivered'], 20)
+        assert_equal(stats['topics']['response_collected']['dropped'], 0)
+        assert stats['max_depth'] >= 1
+
+    def test_latest_coalesced(self):
+        release = threading.Event()
+        displayed = []
+        collected = []
+        finished = []
+        def slow_display(irep):
+            release.wait()
+            displayed.append(irep)
+        self.bus.subscribe('response_collected', slow_display, LATEST)
+        self.bus.subscribe('response_collected', collected.append, ALL)
+        self.bus.subscribe('group_finished', finished.append)
+        # burst of notifications before the dispatcher can keep up
+        for irep in range(50):
+            self.putnotify('response_collected', (irep,))
+        self.putnotify('group_finished', (False,))
+        release.set()
+        self.bus.start()
+        self.bus.stop()
+
+        assert_equal(collected, range(50))
+        assert_equal(finished, [False])
+        assert len(displayed) < 50
+        assert_equal(displayed[-1], 49)
+        stats = self.bus.stats()['topics']['response_collected']
+        assert_equal(stats['delivered'] + stats['dropped'], 100)
+
+    def test_latest_delivered_under_load(self):
+        displayed = []
+        self.bus.subscribe('response_collected', displayed.append, LATEST)
+        self.bus.start()
+        for irep in range(10):
+            self.putnotify('response_collected', (irep,))
+            time.sleep(0.02)
+        # caught up, so the last is shown without waiting for stop
+        time.sleep(0.1)
+        assert_equal(displayed[-1], 9)
+
+    def test_no_listeners_not_queued(self):
+        self.putnotify('response_collected', (0,))
+        assert_equal(self.bus.stats()['max_depth'], 0)
+
+    def test_listener_error_logged(self):
+        received = []
+        def bad_listener(irep):
+            raise ValueError("oops")
+        self.bus.subscribe('response_collected', bad_listener)
+        self.bus.subscribe('response_collected', received.append)
+        self.bus.start()
+        self.putnotify('response_collected', (0,))
+        self.putnotify('response_collected', (1,))
+        self.bus.stop()
+        assert_equal(received, [0, 1])
+
+    @raises(KeyError)
+    def test_unknown_topic(self):
+        self.bus.subscribe('not_a_topic', lambda: None)
@@ -0,0 +1,35 @@
+import numpy as np
+from nose.tools import assert_equal
+
+from sparkle.run.process_runner import MIN_SHARED_BYTES, SharedSlots, SlotRef
+
+
+class TestSharedSlots():
+    def test_pack_unpack(self):
+        slots = SharedSlots(2, MIN_SHARED_BYTES*2)
+        data = np.random.random((2, MIN_SHARED_BYTES/8))
+        ref = slots.pack(data)
+        assert isinstance(ref, SlotRef)
+        data_out = slots.unpack(ref)
+        np.testing.assert_array_equal(data_out, data)
+        assert_equal(data_out.dtype, data.dtype)
+
+    def test_small_items_inline(self):
+        slots = SharedSlots(2, MIN_SHARED_BYTES)
+        for item in [np.ones((3,)), 'segment_1', 5]:
+            assert slots.pack(item) is item
+
+    def test_too_big_inline(self):
+        slots = SharedSlots(2, MIN_SHARED_BYTES)
+        data = np.ones((MIN_SHARED_BYTES,))
+        assert slots.pack(data) is data
+
+    def test_no_free_slot_inline(self):
+        slots = SharedSlots(1, MIN_SHARED_BYTES)
+        data = np.ones((MIN_SHARED_BYTES/8,))
+        ref = slots.pack(data)
+        assert isinstance(ref, SlotRef)
+        # does not wait for the slot to be freed
+        assert slots.pack(data) is data
+        slots.unpack(ref)
+        assert isinstance(slots.pack(data), SlotRef)
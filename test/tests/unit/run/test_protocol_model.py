@@ -1,10 +1,17 @@
+import os
+import tempfile
+
+import numpy as np
+import scipy.io.wavfile as wv
 from nose.tools import assert_equal
 
+import test.sample as sample
 from sparkle.QtWrapper import QtCore
+from sparkle.data.open import open_acqdata
 from sparkle.gui.qprotocol import QProtocolTabelModel
 from sparkle.run.protocol_model import ProtocolTabelModel
 from sparkle.stim.stimulus_model import StimulusModel
-from sparkle.stim.types.stimuli_classes import PureTone
+from sparkle.stim.types.stimuli_classes import PureTone, Vocalization
 
 
 class TestQProtocolModel():
@@ -106,3 +113,35 @@ class TestQProtocolModel():
         model.insertTest(stim,0)
 
         assert model.verify() == 0
+
+    def test_insert_precomputes_calibration(self):
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+        frange = [5000, 100000]
+
+        # a wav file at another samplerate, which the stimulus only
+        # changes to partway through
+        fname = os.path.join(tempfile.mkdtemp(), 'other_rate.wav')
+        wv.write(fname, 200000, np.zeros(1000, dtype=np.int16))
+        stim = StimulusModel()
+        component = Vocalization()
+        component.setFile(sample.samplewav())
+        stim.insertComponent(component, 0, 0)
+        stim.autoParams().insertRow(0)
+        stim.autoParams().overwriteParam(0, {'parameter': 'filename',
+                                             'names': [sample.samplewav(), fname],
+                                             'selection': []})
+        stim.autoParams().toggleSelection(0, component)
+
+        tests = ProtocolTabelModel()
+        tests.setReferenceVoltage(100, 0.1)
+        tests.setCalibration(calibration_vector, calibration_freqs, frange)
+        StimulusModel.clearCache()
+        tests.insert(stim, 0)
+        tests.waitForCalibration()
+
+        misses = StimulusModel.kernelCache.stats()['misses']
+        StimulusModel.calibrationKernel(200000, calibration_vector, calibration_freqs, frange)
+        assert_equal(StimulusModel.kernelCache.stats()['misses'], misses)
@@ -0,0 +1,53 @@
+import numpy as np
+from nose.tools import assert_equal
+from numpy.testing import assert_array_almost_equal
+
+from sparkle.stim.calibration_filter import CalibrationFilter
+from sparkle.tools.audiotools import convolve_filter
+
+
+class TestCalibrationFilter():
+    def test_matches_convolve_filter(self):
+        for klen in [3, 4, 64, 2**14]:
+            kernel = np.random.normal(0, 1, (klen,))
+            calfilter = CalibrationFilter(kernel)
+            for npts in [1, 50, klen*3 + 7, 200001]:
+                signal = np.random.normal(0, 1, (npts,))
+                expected = convolve_filter(signal, kernel)
+                filtered = calfilter.apply(signal)
+                assert_equal(filtered.shape, expected.shape)
+                assert_array_almost_equal(filtered, expected)
+
+    def test_overlap_save_blocks(self):
+        kernel = np.random.normal(0, 1, (100,))
+        calfilter = CalibrationFilter(kernel, block_len=256)
+        signal = np.random.normal(0, 1, (5000,))
+        assert_equal(calfilter.fftLength(len(signal)), 256)
+        assert_array_almost_equal(calfilter.apply(signal), convolve_filter(signal, kernel))
+
+    def test_spectrum_cached(self):
+        calfilter = CalibrationFilter(np.random.normal(0, 1, (64,)))
+        assert calfilter.spectrum(256) is calfilter.spectrum(256)
+
+    def test_stack_mixed_lengths(self):
+        kernel = np.random.normal(0, 1, (512,))
+        calfilter = CalibrationFilter(kernel)
+        # force several batches
+        calfilter.max_batch_points = 1
+        signals = [np.random.normal(0, 1, (npts,)) for npts in [10, 3000, 20000]]
+        filtered = calfilter.applyStack(signals)
+        assert_equal(len(filtered), len(signals))
+        for sig, filt in zip(signals, filtered):
+            assert_array_almost_equal(filt, convolve_filter(sig, kernel))
+
+    def test_zero_delay(self):
+        kernel = np.random.normal(0, 1, (256,))
+        calfilter = CalibrationFilter(kernel, delay=0)
+        signal = np.random.normal(0, 1, (3000,))
+        expected = np.convolve(signal, kernel)[:len(signal)]
+        assert_array_almost_equal(calfilter.apply(signal), expected)
+        assert_array_almost_equal(calfilter.applyStack([signal])[0], expected)
+
+    def test_complex_falls_back(self):
+        x = np.array([1+1j, 2+2j, 3+3j])
+        assert_array_almost_equal(CalibrationFilter(x).apply(x), [0+8j, 0+20j, 0+24j])
@@ -0,0 +1,106 @@
+import os
+import tempfile
+
+import numpy as np
+import scipy.io.wavfile as wv
+from nose.tools import assert_equal, raises
+
+from sparkle.stim.abstract_component import AbstractStimulusComponent
+from sparkle.stim.signal_cache import SignalCache
+from sparkle.stim.stimulus_model import StimulusModel
+from sparkle.stim.types.stimuli_classes import PureTone, Silence, Vocalization, \
+    WhiteNoise
+
+
+class TestSignalCache():
+    def test_lru_eviction(self):
+        cache = SignalCache(budget=2*8*10)
+        cache.get('a', lambda: np.zeros((10,)))
+        cache.get('b', lambda: np.zeros((10,)))
+        # touch a so that b is the least recently used
+        cache.get('a', lambda: np.zeros((10,)))
+        cache.get('c', lambda: np.zeros((10,)))
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        stats = cache.stats()
+        assert_equal(stats['hits'], 1)
+        assert_equal(stats['misses'], 3)
+        assert_equal(stats['evictions'], 1)
+        assert_equal(stats['nbytes'], 2*8*10)
+
+    def test_oversize_not_stored(self):
+        cache = SignalCache(budget=10)
+        sig = cache.get('a', lambda: np.zeros((10,)))
+        assert_equal(len(sig), 10)
+        assert_equal(len(cache), 0)
+
+    @raises(ValueError)
+    def test_cached_read_only(self):
+        cache = SignalCache(budget=1000)
+        sig = cache.get('a', lambda: np.zeros((10,)))
+        sig[0] = 1
+
+
+class TestComponentSignalCache():
+    def setUp(self):
+        AbstractStimulusComponent.enableSignalCache(2**24)
+
+    def tearDown(self):
+        AbstractStimulusComponent.disableSignalCache()
+
+    def test_same_state_hits(self):
+        tone0 = PureTone()
+        tone1 = PureTone()
+        sig0 = tone0.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        sig1 = tone1.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        assert sig0 is sig1
+        stats = AbstractStimulusComponent.signalCacheStats()
+        assert_equal(stats['hits'], 1)
+        assert_equal(stats['misses'], 1)
+
+    def test_state_change_misses(self):
+        tone = PureTone()
+        sig0 = tone.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        tone.setFrequency(7000)
+        sig1 = tone.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        np.testing.assert_array_equal(sig1, tone.signal(fs=100000, atten=0, caldb=100, calv=0.1))
+        assert not np.array_equal(sig0, sig1)
+        # calibration is part of the key as well
+        tone.cachedSignal(fs=100000, atten=0, caldb=90, calv=0.1)
+        assert_equal(AbstractStimulusComponent.signalCacheStats()['misses'], 3)
+
+    def test_edited_file_misses(self):
+        fname = os.path.join(tempfile.mkdtemp(), 'cache_test.wav')
+        wv.write(fname, 100000, (np.sin(np.arange(1000)/10.)*1000).astype(np.int16))
+        vocal = Vocalization()
+        vocal.setFile(fname)
+        sig0 = vocal.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        assert vocal.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1) is sig0
+
+        # same length, so only the modification time tells it apart
+        wv.write(fname, 100000, np.random.randint(-1000, 1000, 1000).astype(np.int16))
+        mtime = os.stat(fname).st_mtime
+        os.utime(fname, (mtime + 10, mtime + 10))
+        sig1 = vocal.cachedSignal(fs=100000, atten=0, caldb=100, calv=0.1)
+        np.testing.assert_array_equal(sig1, vocal.signal(fs=100000, atten=0, caldb=100, calv=0.1))
+        assert not np.array_equal(sig0, sig1)
+
+    def test_model_signal_unchanged(self):
+        model = StimulusModel()
+        model.setReferenceVoltage(100, 0.1)
+        model.setMaxVoltage(1.5, 10.0)
+        model.setMinVoltage(0.005)
+        silence = Silence()
+        model.insertComponent(silence, 0, 0)
+        model.insertComponent(WhiteNoise(), 0, 1)
+        model.insertComponent(PureTone(), 1, 0)
+
+        cached = model.signal()
+        cached_again = model.signal()
+        AbstractStimulusComponent.disableSignalCache()
+        uncached = model.signal()
+
+        np.testing.assert_array_equal(cached[0], uncached[0])
+        np.testing.assert_array_equal(cached_again[0], uncached[0])
+        assert_equal(cached[1:], uncached[1:])
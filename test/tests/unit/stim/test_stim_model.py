@@ -2,7 +2,7 @@ import os
 
 import numpy as np
 import yaml
-from nose.tools import assert_equal, raises
+from nose.tools import assert_almost_equal, assert_equal, raises
 
 import test.sample as sample
 from sparkle.data.open import open_acqdata
@@ -11,7 +11,9 @@ from sparkle.gui.stim.stimulus_editor import StimulusEditor
 from sparkle.stim.auto_parameter_model import AutoParameterModel
 from sparkle.stim.reorder import order_function
 from sparkle.stim.stimulus_model import StimulusModel
-from sparkle.stim.types.stimuli_classes import PureTone, Vocalization, SquareWave
+from sparkle.stim.types.stimuli_classes import PureTone, Silence, SquareWave, Vocalization
+from sparkle.tools.audiotools import convolve_filter
+from sparkle.tools.precision import set_signal_dtype, signal_dtype
 from sparkle.tools.systools import get_src_directory
 
 src_dir = get_src_directory()
@@ -120,6 +122,118 @@ class TestStimModel():
         assert len(doc) == nsteps
         assert doc[0]['samplerate_da'] == self.model.samplerate()
 
+    def test_expanded_stim_matches_separate_passes(self):
+        """single pass expansion gives the same result as expanding signal and doc separately"""
+        tcf = TCFactory()
+        model = tcf.create()
+        model.setReferenceVoltage(100, 0.1)
+        # fix the random order, so both passes can be put in the same order
+        order = order_function('random')(range(model.traceCount()))
+        model.setReorderFunc(lambda docs: order, 'random')
+
+        signals, docs, ovlds = model.expandedStim()
+
+        expected_signals = model.expandFunction(model.signal)
+        expected_docs = model.expandFunction(model.componentDoc)
+
+        assert len(signals) == model.traceCount()
+        for i, itrace in enumerate(order):
+            signal, atten, ovld = expected_signals[itrace]
+            doc = expected_docs[itrace]
+            doc['overloaded_attenuation'] = ovld
+            np.testing.assert_array_almost_equal(signals[i][0], signal)
+            assert_almost_equal(signals[i][1], atten)
+            assert_almost_equal(ovlds[i], ovld)
+            assert_equal(docs[i], doc)
+
+    def test_iter_expanded_stim_matches_expanded(self):
+        tcf = TCFactory()
+        model = tcf.create()
+        model.setReferenceVoltage(100, 0.1)
+        order = order_function('random')(range(model.traceCount()))
+        model.setReorderFunc(lambda docs: order, 'random')
+
+        signals, docs, ovlds = model.expandedStim()
+        streamed = list(model.iterExpandedStim())
+
+        assert_equal(len(streamed), len(signals))
+        for i, (trace, doc, ovld) in enumerate(streamed):
+            np.testing.assert_array_almost_equal(trace[0], signals[i][0])
+            assert_almost_equal(trace[1], signals[i][1])
+            assert_equal(doc, docs[i])
+            assert_almost_equal(ovld, ovlds[i])
+
+    def test_expanded_trace_by_index(self):
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        nsteps = self.add_auto_param(self.model)
+
+        signals, docs, ovlds = self.model.expandedStim()
+        for itrace in reversed(range(nsteps)):
+            trace, doc, ovld = self.model.expandedTrace(itrace)
+            np.testing.assert_array_almost_equal(trace[0], signals[itrace][0])
+            assert_equal(doc, docs[itrace])
+        assert_equal(component.intensity(), 0)
+
+    def test_tuning_curve_renders_each_frequency_once(self):
+        tcf = TCFactory()
+        model = tcf.create()
+        # wide enough intensity range to hit both voltage limits
+        model.autoParams().setParamValue(1, start=40, stop=120, step=20)
+        model.setReferenceVoltage(90, 0.1)
+        renders = []
+        mixed_signal = model._mixedSignal
+        def counting_mixed_signal(*args):
+            renders.append(1)
+            return mixed_signal(*args)
+        model._mixedSignal = counting_mixed_signal
+
+        signals, docs, ovlds = model.expandedStim()
+        nfreqs = len(model.autoParamRanges()[0])
+        assert_equal(len(renders), nfreqs)
+        assert_equal(len(signals), model.traceCount())
+
+        expected = model.expandFunction(model.signal)
+        assert max(ovlds) > 0
+        for (sig, atten), ovld, (exp_sig, exp_atten, exp_ovld) in zip(signals, ovlds, expected):
+            np.testing.assert_array_almost_equal(sig, exp_sig)
+            assert_almost_equal(atten, exp_atten)
+            assert_almost_equal(ovld, exp_ovld)
+
+        del renders[:]
+        streamed = list(model.iterExpandedStim())
+        # intensity varies slowest, so only consecutive traces in the stream share a render
+        assert_equal(len(renders), model.traceCount())
+        for (trace, doc, ovld), (sig, atten) in zip(streamed, signals):
+            np.testing.assert_array_almost_equal(trace[0], sig)
+
+    def test_amplitude_axis_needs_all_components(self):
+        tone0 = PureTone()
+        tone1 = PureTone()
+        self.model.insertComponent(tone0, 0, 0)
+        self.model.insertComponent(Silence(), 0, 1)
+        self.add_auto_param(self.model)
+        assert_equal(self.model._amplitudeAxis(), 0)
+
+        # a second tone, not changed by the intensity parameter
+        self.model.insertComponent(tone1, 1, 0)
+        assert_equal(self.model._amplitudeAxis(), None)
+
+        self.model.autoParams().toggleSelection(0, tone1)
+        assert_equal(self.model._amplitudeAxis(), 0)
+
+        # square waves do not scale with intensity
+        self.model.insertComponent(SquareWave(), 2, 0)
+        assert_equal(self.model._amplitudeAxis(), None)
+
+    def test_expanded_stim_resets_components(self):
+        component = PureTone()
+        self.model.insertComponent(component, 0,0)
+        self.add_auto_param(self.model)
+        self.model.expandedStim()
+
+        assert_equal(component.intensity(), 0)
+
     def test_signal_eq_caldb(self):
         caldb = 100
         calv = 0.1
@@ -517,6 +631,129 @@ class TestStimModel():
 
         assert self.model._calibration_fs == DEFAULT_SAMPLERATE
 
+    def test_expanded_stim_calibrated(self):
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+
+        tone = PureTone()
+        self.model.insertComponent(tone, 0, 0)
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        self.add_auto_param(self.model)
+
+        signals, docs, overloads = self.model.expandedStim()
+        expected = self.model.expandFunction(self.model.signal)
+        assert_equal(len(signals), len(expected))
+        for (sig, atten), (exp_sig, exp_atten, exp_over), over in zip(signals, expected, overloads):
+            np.testing.assert_array_almost_equal(sig, exp_sig)
+            assert_almost_equal(atten, exp_atten)
+            assert_almost_equal(over, exp_over)
+
+        # and the filter gives the same result as the straight convolution
+        convolved = convolve_filter(self.model._mixedSignal()[0], self.model.impulseResponse)
+        np.testing.assert_array_almost_equal(self.model._calibrate(self.model._mixedSignal()[0]), convolved)
+
+    def test_calibration_change_not_stale(self):
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+
+        self.model.insertComponent(PureTone(), 0, 0)
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        first_kernel = self.model.impulseResponse
+
+        # a different calibration, without clearing the cache
+        self.model.setCalibration(calibration_vector/2, calibration_freqs, frange)
+        assert not np.array_equal(first_kernel, self.model.impulseResponse)
+
+        # a different frequency range
+        self.model.setCalibration(calibration_vector, calibration_freqs, [10000, 80000])
+        assert not np.array_equal(first_kernel, self.model.impulseResponse)
+
+        # back to the original, re-uses the cached filter
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        assert self.model.impulseResponse is first_kernel
+
+    def test_precompute_kernels(self):
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+
+        vocal = Vocalization()
+        vocal.setFile(sample.samplewav())
+        self.model.insertComponent(vocal, 0, 0)
+        rates = self.model.expandedSamplerates()
+        assert_equal(rates, [vocal.samplerate()])
+
+        StimulusModel.clearCache()
+        filters = StimulusModel.precomputeKernels(rates + [DEFAULT_SAMPLERATE], calibration_vector,
+                                                  calibration_freqs, frange)
+        assert_equal(sorted(filters.keys()), sorted([vocal.samplerate(), DEFAULT_SAMPLERATE]))
+        misses = StimulusModel.kernelCache.stats()['misses']
+
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        assert self.model.calibrationFilter() is filters[vocal.samplerate()]
+        assert_equal(StimulusModel.kernelCache.stats()['misses'], misses)
+
+    def test_kernel_design(self):
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+
+        self.model.insertComponent(PureTone(), 0, 0)
+        self.model.setCalibration(calibration_vector, calibration_freqs, frange)
+        assert_equal(len(self.model.impulseResponse), StimulusModel.filterLength)
+        assert_equal(self.model.calibrationError(), 0)
+        full_signal = self.model.signal()[0]
+
+        self.model.setKernelDesign(4096, minimum_phase=True)
+        assert_equal(len(self.model.impulseResponse), 4096)
+        assert_equal(self.model.calibrationFilter().delay, 0)
+        error = self.model.calibrationError()
+        assert 0 < error < 1
+        short_signal = self.model.signal()[0]
+        assert_equal(len(short_signal), len(full_signal))
+
+        self.model.setKernelDesign()
+        assert_equal(len(self.model.impulseResponse), StimulusModel.filterLength)
+
+    def test_single_precision_tuning_curve(self):
+        frange = [5000, 100000]
+        cal_data_file = open_acqdata(sample.calibration_filename(), filemode='r')
+        calname = cal_data_file.calibration_list()[0]
+        calibration_vector, calibration_freqs = cal_data_file.get_calibration(calname, reffreq=15000)
+        cal_data_file.close()
+
+        model = TCFactory().create()
+        model.setReferenceVoltage(90, 0.1)
+        model.setCalibration(calibration_vector, calibration_freqs, frange)
+
+        default_dtype = signal_dtype()
+        try:
+            set_signal_dtype(np.float64)
+            doubles, docs, ovlds = model.expandedStim()
+            set_signal_dtype(np.float32)
+            singles, docs, ovlds = model.expandedStim()
+        finally:
+            set_signal_dtype(default_dtype)
+
+        assert_equal(len(singles), len(doubles))
+        for (single, atten), (double, exp_atten) in zip(singles, doubles):
+            assert_equal(single.dtype, np.float32)
+            assert_equal(double.dtype, np.float64)
+            # attenuation follows from the signal peak
+            assert_almost_equal(atten, exp_atten, places=4)
+            np.testing.assert_allclose(single, double, rtol=0,
+                                       atol=1e-5*np.amax(np.abs(double)))
+
     def add_auto_param(self, model):
         # adds an autoparameter to the given model
         ptype = 'intensity'
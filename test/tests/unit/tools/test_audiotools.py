@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -318,6 +319,35 @@ def test_impulse_response_truncation_length():
     ir = tools.impulse_response(fs, atten, freqs, frange, filter_len=npts+1000)
     assert len(ir) == npts
 
+def test_impulse_response_minimum_phase():
+    fs = 5e5
+    duration = 0.2
+    npts = int(duration*fs)
+
+    frange = [5000, 100000]
+    freqs = np.arange(npts/2 + 1)/(float(npts)/fs)
+    f0 = (np.abs(freqs-frange[0])).argmin()
+    f1 = (np.abs(freqs-frange[1])).argmin()
+    atten = np.zeros(npts/2 + 1)
+    atten[f0:f1] = np.linspace(0, 20, len(atten[f0:f1]))
+
+    full = tools.impulse_response(fs, atten, freqs, frange)
+    short = tools.impulse_response(fs, atten, freqs, frange, filter_len=2048, minimum_phase=True)
+    assert len(short) == 2048
+    # energy is at the start, not the middle
+    assert np.argmax(np.abs(short)) < 100
+    assert tools.kernel_error(full, full, fs, frange) == 0
+    # smooth response is well approximated by a short minimum phase kernel,
+    # away from the tapered band edges
+    assert tools.kernel_error(short, full, fs, [10000, 90000]) < 0.1
+
+def test_kernel_error():
+    fs = 1000
+    kernel = np.zeros(64)
+    kernel[0] = 1
+    assert_almost_equal(tools.kernel_error(kernel*10, kernel, fs, [0, 500]), 20)
+    assert tools.kernel_error(kernel, kernel, fs, [600, 700]) == 0
+
 def test_impulse_response_high_pass():
     fs = 5e5
     duration = 0.2
@@ -465,3 +495,43 @@ def test_audiorate_wav():
 def test_audiorate_call1():
     fs = tools.audiorate(sample.samplecall1())
     assert fs == 333333
+
+def test_audiolength_wav():
+    npts = tools.audiolength(sample.samplewav())
+    assert npts == 29758
+
+def test_audioread_cached_until_modified():
+    fname = os.path.join(tempfile.mkdtemp(), 'cache_test.wav')
+    wv.write(fname, 100000, np.arange(100, dtype=np.int16))
+    fs, signal = tools.audioread(fname)
+    assert_array_equal(signal, np.arange(100))
+    # modifying the returned signal must not alter the stored audio
+    signal[:] = 0
+    fs, signal = tools.audioread(fname)
+    assert_array_equal(signal, np.arange(100))
+
+    wv.write(fname, 200000, np.ones(50, dtype=np.int16))
+    # make sure the modification time differs on coarse filesystems
+    mtime = os.stat(fname).st_mtime
+    os.utime(fname, (mtime + 10, mtime + 10))
+    fs, signal = tools.audioread(fname)
+    assert fs == 200000
+    assert tools.audiolength(fname) == 50
+    assert_array_equal(signal, np.ones(50))
+
+def test_audio_cache_bounded():
+    folder = tempfile.mkdtemp()
+    fnames = [os.path.join(folder, 'cache_test{}.wav'.format(i)) for i in range(3)]
+    for fname in fnames:
+        wv.write(fname, 100000, np.arange(100, dtype=np.int16))
+    original = tools._audio_cache.budget
+    tools.clear_audio_cache()
+    # room for two of the files
+    tools._audio_cache.budget = 2*100*2
+    try:
+        for fname in fnames:
+            tools.audioread(fname)
+        assert len(tools._audio_cache) == 2
+    finally:
+        tools._audio_cache.budget = original
+        tools.clear_audio_cache()
@@ -0,0 +1,40 @@
+import numpy as np
+
+from sparkle.tools.averaging import RepAverage
+
+
+def test_average_matches_mean():
+    reps = np.random.random((5, 2, 100))
+    average = RepAverage((2, 100))
+    for rep in reps:
+        average.add(rep)
+    np.testing.assert_array_almost_equal(average.average(), reps.mean(axis=0))
+    assert np.all(average.counts == 5)
+
+def test_reject_every_channel():
+    reps = np.random.random((6, 3, 100))
+    reps[1, 2, 10:20] = 5
+    reps[4, 0, 50] = 2
+    average = RepAverage((3, 100))
+    for rep in reps:
+        average.add(rep, 1.5)
+
+    masked = np.where(reps >= 1.5, np.nan, reps)
+    np.testing.assert_array_almost_equal(average.average(), np.nanmean(masked, axis=0))
+    assert np.all(average.counts[2, 10:20] == 5)
+    assert average.counts[0, 50] == 5
+    assert average.counts.sum() == 6*3*100 - 11
+
+def test_all_rejected_nan():
+    average = RepAverage((1, 10))
+    average.add(np.ones((1, 10)), 0.5)
+    assert np.all(np.isnan(average.average()))
+    assert np.all(average.counts == 0)
+
+def test_reset():
+    average = RepAverage((1, 10))
+    average.add(np.ones((1, 10)))
+    average.reset()
+    average.add(np.zeros((1, 10)))
+    np.testing.assert_array_equal(average.average(), np.zeros((1, 10)))
+    assert np.all(average.counts == 1)
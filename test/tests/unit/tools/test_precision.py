@@ -0,0 +1,49 @@
+import numpy as np
+from nose.tools import assert_equal, raises
+
+from sparkle.tools.precision import as_daq, as_signal, set_signal_dtype, \
+    set_storage_dtype, signal_dtype, storage_dtype
+
+
+class TestPrecision():
+    def setUp(self):
+        self.default_dtype = signal_dtype()
+        self.default_storage = storage_dtype()
+
+    def tearDown(self):
+        set_signal_dtype(self.default_dtype)
+        set_storage_dtype(self.default_storage)
+
+    def test_default_double(self):
+        assert_equal(signal_dtype(), np.float64)
+
+    def test_default_storage_single(self):
+        assert_equal(storage_dtype(), np.float32)
+
+    def test_as_signal_converts(self):
+        set_signal_dtype('float32')
+        data = np.arange(10, dtype=np.float64)
+        converted = as_signal(data)
+        assert_equal(converted.dtype, np.float32)
+        np.testing.assert_array_equal(converted, data)
+
+        # already the right type, no copy
+        assert as_signal(converted) is converted
+
+    def test_as_daq_double_contiguous(self):
+        data = np.arange(20, dtype=np.float32)[::2]
+        converted = as_daq(data)
+        assert_equal(converted.dtype, np.float64)
+        assert converted.flags['C_CONTIGUOUS']
+        np.testing.assert_array_equal(converted, data)
+
+        double = np.arange(10, dtype=np.float64)
+        assert as_daq(double) is double
+
+    @raises(ValueError)
+    def test_integer_not_allowed(self):
+        set_signal_dtype(np.int16)
+
+    @raises(ValueError)
+    def test_storage_integer_not_allowed(self):
+        set_storage_dtype(np.int16)